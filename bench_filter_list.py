@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmark for FilterList.  Generates a block list shaped like
+EasyList (mostly host rules, plus url patterns and some exceptions),
+and measures how long it takes to compile, how long the compiled
+index takes to map, and how long a url lookup takes.
+
+Usage: python bench_filter_list.py [rule count] [lookup count]
+"""
+
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from filter_list import FilterList
+from request_filter import uri_host
+
+
+WORDS = [
+    "ads", "banner", "track", "pixel", "analytics", "promo", "sponsor",
+    "popup", "count", "stats", "beacon", "widget", "affiliate", "click",
+]
+
+
+def make_rules(rng, count):
+    rules = ["[Adblock Plus 2.0]", "! generated"]
+    for i in range(count):
+        kind = rng.random()
+        if kind < 0.6:
+            rules.append("||%s%i.com^" % (rng.choice(WORDS), i))
+        elif kind < 0.9:
+            rules.append("/%s/*/%s%i_" % (
+                rng.choice(WORDS), rng.choice(WORDS), i))
+        elif kind < 0.95:
+            rules.append("@@||cdn%i.net/%s/" % (i, rng.choice(WORDS)))
+        else:
+            rules.append("example%i.org##.%s" % (i, rng.choice(WORDS)))
+    return rules
+
+
+def make_uris(rng, count):
+    uris = []
+    for i in range(count):
+        uris.append("https://%s%i.com/%s/%i/%s%i_x.js?v=%i" % (
+            rng.choice(WORDS), rng.randint(0, 20000), rng.choice(WORDS), i,
+            rng.choice(WORDS), rng.randint(0, 20000), i))
+    return uris
+
+
+if __name__ == "__main__":
+    rule_count = 50000
+    lookup_count = 100000
+    if len(sys.argv) > 1:
+        rule_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        lookup_count = int(sys.argv[2])
+
+    rng = random.Random(1)
+    work_dir = tempfile.mkdtemp()
+    list_path = os.path.join(work_dir, "list.txt")
+    compiled_path = os.path.join(work_dir, "filters.bin")
+    try:
+        with open(list_path, "w") as source:
+            source.write("\n".join(make_rules(rng, rule_count)) + "\n")
+
+        start = time.time()
+        FilterList([list_path], compiled_path)
+        print "compile   %.2f ms, %i rules, %i bytes" % (
+            1e3 * (time.time() - start), rule_count,
+            os.path.getsize(compiled_path))
+        start = time.time()
+        filters = FilterList([list_path], compiled_path)
+        print "load      %.2f ms" % (1e3 * (time.time() - start))
+
+        uris = make_uris(rng, lookup_count)
+        hosts = [uri_host(uri) for uri in uris]
+        start = time.time()
+        blocked = 0
+        for uri, host in zip(uris, hosts):
+            if filters.blocks(uri, host):
+                blocked += 1
+        elapsed = time.time() - start
+        print "lookup    %i urls, %.2f us each, %i blocked" % (
+            lookup_count, 1e6 * elapsed / lookup_count, blocked)
+    finally:
+        shutil.rmtree(work_dir)
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Throughput and latency benchmarks for the universe protocol, that is
+IpcHandler and IpcListener over pipes.  No display and no WebKit are
+needed.  Each universe is a forked child running an echo listener on
+its own main loop, and the parent plays the frontend.
+
+Scenarios:
+
+    roundtrip  Every universe has one call in flight at a time.  The
+               latency of each call is recorded.
+    send       The frontend sends a stream of packets to every
+               universe, like navigation requests.
+    stream     Every universe sends packets to the frontend in bursts
+               with a pause in between, like title and uri updates.
+               The latency is from send to dispatch.
+
+Each scenario is run for every wire format, payload size (from short
+titles to large uris), and universe count.  The stream scenario is
+also run for every burst size.  CPU time per message is reported for
+the frontend and for the universes.
+
+Results are printed as json on stdout, with a summary on stderr.
+
+If PyGObject is not installed, the select based loop from
+test_support.py stands in for GLib, which is enough for the IPC code.
+
+Usage: python bench_ipc.py [--quick] [--output file.json]
+"""
+
+
+import os
+import sys
+import json
+import time
+import platform
+
+from test_support import GLib, iteration, LOOP
+import wire
+from universe import IpcHandler, IpcListener, read_process_usage
+
+
+# Payload sizes in bytes: a short title, a typical url, a long url
+# with tracking parameters, and a data uri.
+PAYLOAD_SIZES = (16, 128, 2048, 65536)
+UNIVERSE_COUNTS = (1, 4, 16)
+BURST_SIZES = (1, 16, 256)
+
+# Pause between bursts in the stream scenario, in milliseconds.
+BURST_GAP = 5
+
+
+def make_payload(size):
+    return ("http://example.com/?" + "x" * size)[:size]
+
+
+class EchoUniverse(IpcListener):
+    """
+    The universe end of the benchmark.
+    """
+
+    def __init__(self, ipc):
+        IpcListener.__init__(self, ipc)
+        self.received = 0
+        self.running = True
+
+    def ping(self, payload=None):
+        return True
+
+    def navigate_event(self, uri):
+        self.received += 1
+
+    def received_count(self):
+        return self.received
+
+    def start_stream(self, count, size, burst):
+        payload = make_payload(size)
+        remaining = [count]
+
+        def send_burst():
+            batch = min(burst, remaining[0])
+            remaining[0] -= batch
+            for i in xrange(batch):
+                self.send("update_uri", uri=payload, sent=time.time())
+            return remaining[0] > 0
+
+        if send_burst():
+            GLib.timeout_add(BURST_GAP, send_burst)
+        return True
+
+    def hangup_event(self):
+        self.running = False
+
+
+class Frontend(IpcListener):
+    """
+    The frontend end of the benchmark, for one universe.
+    """
+
+    def __init__(self, ipc, pid, pipes):
+        IpcListener.__init__(self, ipc)
+        self.pid = pid
+        self.pipes = pipes
+        self.latencies = []
+        self.received = 0
+
+    def update_uri(self, uri, sent):
+        self.received += 1
+        self.latencies.append(time.time() - sent)
+
+
+def spawn_universes(count, wire_format):
+    """
+    Fork 'count' echo universes.  All of them are forked before the
+    parent creates any IpcHandler, so no child inherits the watches of
+    another.
+    """
+    pipes = []
+    for i in range(count):
+        down_read, down_write = os.pipe()
+        up_read, up_write = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            for fd in (down_write, up_read):
+                os.close(fd)
+            for other in pipes:
+                for fd in other[1:]:
+                    os.close(fd)
+            ipc = IpcHandler(
+                os.fdopen(down_read, "rb", 0), os.fdopen(up_write, "wb"),
+                wire_format=wire_format, overflow_policy="block")
+            listener = EchoUniverse(ipc)
+            ipc.attach(listener)
+            while listener.running:
+                iteration(True)
+            os._exit(0)
+        os.close(down_read)
+        os.close(up_write)
+        pipes.append((pid, up_read, down_write))
+
+    frontends = []
+    for pid, up_read, down_write in pipes:
+        read_pipe = os.fdopen(up_read, "rb", 0)
+        write_pipe = os.fdopen(down_write, "wb")
+        # the send scenario outruns the universes on purpose, and
+        # every packet has to arrive to be counted
+        ipc = IpcHandler(read_pipe, write_pipe, wire_format=wire_format,
+                         overflow_policy="block")
+        frontend = Frontend(ipc, pid, (read_pipe, write_pipe))
+        ipc.attach(frontend)
+        frontends.append(frontend)
+    return frontends
+
+
+def stop_universes(frontends):
+    for frontend in frontends:
+        frontend.ipc.close()
+        for pipe in frontend.pipes:
+            pipe.close()
+    for frontend in frontends:
+        os.waitpid(frontend.pid, 0)
+
+
+def wait_for(condition, timeout=120):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise RuntimeError("benchmark timed out")
+        iteration(True)
+
+
+def cpu_time(frontends):
+    """
+    Returns the cpu seconds used so far by this process, and by all of
+    the universe processes together.
+    """
+    times = os.times()
+    universes = 0.0
+    for frontend in frontends:
+        usage = read_process_usage(frontend.pid)
+        if usage:
+            universes += usage[1]
+    return times[0] + times[1], universes
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def call_all(frontends, action, **kargs):
+    replies = []
+    for frontend in frontends:
+        frontend.call(action, replies.append, timeout=120000, **kargs)
+    wait_for(lambda: len(replies) == len(frontends))
+    return replies
+
+
+def run_roundtrip(frontends, size, count):
+    payload = make_payload(size)
+    latencies = []
+    remaining = [count]
+
+    def next_call(frontend):
+        if remaining[0] <= 0:
+            return
+        remaining[0] -= 1
+        start = time.time()
+
+        def done(result):
+            latencies.append(time.time() - start)
+            next_call(frontend)
+
+        frontend.call("ping", done, timeout=120000, payload=payload)
+
+    for frontend in frontends:
+        next_call(frontend)
+    wait_for(lambda: len(latencies) == count)
+    return count, latencies
+
+
+def run_send(frontends, size, count):
+    payload = make_payload(size)
+    per_universe = max(1, count // len(frontends))
+    for i in xrange(per_universe):
+        for frontend in frontends:
+            frontend.send("navigate_event", uri=payload)
+    # the count comes back once everything before it was handled
+    counts = call_all(frontends, "received_count")
+    return sum(counts), []
+
+
+def run_stream(frontends, size, count, burst):
+    per_universe = max(1, count // len(frontends))
+    for frontend in frontends:
+        frontend.received = 0
+        frontend.latencies = []
+    call_all(frontends, "start_stream",
+             count=per_universe, size=size, burst=burst)
+    total = per_universe * len(frontends)
+    wait_for(lambda: sum(each.received for each in frontends) == total)
+    latencies = []
+    for frontend in frontends:
+        latencies.extend(frontend.latencies)
+    return total, latencies
+
+
+def measure(scenario, wire_format, size, universes, count, burst=None):
+    frontends = spawn_universes(universes, wire_format)
+    try:
+        call_all(frontends, "ping")
+        frame_size = len(wire.FORMATS[wire_format]().encode(
+            "update_uri", {"uri" : make_payload(size)}))
+        before = cpu_time(frontends)
+        start = time.time()
+        if scenario == "roundtrip":
+            messages, latencies = run_roundtrip(frontends, size, count)
+        elif scenario == "send":
+            messages, latencies = run_send(frontends, size, count)
+        else:
+            messages, latencies = run_stream(frontends, size, count, burst)
+        elapsed = time.time() - start
+        after = cpu_time(frontends)
+    finally:
+        stop_universes(frontends)
+
+    latencies.sort()
+    result = {
+        "scenario" : scenario,
+        "wire" : wire_format,
+        "payload_bytes" : size,
+        "frame_bytes" : frame_size,
+        "universes" : universes,
+        "burst" : burst,
+        "messages" : messages,
+        "seconds" : elapsed,
+        "messages_per_second" : messages / elapsed,
+        "p50_us" : None,
+        "p99_us" : None,
+        "frontend_cpu_us_per_message" : 1e6 * (after[0] - before[0]) / messages,
+        "universe_cpu_us_per_message" : 1e6 * (after[1] - before[1]) / messages,
+    }
+    if latencies:
+        result["p50_us"] = 1e6 * percentile(latencies, 0.5)
+        result["p99_us"] = 1e6 * percentile(latencies, 0.99)
+    return result
+
+
+def describe(result):
+    line = ("%(scenario)-9s %(wire)-6s %(payload_bytes)6iB "
+            "x%(universes)-3i" % result)
+    if result["burst"]:
+        line += " burst %-4i" % result["burst"]
+    else:
+        line += " " * 11
+    line += " %9.0f msg/s" % result["messages_per_second"]
+    if result["p50_us"] is not None:
+        line += "  p50 %8.1f us  p99 %8.1f us" % (
+            result["p50_us"], result["p99_us"])
+    line += "  cpu %.1f + %.1f us/msg" % (
+        result["frontend_cpu_us_per_message"],
+        result["universe_cpu_us_per_message"])
+    return line
+
+
+def main(args):
+    quick = "--quick" in args
+    output = None
+    if "--output" in args:
+        output = args[args.index("--output") + 1]
+
+    count = 500 if quick else 5000
+    sizes = PAYLOAD_SIZES[:2] + PAYLOAD_SIZES[-1:] if quick else PAYLOAD_SIZES
+    universe_counts = UNIVERSE_COUNTS[:2] if quick else UNIVERSE_COUNTS
+    bursts = BURST_SIZES[::2] if quick else BURST_SIZES
+
+    results = []
+
+    def run(*args):
+        result = measure(*args)
+        sys.stderr.write(describe(result) + "\n")
+        results.append(result)
+
+    for wire_format in sorted(wire.FORMATS):
+        for size in sizes:
+            for universes in universe_counts:
+                run("roundtrip", wire_format, size, universes, count)
+                run("send", wire_format, size, universes, count)
+                for burst in bursts:
+                    run("stream", wire_format, size, universes, count, burst)
+
+    report = json.dumps({
+        "environment" : {
+            "python" : platform.python_version(),
+            "platform" : platform.platform(),
+            "loop" : LOOP,
+            "time" : time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        },
+        "results" : results,
+    }, indent=2)
+    if output:
+        with open(output, "w") as report_file:
+            report_file.write(report + "\n")
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Microbenchmark for HistoryIndex.  Fills the index with a generated
+history, then types queries one character at a time, like a user in
+the url bar, and reports how long each keystroke's search took.  A
+keystroke should be answered well within a frame (16 ms).
+
+Usage: python bench_omnibox.py [history size]
+"""
+
+
+import sys
+import time
+import random
+
+from omnibox import HistoryIndex
+
+
+WORDS = [
+    "news", "python", "linux", "kernel", "github", "issue", "weather",
+    "recipe", "music", "video", "mail", "docs", "search", "forum",
+    "wiki", "release", "notes", "bank", "shop", "map", "travel", "game",
+]
+
+SITES = ["github.com", "wikipedia.org", "bbc.co.uk", "example.com",
+         "lwn.net", "gnome.org", "duckduckgo.com", "reddit.com"]
+
+QUERIES = ["g", "github", "git iss", "wiki linux", "lwn kernel rel",
+           "bbc news weather", "zzz", "e", "shop game", "docs python"]
+
+
+def make_history(rng, count):
+    now = time.time()
+    history = []
+    for i in range(count):
+        site = rng.choice(SITES) if rng.random() < 0.7 else \
+            "%s%i.com" % (rng.choice(WORDS), rng.randint(0, 5000))
+        path = "/".join(rng.choice(WORDS) for j in range(rng.randint(1, 3)))
+        title = " ".join(rng.choice(WORDS) for j in range(rng.randint(2, 6)))
+        history.append((
+            "https://%s/%s/%i" % (site, path, i), title.title(),
+            now - rng.random() * 365 * 86400))
+    return history
+
+
+if __name__ == "__main__":
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    rng = random.Random(1)
+    history = make_history(rng, count)
+    index = HistoryIndex()
+    start = time.time()
+    for url, title, when in history:
+        index.visit(url, title, when)
+    # some pages get visited a lot
+    for url, title, when in rng.sample(history, count // 10):
+        for i in range(rng.randint(1, 20)):
+            index.visit(url, when=when + i * 3600)
+    elapsed = time.time() - start
+    print "fill      %i entries, %i visits, %.2f us per visit" % (
+        len(index), count + count // 10 * 10,
+        1e6 * elapsed / (count + count // 10 * 10))
+
+    timings = []
+    for query in QUERIES:
+        for length in range(1, len(query) + 1):
+            start = time.time()
+            index.search(query[:length])
+            timings.append(time.time() - start)
+    timings.sort()
+    print "keystroke %i searches, mean %.3f ms, p99 %.3f ms, max %.3f ms" % (
+        len(timings), 1e3 * sum(timings) / len(timings),
+        1e3 * timings[int(len(timings) * 0.99)], 1e3 * timings[-1])
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Microbenchmark for PublicSuffixList.  Measures how long it takes to
+load the list, both when it has to be compiled and when the compiled
+file can be mapped, and then how many lookups per second it manages
+with every host distinct (cache misses), with a repeating host mix
+(cache hits), and through the batch interface.
+
+Usage: python bench_public_suffix.py [lookup count]
+"""
+
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from public_suffix import PublicSuffixList
+
+
+SUFFIXES = [
+    "com", "net", "org", "co.uk", "org.uk", "com.au", "github.io",
+    "kawasaki.jp", "city.kawasaki.jp", "appspot.com", "de", "unknowntld",
+]
+
+
+def make_hosts(rng, count):
+    hosts = []
+    for i in range(count):
+        labels = ["site%i" % i, rng.choice(SUFFIXES)]
+        if rng.random() < 0.5:
+            labels.insert(0, rng.choice(["www", "cdn", "static.a"]))
+        hosts.append(".".join(labels))
+    return hosts
+
+
+def run(name, count, lookup):
+    start = time.time()
+    lookup()
+    elapsed = time.time() - start
+    print "%-9s %i lookups, %.2f us each, %.0f per second" % (
+        name, count, 1e6 * elapsed / count, count / elapsed)
+
+
+if __name__ == "__main__":
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    cache_dir = tempfile.mkdtemp()
+    compiled_path = os.path.join(cache_dir, "public_suffix.bin")
+    try:
+        start = time.time()
+        PublicSuffixList(compiled_path=compiled_path)
+        print "compile   %.2f ms" % (1e3 * (time.time() - start))
+        start = time.time()
+        suffixes = PublicSuffixList(compiled_path=compiled_path)
+        print "load      %.2f ms" % (1e3 * (time.time() - start))
+
+        rng = random.Random(1)
+        distinct = make_hosts(rng, count)
+        # a browsing session mostly revisits a handful of hosts
+        favourites = distinct[:50]
+        skewed = [rng.choice(favourites) for i in range(count)]
+
+        def lookup_all(hosts):
+            for host in hosts:
+                suffixes.registrable_domain(host)
+
+        run("distinct", count, lambda: lookup_all(distinct))
+        run("skewed", count, lambda: lookup_all(skewed))
+        suffixes.cache.entries.clear()
+        run("batch", count, lambda: suffixes.registrable_domains(skewed))
+    finally:
+        shutil.rmtree(cache_dir)
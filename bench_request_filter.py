@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Microbenchmark for RequestFilter.  Runs 100k lookups against a filter
+with a few thousand rules, once with every host distinct (so every
+lookup walks the tries) and once with the skewed host mix of a real
+page (so most lookups hit the decision cache).
+
+Usage: python bench_request_filter.py [lookup count]
+"""
+
+
+import sys
+import time
+import random
+
+from request_filter import RequestFilter
+
+
+def make_rules(rng, count):
+    names = []
+    for i in range(count):
+        labels = ["site%i" % rng.randint(0, 100000)]
+        if rng.random() < 0.3:
+            labels.insert(0, "cdn")
+        labels.append(rng.choice(["com", "net", "org", "co.uk", "io"]))
+        names.append(".".join(labels))
+    return names
+
+
+def run(name, filter, uris):
+    start = time.time()
+    allowed = 0
+    for uri in uris:
+        if filter.allows(uri):
+            allowed += 1
+    elapsed = time.time() - start
+    print "%-9s %i lookups, %.2f us each, %i allowed" % (
+        name, len(uris), 1e6 * elapsed / len(uris), allowed)
+
+
+if __name__ == "__main__":
+    count = 100000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    rng = random.Random(1)
+    allow = make_rules(rng, 2000)
+    block = make_rules(rng, 5000)
+    filter = RequestFilter(allow, block, "block")
+
+    hosts = allow + block + make_rules(rng, 2000)
+    distinct = [
+        "https://h%i.%s/path/to/resource.js?v=%i" % (i, rng.choice(hosts), i)
+        for i in range(count)]
+    # a page mostly talks to a handful of hosts
+    favourites = hosts[:20]
+    skewed = [
+        "https://%s/img/%i.png" % (rng.choice(
+            favourites if rng.random() < 0.95 else hosts), i)
+        for i in range(count)]
+
+    filter.update(allow, block, "block")
+    run("distinct", filter, distinct)
+    filter.update(allow, block, "block")
+    run("skewed", filter, skewed)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Scaling check for TabTreeIndex.  Fills a tab tree with universes and
+tabs, checks that every row can still be found after rows are added
+and removed around it, and compares the cost of a title update done
+through the index against the old recursive scan of the store.
+
+Usage: python bench_tab_tree.py [tab count]
+"""
+
+
+import sys
+import time
+import uuid
+
+from gi.repository import Gtk
+
+from browser import TabTreeIndex
+
+
+TABS_PER_UNIVERSE = 20
+
+
+def scan_tree(store, thing_id, search=None):
+    """
+    The recursive lookup that TabTreeIndex replaced.
+    """
+    for row in search or store:
+        if store.get_value(row.iter, 1) == thing_id:
+            return row.iter
+        found = scan_tree(store, thing_id, row.iterchildren())
+        if found:
+            return found
+
+
+def check(store, index, ids):
+    for thing_id in ids:
+        tree_iter = index.find(thing_id)
+        if tree_iter is None or store.get_value(tree_iter, 1) != thing_id:
+            sys.exit("Lookup failed for row %s" % thing_id)
+
+
+def time_updates(store, find, ids):
+    start = time.time()
+    for thing_id in ids:
+        store[find(thing_id)][0] = "title %s" % thing_id
+    return (time.time() - start) / len(ids)
+
+
+if __name__ == "__main__":
+    count = 1000
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+
+    store = Gtk.TreeStore(str, str, str)
+    index = TabTreeIndex(store)
+    tab_ids = []
+    universe_ids = []
+    start = time.time()
+    for number in range(count):
+        if number % TABS_PER_UNIVERSE == 0:
+            universe_id = str(len(universe_ids) + 1)
+            universe_ids.append(universe_id)
+            universe_iter = index.append(None, ["EARTH", universe_id, ""])
+        tab_id = uuid.uuid4().hex
+        tab_ids.append(tab_id)
+        index.append(universe_iter, ["New Tab", tab_id, ""])
+    fill_time = time.time() - start
+    check(store, index, tab_ids + universe_ids)
+
+    # remove every other universe and every third remaining tab, and
+    # make sure the surviving rows are still found
+    start = time.time()
+    removed = set()
+    for universe_id in universe_ids[::2]:
+        index.remove(universe_id)
+        removed.add(universe_id)
+    universe_of = dict(
+        (tab_id, universe_ids[number // TABS_PER_UNIVERSE])
+        for number, tab_id in enumerate(tab_ids))
+    for tab_id in tab_ids[::3]:
+        index.remove(tab_id)
+        removed.add(tab_id)
+    remove_time = time.time() - start
+    survivors = [
+        tab_id for tab_id in tab_ids
+        if tab_id not in removed and universe_of[tab_id] not in removed]
+    check(store, index, survivors)
+    for thing_id in removed:
+        if index.find(thing_id) is not None:
+            sys.exit("Removed row %s is still indexed" % thing_id)
+
+    indexed = time_updates(store, index.find, survivors)
+    scanned = time_updates(
+        store, lambda thing_id: scan_tree(store, thing_id), survivors)
+
+    print "%i rows, %i left after removals" % (
+        count + len(universe_ids), len(survivors))
+    print "fill:   %.2f ms total" % (1000 * fill_time)
+    print "remove: %.2f ms total" % (1000 * remove_time)
+    print "title update, indexed: %.1f us each" % (1e6 * indexed)
+    print "title update, scanned: %.1f us each" % (1e6 * scanned)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Compares the "popen" and "zygote" spawn modes for universe processes.
+
+For each mode, a number of universes are started one after another.
+The spawn latency is the time from creating the Universe until the
+process answers a ping.  Once all of them are up, the memory of every
+universe process (and the zygote, if any) is summed up from /proc.
+RSS counts shared pages once per process, while PSS divides them
+between the processes sharing them, so PSS is the better measure of
+what copy-on-write sharing saves.
+
+Usage: python bench_zygote.py [universe count]
+"""
+
+
+import sys
+import json
+import time
+import shutil
+import tempfile
+
+from gi.repository import GLib
+
+import universe
+
+
+def read_memory(pid):
+    """
+    Returns the (rss, pss) of a process in kB.
+    """
+    rss = pss = 0
+    try:
+        with open("/proc/%i/status" % pid) as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+        with open("/proc/%i/smaps_rollup" % pid) as smaps:
+            for line in smaps:
+                if line.startswith("Pss:"):
+                    pss = int(line.split()[1])
+    except IOError:
+        pass
+    return rss, pss
+
+
+def wait_for(condition, timeout=60):
+    context = GLib.MainContext.default()
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        context.iteration(True)
+
+
+def run_mode(mode, count):
+    universe.SPAWN_MODE = mode
+    universe.pool.size = 0
+    if mode == "zygote":
+        universe.zygote.start()
+        # let the fork server finish its imports before timing
+        pinger = universe.Universe()
+        replies = []
+        pinger.call("ping", replies.append, timeout=60000)
+        wait_for(lambda: replies)
+        pinger.destroy()
+
+    latencies = []
+    universes = []
+    for i in range(count):
+        replies = []
+        start = time.time()
+        new_universe = universe.Universe()
+        new_universe.call("ping", replies.append, timeout=60000)
+        wait_for(lambda: replies)
+        latencies.append(time.time() - start)
+        universes.append(new_universe)
+
+    pids = [each.proc.pid for each in universes]
+    if mode == "zygote":
+        pids.append(universe.zygote.proc.pid)
+    memory = [read_memory(pid) for pid in pids]
+
+    for each in universes:
+        each.destroy()
+    # wait for the universes to exit while the zygote is still around
+    # to reap the ones it forked, so that none are left as zombies
+    universe.pool.drain()
+    universe.reaper.finish()
+    universe.zygote.stop()
+
+    latencies.sort()
+    return {
+        "mode" : mode,
+        "universes" : count,
+        "spawn_mean_ms" : 1000 * sum(latencies) / len(latencies),
+        "spawn_p50_ms" : 1000 * latencies[len(latencies) // 2],
+        "spawn_max_ms" : 1000 * latencies[-1],
+        "total_rss_kb" : sum(rss for rss, pss in memory),
+        "total_pss_kb" : sum(pss for rss, pss in memory),
+    }
+
+
+if __name__ == "__main__":
+    count = 20
+    if len(sys.argv) > 1:
+        count = int(sys.argv[1])
+    # keep the http caches of the benchmark's universes out of the
+    # user's real cache directory
+    universe.CACHE_DIR = tempfile.mkdtemp()
+    try:
+        results = [run_mode(mode, count) for mode in ("popen", "zygote")]
+    finally:
+        shutil.rmtree(universe.CACHE_DIR, ignore_errors=True)
+    for result in results:
+        sys.stderr.write(
+            "%(mode)-7s %(universes)i universes: "
+            "spawn %(spawn_mean_ms).1f ms mean, %(spawn_max_ms).1f ms max, "
+            "RSS %(total_rss_kb)i kB, PSS %(total_pss_kb)i kB\n" % result)
+    print json.dumps(results, indent=2)
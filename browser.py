@@ -17,15 +17,52 @@
 # along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import time
+IMPORT_START = time.time()
+
+import os
 import re
+import sys
 import json
 import uuid
 
 from urlparse import urlsplit, urlunsplit
 
 import gi
-from gi.repository import Gtk, GObject
-from universe import Universe, IpcListener
+from gi.repository import Gtk, GObject, GLib
+from universe import Universe, IpcListener, pool as universe_pool, zygote
+from universe import prune_universe_caches, reaper
+from session import SessionJournal
+from tracing import tracer
+import ipc_metrics
+from request_filter import uri_host, load_host_rules
+from public_suffix import default_list as suffix_list
+from thumbnails import prune_stale_rings
+from filter_list import default_filter_list
+from omnibox import HistoryIndex
+
+
+# Seconds a universe may go without any of its tabs being focused
+# before its process is torn down.  Zero disables hibernation.
+HIBERNATE_AFTER = int(os.environ.get("RIDINGHOOD_HIBERNATE_AFTER", 600))
+
+# Seconds between checks for universes that should be hibernated.
+HIBERNATE_CHECK_INTERVAL = 30
+
+# Seconds between samples of the memory and cpu used by each universe.
+USAGE_SAMPLE_INTERVAL = 5
+
+# When the universes together use more resident memory than this many
+# megabytes, the least recently focused ones are hibernated.  Zero
+# disables the budget.
+MEMORY_BUDGET = int(os.environ.get("RIDINGHOOD_MEMORY_BUDGET", 0))
+
+# Seconds the session journal gets to finish writing at shutdown.
+JOURNAL_CLOSE_TIMEOUT = 2
+
+# Most tabs a universe will take on when a url is routed to it because
+# it already has the url's domain open.  Zero means no limit.
+UNIVERSE_TAB_LIMIT = int(os.environ.get("RIDINGHOOD_UNIVERSE_TABS", 16))
 
 
 def validate_url(in_url):
@@ -51,10 +88,130 @@ def validate_url(in_url):
 
 def url_domain(url):
     """
-    Return the two top-most domains from a given url.
+    Return the registrable domain (eTLD+1) of a given url, such as
+    "bbc.co.uk" for "http://www.bbc.co.uk/news".  Hosts that have no
+    registrable domain, like ip addresses, "localhost", or a bare
+    public suffix, are returned as they are.
+    """
+    host = uri_host(url)
+    if not host:
+        return urlsplit(url).netloc
+    if host.startswith("[") or host.replace(".", "").isdigit():
+        return host
+    return suffix_list().registrable_domain(host) or host
+
+
+class TabTreeIndex(object):
+    """
+    Indexes the rows of the tab tree by the ID stored in their second
+    column, so that a row can be found without walking the whole tree.
+    Each entry is a Gtk.TreeRowReference, which Gtk keeps pointing at
+    the right row as other rows are added and removed.
+
+    Rows must be added and removed through this class for the index
+    to stay in sync with the store.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.rows = {}
+
+    def append(self, parent_iter, row):
+        """
+        Append a row to the store, under the given parent row, and
+        return its GtkTreeIter.
+        """
+        tree_iter = self.store.append(parent_iter, row)
+        path = self.store.get_path(tree_iter)
+        self.rows[str(row[1])] = Gtk.TreeRowReference.new(self.store, path)
+        return tree_iter
+
+    def find(self, row_id):
+        """
+        Returns the GtkTreeIter for the given ID, or None.
+        """
+        reference = self.rows.get(str(row_id))
+        if reference and reference.valid():
+            return self.store.get_iter(reference.get_path())
+
+    def remove(self, row_id):
+        """
+        Remove the row with the given ID from the store, along with
+        any of its children.
+        """
+        tree_iter = self.find(row_id)
+        self.rows.pop(str(row_id), None)
+        if tree_iter:
+            child = self.store.iter_children(tree_iter)
+            while child:
+                self.rows.pop(self.store.get_value(child, 1), None)
+                child = self.store.iter_next(child)
+            self.store.remove(tree_iter)
+
+
+class DomainRegistry(object):
+    """
+    Tracks which universes have tabs open on which registrable domains
+    (see url_domain), so that a url can be opened in a universe that
+    already has its domain open instead of spawning a new one.
+
+    Each tab claims the domain of its current url.  A universe owns a
+    domain for as long as at least one of its tabs claims it.
     """
-    parts = urlsplit(url)
-    return ".".join(parts.netloc.split(".")[-2:])
+
+    def __init__(self):
+        # domain -> {universe ID -> number of claiming tabs}
+        self.domains = {}
+        # tab ID -> (domain, universe ID)
+        self.claims = {}
+
+    def claim(self, tab):
+        """
+        Record the domain of a tab's current url, dropping whatever the
+        tab claimed before.
+        """
+        domain = url_domain(tab.url)
+        claim = (domain, tab.universe.universe_id)
+        if self.claims.get(tab.uuid) == claim:
+            return
+        self.release(tab.uuid)
+        if domain:
+            self.claims[tab.uuid] = claim
+            owners = self.domains.setdefault(domain, {})
+            owners[claim[1]] = owners.get(claim[1], 0) + 1
+
+    def release(self, tab_id):
+        """
+        Drop the claim of a tab, such as when it is closed.
+        """
+        claim = self.claims.pop(tab_id, None)
+        if claim:
+            domain, universe_id = claim
+            owners = self.domains[domain]
+            owners[universe_id] -= 1
+            if not owners[universe_id]:
+                del owners[universe_id]
+            if not owners:
+                del self.domains[domain]
+
+    def owner(self, domain):
+        """
+        Returns the live universe with the most tabs on the given
+        domain that still has room for another tab, or None.
+        """
+        best = None
+        best_count = 0
+        universes = Universe.__active_universes__
+        for universe_id, count in self.domains.get(domain, {}).iteritems():
+            universe = universes.get(universe_id)
+            if not universe or count <= best_count:
+                continue
+            if UNIVERSE_TAB_LIMIT and \
+               len(universe.actors) >= UNIVERSE_TAB_LIMIT:
+                continue
+            best = universe
+            best_count = count
+        return best
 
 
 class BrowserTab(object):
@@ -62,39 +219,65 @@ class BrowserTab(object):
     This class represents a browser tab.  It is mostly boilerplate for
     event routing.  It is also responsible for tracking the Socket
     object needed to display the browser tab.
+
+    When the tab's universe is hibernated, the tab keeps the url,
+    title and history snapshot of the page, which are used to recreate
+    the page once the universe wakes up.
+
+    A tab restored from the session journal passes in the ID and title
+    it was recorded with.
+
+    Tabs are created without a BrowserWorker.  The worker, and with it
+    the WebView and Plug, is only created in the universe process the
+    first time the tab is focused, which sets "materialized".  Until
+    then the tab is just its row in the tab tree.
+
+    The tab's "thumbnail" is a cairo surface over a slot of the
+    universe's ThumbnailRing, which the worker draws into.  It is kept
+    when the universe hibernates.
     """
     
-    def __init__(self, browser, url, universe):
+    def __init__(self, browser, url, universe, tab_id=None, title="New Tab"):
         self.url = url
-        self.title = "New Tab"
+        self.title = title
+        self.history = None
+        self.materialized = False
+        self.thumbnail = None
+        self.thumbnail_slot = None
+        self.thumbnail_visible = False
         
-        self.uuid = uuid.uuid4().hex
+        self.uuid = tab_id or uuid.uuid4().hex
         self.browser = browser
         self.universe = universe
         self.universe.register(self.uuid, self)
+        self.browser.domains.claim(self)
+        self.browser.journal.record(
+            "t", self.uuid, universe.identity, self.url, self.title)
 
         self.init_ui_elements()
-        self.send("create_new_tab", url=self.url)
 
     def init_ui_elements(self):
         # setup the XEmbed socket:
         self.socket = Gtk.Socket()
         self.socket.set_can_focus(True)
+        self.socket.connect("plug-removed", self.plug_removed_event)
 
         # add universe tab to tree, if applicable:
         tab_store = self.browser.tab_store
+        tab_index = self.browser.tab_index
         uni_id = self.universe.universe_id
-        uni_iter = self.browser.find_tree_iter(uni_id)
+        uni_iter = tab_index.find(uni_id)
         if not uni_iter:
             uni_row = [
                 self.universe.__repr__(),
                 str(uni_id),
+                "",
             ]
-            uni_iter = tab_store.append(None, uni_row)
+            uni_iter = tab_index.append(None, uni_row)
 
         # add browser tab to tree:
-        tab_row = [self.title, self.uuid]
-        tree_iter = tab_store.append(uni_iter, tab_row)
+        tab_row = [self.title, self.uuid, ""]
+        tree_iter = tab_index.append(uni_iter, tab_row)
 
         # expand universe row:
         uni_path = tab_store.get_path(uni_iter)
@@ -107,7 +290,74 @@ class BrowserTab(object):
         populates the 'target' field of the packet.
         """
         self.universe.send(action, target=self.uuid, **packet)
-        
+
+    def call(self, action, callback=None, errback=None, **packet):
+        """
+        Like 'send', but expects a reply from the BrowserWorker.  See
+        IpcListener.call for the details.
+        """
+        return self.universe.call(
+            action, callback, errback, target=self.uuid, **packet)
+
+    def create_worker(self):
+        """
+        Ask the universe to create the BrowserWorker for this tab.
+        """
+        self.materialized = True
+        self.thumbnail_visible = False
+        tracer.instant("create_new_tab sent", url=self.url)
+        self.send("create_new_tab", url=self.url, history=self.history)
+        self.browser.queue_thumbnail_update()
+
+    def set_thumbnail_visible(self, visible):
+        """
+        Tell the worker whether the tab's row can be seen, since it only
+        draws thumbnails for rows that can.
+        """
+        if self.materialized and visible != self.thumbnail_visible:
+            self.thumbnail_visible = visible
+            self.send("set_thumbnail_visible", visible=visible)
+
+    def thumbnail_ready(self, slot):
+        """
+        Event handler for when the worker has drawn a new thumbnail.
+        The slot the old one was in is handed back to the universe.
+        """
+        ring = self.universe.thumbnails
+        if not ring or not 0 <= slot < len(ring.slots):
+            return
+        self.release_thumbnail()
+        self.thumbnail = ring.surface(slot)
+        self.thumbnail_slot = slot
+        self.universe.held_thumbnails.add(slot)
+        tree_iter = self.browser.find_tree_iter(self.uuid)
+        if tree_iter:
+            self.browser.tab_store.row_changed(
+                self.browser.tab_store.get_path(tree_iter), tree_iter)
+
+    def release_thumbnail(self):
+        """
+        Stop showing the current thumbnail, so that the universe can
+        draw into its slot again.
+        """
+        if self.thumbnail_slot is not None:
+            self.universe.held_thumbnails.discard(self.thumbnail_slot)
+            self.universe.send("release_thumbnail", slot=self.thumbnail_slot)
+        self.thumbnail = None
+        self.thumbnail_slot = None
+
+    def snapshot_event(self, state):
+        """
+        Callback for the reply to a "snapshot_state" call, which is made
+        before the universe is hibernated.
+        """
+        self.url = state["uri"] or self.url
+        self.title = state["title"] or self.title
+        self.history = state["history"]
+        self.browser.domains.claim(self)
+        self.browser.journal.record("n", self.uuid, self.url)
+        self.browser.journal.record("h", self.uuid, self.title)
+
     def navigate_to(self, url):
         """
         Request that the universe open the given url.
@@ -115,6 +365,8 @@ class BrowserTab(object):
         self.send("navigate_event", uri=url)
         self.browser.url_bar.set_text(url)
         self.url = url
+        self.browser.domains.claim(self)
+        self.browser.journal.record("n", self.uuid, url)
 
     def activate(self, *args, **kargs):
         """
@@ -139,7 +391,9 @@ class BrowserTab(object):
         Event handler for when the program is trying to quit.  This
         triggers the browser universe to tear down.
         """
-        self.send("teardown")
+        self.release_thumbnail()
+        if self.materialized:
+            self.send("teardown")
         self.universe.remove(self.uuid)
         if not self.universe.actors:
             self.universe.destroy()
@@ -154,18 +408,29 @@ class BrowserTab(object):
         self.browser.views.remove(self.socket)
         self.socket.destroy()
 
+    def plug_removed_event(self, *args, **kargs):
+        """
+        Event handler for when the universe's Plug goes away.  Returning
+        True keeps the Socket around, so that a woken up universe can
+        attach to it again.
+        """
+        return True
+
     def attach_event(self, plug_id):
         """
         Event handler for when the universe reports the plug_id of its
         Plug object.
         """
-        self.socket.add_id(int(plug_id))
+        with tracer.span("socket.add_id", plug_id=plug_id):
+            self.socket.add_id(int(plug_id))
 
     def title_changed_event(self, new_title):
         """
         Event handler for when the title of the open web page changes.
         """
         self.title = new_title
+        self.browser.journal.record("h", self.uuid, new_title)
+        self.browser.history_index.set_title(self.url, new_title)
         tree_iter = self.browser.find_tree_iter(self.uuid)
         if tree_iter:
             self.browser.tab_store[tree_iter][0] = self.title
@@ -174,7 +439,25 @@ class BrowserTab(object):
         """
         Query the universe for the current status of the history buttons.
         """
-        self.send("update_history_state")
+        self.call("query_history_state",
+                  self.history_state_event, self.history_state_failed)
+
+    def history_state_event(self, state):
+        """
+        Callback for the reply to request_history_state.  Replies for
+        tabs that lost focus in the mean time are ignored.
+        """
+        if self.browser.focused is self:
+            self.update_history_buttons(**state)
+
+    def history_state_failed(self, error):
+        """
+        Callback for when the universe failed to report the history
+        state.  The buttons are disabled rather than left stale.
+        """
+        sys.stderr.write("History state unavailable: %s\n" % error)
+        if self.browser.focused is self:
+            self.update_history_buttons(False, False)
 
     def update_history_buttons(self, back, forward):
         """
@@ -189,7 +472,13 @@ class BrowserTab(object):
         Update the value shown in the url bar.
         """
         if uri:
-            self.browser.url_bar.set_text(uri)
+            self.url = uri
+            self.browser.domains.claim(self)
+            self.browser.journal.record("n", self.uuid, uri)
+            if uri_host(uri):
+                self.browser.history_index.visit(uri)
+            if self.browser.focused is self:
+                self.browser.url_bar.set_text(uri)
 
 
 class TabContextMenu(object):
@@ -269,9 +558,10 @@ class BrowserWindow(object):
     tabs.  For example, the title, the webkit universe, and so on.
     """
     def __init__(self):
-        builder = Gtk.Builder()
-        builder.add_from_file("layout.glade")
-        builder.connect_signals(self)
+        with tracer.span("load glade"):
+            builder = Gtk.Builder()
+            builder.add_from_file("layout.glade")
+            builder.connect_signals(self)
         
         window = builder.get_object("BrowserWindow")
         window.set_default_size(900, 675)
@@ -281,6 +571,27 @@ class BrowserWindow(object):
         self.history_forward = builder.get_object("HistoryForward")
         self.history_backward = builder.get_object("HistoryBackward")
 
+        # suggestions shown under the url bar, from the pages visited
+        # this session, which includes the open tabs
+        self.history_index = HistoryIndex()
+        # title, description, url, and ID of the tab showing the url
+        self.suggestions = Gtk.ListStore(str, str, str, str)
+        completion = Gtk.EntryCompletion()
+        completion.set_model(self.suggestions)
+        # the suggestions are already filtered by the HistoryIndex
+        completion.set_match_func(lambda *args: True, None)
+        title_renderer = Gtk.CellRendererText()
+        title_renderer.set_property("ellipsize", 3)
+        completion.pack_start(title_renderer, True)
+        completion.add_attribute(title_renderer, "text", 0)
+        url_renderer = Gtk.CellRendererText()
+        url_renderer.set_property("ellipsize", 3)
+        url_renderer.set_property("scale", 0.8)
+        completion.pack_start(url_renderer, True)
+        completion.add_attribute(url_renderer, "text", 1)
+        completion.connect("match-selected", self.suggestion_selected)
+        self.url_bar.set_completion(completion)
+
         # create popup menu for browser tabs
         self.tab_menu = TabContextMenu(self)
         self.uni_menu = UniverseContextMenu(self)
@@ -289,26 +600,110 @@ class BrowserWindow(object):
         self.tabs = {}
         self.focused = None
         self.tab_store = builder.get_object("TabTreeStore")
+        self.tab_index = TabTreeIndex(self.tab_store)
+        self.domains = DomainRegistry()
+        self.journal = SessionJournal()
+        session = self.journal.load()
+        self.host_rules = load_host_rules()
         self.tab_tree_view = builder.get_object("TabTreeView")
         self.tab_tree_view.set_activate_on_single_click(True)
 
         # stores a list of tab ID's, in order of call
         self.focus_history = []
 
-        # setup the treeview's renderer
+        # when each universe last had a focused tab, by universe ID
+        self.universe_focus_times = {}
+        self.hibernating = set()
+        if HIBERNATE_AFTER:
+            GLib.timeout_add_seconds(
+                HIBERNATE_CHECK_INTERVAL, self.hibernate_idle_universes)
+        GLib.timeout_add_seconds(USAGE_SAMPLE_INTERVAL, self.sample_usage)
+        GLib.idle_add(prune_universe_caches)
+        GLib.idle_add(prune_stale_rings)
+        ipc_metrics.on_dump_signal(GLib, self.dump_metrics)
+
+        # setup the treeview's renderers
+        thumbnail_renderer = Gtk.CellRendererPixbuf()
+        self.thumbnail_column = Gtk.TreeViewColumn(
+            "Thumbnail", thumbnail_renderer)
+        self.thumbnail_column.set_cell_data_func(
+            thumbnail_renderer, self.thumbnail_cell_data)
+        self.tab_tree_view.append_column(self.thumbnail_column)
         renderer = Gtk.CellRendererText()
         renderer.set_property("ellipsize", 3)
         self.title_column = Gtk.TreeViewColumn("Tab Title", renderer, text=0)
+        self.title_column.set_expand(True)
         self.tab_tree_view.append_column(self.title_column)
+        usage_renderer = Gtk.CellRendererText()
+        usage_renderer.set_property("scale", 0.8)
+        self.usage_column = Gtk.TreeViewColumn("Usage", usage_renderer, text=2)
+        self.tab_tree_view.append_column(self.usage_column)
         self.tab_tree_view.connect("row_activated", self.tree_activates_tab)
 
+        # only the tabs whose rows are scrolled into view get thumbnails
+        self.thumbnail_update = None
+        self.tab_scroll = builder.get_object("TabViewport").get_vadjustment()
+        self.tab_scroll.connect("value-changed", self.queue_thumbnail_update)
+        self.tab_scroll.connect("changed", self.queue_thumbnail_update)
+        self.tab_tree_view.connect(
+            "row-expanded", self.queue_thumbnail_update)
+        self.tab_tree_view.connect(
+            "row-collapsed", self.queue_thumbnail_update)
+
         # self.views tracks all of the sockets
         self.views = builder.get_object("ViewPorts")
 
         window.show_all()
         
-        # create a new tab
-        self.new_tab("http://duckduckgo.com")
+        # restore the last session, or else create a new tab
+        with tracer.span("first tab"):
+            if not self.restore_session(session):
+                self.new_tab("http://duckduckgo.com")
+
+    def restore_session(self, session):
+        """
+        Rebuild the universes and tabs of a SessionState.  Universes are
+        restored hibernated, so only the one holding the focused tab
+        starts a process.  Returns False if there was nothing to
+        restore.
+        """
+        restored = None
+        history = []
+        for identity, tab_records in session.universes.items():
+            if not tab_records:
+                self.journal.record("U", identity)
+                continue
+            universe = self.create_universe(identity, hibernated=True)
+            for tab_id, (url, title) in tab_records.items():
+                if uri_host(url):
+                    self.history_index.visit(url, title)
+                tab = BrowserTab(self, url, universe, tab_id, title)
+                self.tabs[tab_id] = tab
+                self.views.pack_start(tab.socket, True, True, 0)
+                history.append(tab_id)
+                restored = tab
+            self.set_universe_label(universe)
+        if not restored:
+            return False
+        # tab ids are unique, so the journal order can be used as is,
+        # instead of pushing every tab onto the history one at a time
+        self.focus_history = history
+        self.focus_tab(self.tabs.get(session.focused, restored))
+        self.viewport_grab_focus()
+        return True
+
+    def create_universe(self, identity=None, hibernated=False):
+        """
+        Create a Universe that starts out with the host rules from
+        HOST_RULES_PATH, if there are any, and whose row in the tab
+        tree shows when it stops responding.
+        """
+        universe = Universe(identity, hibernated=hibernated)
+        universe.on_health_change = self.set_universe_label
+        universe.on_hangup = self.universe_hung_up
+        if self.host_rules:
+            universe.set_request_filter(**self.host_rules)
+        return universe
 
     def push_focus_history(self, tab_id):
         """
@@ -398,6 +793,12 @@ class BrowserWindow(object):
         if self.focused:
             self.focused.mute()
             self.focused.socket.hide()
+            self.universe_focus_times[self.focused.universe.universe_id] = \
+                time.time()
+        if tab.universe.hibernated:
+            self.wake_universe(tab.universe)
+        if not tab.materialized:
+            tab.create_worker()
         self.focused = tab
         tab.focus()
         tab.socket.show()
@@ -410,6 +811,7 @@ class BrowserWindow(object):
                 selector.select_path(path)
         self.push_focus_history(tab.uuid)
         self.url_bar.set_text(tab.url)
+        self.journal.record("f", tab.uuid)
 
     def new_tab(self, uri="about:blank", universe=None):
         """
@@ -417,7 +819,8 @@ class BrowserWindow(object):
         the web browser!
         """
         if not universe:
-            universe = Universe()
+            universe = self.create_universe()
+            self.journal.record("u", universe.identity)
 
         tab = BrowserTab(self, uri, universe)
         self.tabs[tab.uuid] = tab
@@ -427,19 +830,187 @@ class BrowserWindow(object):
         self.push_focus_history(tab.uuid)
         self.url_bar.set_text(uri)
 
-    def find_tree_iter(self, thing_id, search=None):
+    def find_tree_iter(self, thing_id):
         """
         Returns either None or the GtkTreeIter object associated to the
         provided object ID present in the tab bar.
         """
-        for row in search or self.tab_store:
-            row_id = self.tab_store.get_value(row.iter, 1)
-            if str(thing_id) == row_id:
-                return row.iter
-            else:
-                found = self.find_tree_iter(thing_id, row.iterchildren())
-                if found:
-                    return found
+        return self.tab_index.find(thing_id)
+
+    def thumbnail_cell_data(self, column, renderer, model, tree_iter, data):
+        """
+        Shows the thumbnail of the tab in a row, if it has one.
+        """
+        tab = self.tabs.get(model.get_value(tree_iter, 1))
+        renderer.set_property("surface", tab and tab.thumbnail)
+
+    def queue_thumbnail_update(self, *args, **kargs):
+        """
+        Work out which tabs' rows can be seen once the tab tree has
+        settled down.
+        """
+        if self.thumbnail_update is None:
+            self.thumbnail_update = GLib.idle_add(self.update_thumbnails)
+
+    def update_thumbnails(self):
+        """
+        Idle callback that tells every tab whether its row is scrolled
+        into view, so that only those tabs' thumbnails are redrawn.
+        """
+        self.thumbnail_update = None
+        top = self.tab_scroll.get_value()
+        bottom = top + self.tab_scroll.get_page_size()
+        for tab in self.tabs.values():
+            visible = False
+            tree_iter = self.find_tree_iter(tab.uuid)
+            if tab.materialized and tree_iter:
+                area = self.tab_tree_view.get_background_area(
+                    self.tab_store.get_path(tree_iter), self.thumbnail_column)
+                visible = area.height > 0 and \
+                    area.y < bottom and area.y + area.height > top
+            tab.set_thumbnail_visible(visible)
+        return False
+
+    def set_universe_label(self, universe):
+        """
+        Update the text shown on a universe's row in the tab tree.
+        """
+        label = universe.__repr__()
+        if universe.hibernated:
+            label += " (hibernating)"
+        elif not universe.ipc.healthy:
+            label += " (not responding)"
+        tree_iter = self.find_tree_iter(universe.universe_id)
+        if tree_iter:
+            self.tab_store[tree_iter][0] = label
+
+    def hibernate_idle_universes(self):
+        """
+        Timer callback that hibernates every universe which hasn't had
+        a focused tab for HIBERNATE_AFTER seconds.
+        """
+        cutoff = time.time() - HIBERNATE_AFTER
+        for universe in Universe.__active_universes__.values():
+            universe_id = universe.universe_id
+            if universe.hibernated or universe_id in self.hibernating:
+                continue
+            if self.focused and self.focused.universe is universe:
+                continue
+            last_focus = self.universe_focus_times.setdefault(
+                universe_id, time.time())
+            if last_focus < cutoff:
+                self.hibernate_universe(universe)
+        return True
+
+    def sample_usage(self):
+        """
+        Timer callback that measures the memory and cpu used by every
+        universe, shows it in the tab tree along with how many requests
+        it has blocked, and enforces the memory budget.
+        """
+        total = 0
+        for universe in Universe.__active_universes__.values():
+            universe.sample_usage()
+            total += universe.rss
+            usage = ""
+            if not universe.hibernated:
+                usage = "%i MB %i%%" % (universe.rss >> 20, universe.cpu)
+            if universe.blocked_count:
+                usage = ("%s %i blocked" % (
+                    usage, universe.blocked_count)).lstrip()
+            tree_iter = self.find_tree_iter(universe.universe_id)
+            if tree_iter:
+                self.tab_store[tree_iter][2] = usage
+            self.set_universe_label(universe)
+        if MEMORY_BUDGET and total > MEMORY_BUDGET << 20:
+            self.shed_universes(total - (MEMORY_BUDGET << 20))
+        return True
+
+    def shed_universes(self, excess):
+        """
+        Hibernate background universes, least recently focused first,
+        until at least 'excess' bytes of resident memory are freed.
+        """
+        last_focus = {}
+        for order, tab_id in enumerate(self.focus_history):
+            tab = self.tabs.get(tab_id)
+            if tab:
+                last_focus[tab.universe.universe_id] = order
+        candidates = []
+        for universe in Universe.__active_universes__.values():
+            universe_id = universe.universe_id
+            if universe.hibernated or universe_id in self.hibernating:
+                continue
+            if self.focused and self.focused.universe is universe:
+                continue
+            candidates.append((last_focus.get(universe_id, -1), universe))
+        candidates.sort(key=lambda candidate: candidate[0])
+        for order, universe in candidates:
+            if excess <= 0:
+                break
+            excess -= universe.rss
+            self.hibernate_universe(universe)
+
+    def hibernate_universe(self, universe):
+        """
+        Record the state of every tab in a universe, and then tear down
+        the universe's process.  The tabs stay in the tab tree, and
+        focusing one of them wakes the universe back up.
+        """
+        tabs = [tab for tab in universe.actors.values() if tab.materialized]
+        remaining = [len(tabs)]
+        universe_id = universe.universe_id
+        self.hibernating.add(universe_id)
+
+        def snapshot_done(*args):
+            remaining[0] -= 1
+            if remaining[0] > 0:
+                return
+            self.hibernating.discard(universe_id)
+            focused = self.focused and self.focused.universe is universe
+            if not focused and universe_id in Universe.__active_universes__:
+                universe.hibernate()
+                self.set_universe_label(universe)
+                for tab in universe.actors.values():
+                    tab.materialized = False
+
+        for tab in tabs:
+            tab.call("snapshot_state", tab.snapshot_event).then(
+                snapshot_done, snapshot_done)
+        if not tabs:
+            snapshot_done()
+
+    def dump_metrics(self):
+        """
+        Print the IPC metrics of both ends of every universe's
+        connection to stderr.  Called on SIGUSR1, see ipc_metrics.
+        """
+        for universe in Universe.__active_universes__.values():
+            label = universe.__repr__()
+            ipc_metrics.dump(label + " frontend", universe.dump_metrics())
+            if universe.ipc.alive:
+                universe.call(
+                    "dump_metrics",
+                    lambda summary, label=label: ipc_metrics.dump(
+                        label + " universe", summary))
+
+    def universe_hung_up(self, universe):
+        """
+        Called when a universe's process went away by itself.  The
+        universe is left hibernated, so focusing one of its tabs starts
+        a fresh process and recreates the tab in it.
+        """
+        for tab in universe.actors.values():
+            tab.materialized = False
+        self.set_universe_label(universe)
+
+    def wake_universe(self, universe):
+        """
+        Start a new process for a hibernated universe.  Its tabs are
+        recreated in it as they are focused.
+        """
+        universe.wake()
+        self.set_universe_label(universe)
 
     def open_url_event(self, *args, **kargs):
         """
@@ -453,16 +1024,66 @@ class BrowserWindow(object):
             self.focused.navigate_to(new_url)
             self.viewport_grab_focus()
         else:
-            self.new_tab(new_url)
+            # open the url next to any tabs already on its domain, and
+            # only start a new universe if there are none
+            self.new_tab(new_url, self.domains.owner(new_domain))
 
     def url_bar_gains_focus(self, *args, **kargs):
         """
         Event handler that is called when the url bar gains input focus.
+        The best suggestions for the text already there are shown.
         """
-        # This might be useful for changing the cursor position or
-        # highlighting the url or something.
-        pass
-        
+        self.show_suggestions()
+        self.url_bar.get_completion().complete()
+
+    def url_bar_changed(self, *args, **kargs):
+        """
+        Event handler for when the text in the url bar changes.  If the
+        user is typing, the suggestions are looked up again.
+        """
+        if self.url_bar.has_focus():
+            self.show_suggestions()
+        else:
+            self.suggestions.clear()
+
+    def show_suggestions(self):
+        """
+        Fills the url bar's completion with the pages from the history
+        that best match its text, ranked by frecency.
+        """
+        self.suggestions.clear()
+        open_tabs = dict((tab.url, tab) for tab in self.tabs.values())
+        for entry in self.history_index.search(self.url_bar.get_text()):
+            tab = open_tabs.get(entry.url)
+            if tab:
+                self.suggestions.append([
+                    entry.title or entry.url, "Switch to tab: " + entry.url,
+                    entry.url, tab.uuid])
+            else:
+                self.suggestions.append([
+                    entry.title or entry.url, entry.url, entry.url, ""])
+
+    def suggestion_selected(self, completion, model, tree_iter):
+        """
+        Event handler for when a suggestion is picked.  An url that is
+        open in a tab focuses that tab, rather than loading it again.
+        """
+        url, tab_id = model[tree_iter][2:4]
+        tab = self.tabs.get(tab_id)
+        if tab:
+            self.focus_tab(tab)
+            self.viewport_grab_focus()
+        else:
+            # setting the text would otherwise look up suggestions again,
+            # replacing the model while the completion is still using it
+            self.url_bar.handler_block_by_func(self.url_bar_changed)
+            try:
+                self.url_bar.set_text(url)
+            finally:
+                self.url_bar.handler_unblock_by_func(self.url_bar_changed)
+            self.open_url_event()
+        return True
+
     def req_history_update(self):
         """
         When this method is called, the active browser tab's universe is
@@ -491,7 +1112,8 @@ class BrowserWindow(object):
 
     def close_universe(self, universe):
         """
-        Close all of the tabs in a given universe.
+        Close all of the tabs in a given universe, which also deletes
+        its http cache.
         """
         tabs = universe.actors.values()
         universe.destroy()
@@ -519,20 +1141,17 @@ class BrowserWindow(object):
             shutdown = True
 
         # tear down the old tab
-        if universe.ipc.alive:
-            tab.close_event()
-        else:
-            tab.clean_up()
+        tab.close_event()
         self.tabs.pop(tab_id)
+        self.domains.release(tab_id)
+        self.journal.record("T", tab_id)
 
-        tab_iter = self.find_tree_iter(tab_id)
-        if tab_iter:
-            self.tab_store.remove(tab_iter)
+        self.tab_index.remove(tab_id)
         if not universe.actors:
-            # and also the old universe
-            universe_iter = self.find_tree_iter(universe_id)
-            if universe_iter:
-                self.tab_store.remove(universe_iter)
+            # and also the old universe, along with its http cache
+            self.tab_index.remove(universe_id)
+            universe.wipe_cache()
+            self.journal.record("U", universe.identity)
 
         # and shut down if there are no other tabs
         if shutdown:
@@ -544,13 +1163,34 @@ class BrowserWindow(object):
         """
         Tear down all subprocesses and stop the Gtk event loop.  This
         causes the program to quit gracefully.
-        """
-        for tab in self.tabs.values():
-            tab.close_event()
+
+        Every universe is told to exit at once, and then they are all
+        waited on together, so quitting takes about as long with many
+        universes as with one.  The tabs are left in the session
+        journal, so that they are restored next time.
+        """
+        universe_pool.drain()
+        for universe in Universe.__active_universes__.values():
+            universe.destroy()
+        reaper.finish()
+        zygote.stop()
+        self.journal.close(JOURNAL_CLOSE_TIMEOUT)
+        tracer.save()
         Gtk.main_quit()
 
 
 if __name__ == "__main__":
-    Gtk.init()
-    browser = BrowserWindow()
+    # the session journal is written from a thread, which needs the
+    # GIL to be released while the main loop waits
+    GObject.threads_init()
+    tracer.name_process("frontend")
+    tracer.complete("frontend imports", IMPORT_START)
+    with tracer.span("Gtk.init"):
+        Gtk.init()
+    # compile the block lists, if they changed, before any universe
+    # process starts and needs them
+    with tracer.span("block lists"):
+        default_filter_list()
+    with tracer.span("BrowserWindow"):
+        browser = BrowserWindow()
     Gtk.main()
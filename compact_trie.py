@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import struct
+from collections import deque
+
+
+class CompactTrie(object):
+    """
+    A read only trie over domain labels, stored as flat arrays in a
+    single buffer.  The buffer may be a string or a read only mmap, so
+    that several processes mapping the same file share its pages.
+
+    The buffer starts with a header holding the node count and the
+    size of the label blob.  Then come the fixed size node records,
+    and then the label blob.  Each node record holds the offset and
+    length of the node's label in the blob, the node's flags, and the
+    index and count of its children.  Nodes are laid out breadth
+    first, so the children of a node are contiguous and sorted by
+    label, and can be binary searched.  Node zero is the root.
+
+    Use 'build' to produce the buffer from nested dictionaries.
+    """
+
+    HEADER = struct.Struct("<II")
+    NODE = struct.Struct("<IBBII")
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        node_count, labels_size = self.HEADER.unpack_from(buffer, offset)
+        self.nodes = offset + self.HEADER.size
+        self.labels = self.nodes + node_count * self.NODE.size
+        self.size = self.labels + labels_size - offset
+
+    def flags(self, node):
+        """
+        Returns the flags of the given node.
+        """
+        return self.NODE.unpack_from(
+            self.buffer, self.nodes + node * self.NODE.size)[2]
+
+    def child(self, node, label):
+        """
+        Returns the index of the child of 'node' with the given label,
+        or -1 if there is none.
+        """
+        unpack_from = self.NODE.unpack_from
+        buffer = self.buffer
+        nodes = self.nodes
+        labels = self.labels
+        node_size = self.NODE.size
+
+        first, count = unpack_from(buffer, nodes + node * node_size)[3:]
+        low = first
+        high = first + count
+        while low < high:
+            middle = (low + high) // 2
+            start, length = unpack_from(buffer, nodes + middle * node_size)[:2]
+            start += labels
+            probe = buffer[start:start + length]
+            if probe < label:
+                low = middle + 1
+            elif probe > label:
+                high = middle
+            else:
+                return middle
+        return -1
+
+    @classmethod
+    def build(cls, root):
+        """
+        Serializes a trie made of nested dictionaries.  Each dictionary
+        maps a label to the dictionary of the child node, and may store
+        the node's flags under the None key.
+        """
+        records = [None]
+        label_offsets = {}
+        blob = []
+        blob_size = [0]
+
+        def label_offset(label):
+            if label not in label_offsets:
+                label_offsets[label] = blob_size[0]
+                blob.append(label)
+                blob_size[0] += len(label)
+            return label_offsets[label]
+
+        queue = deque([(0, "", root)])
+        while queue:
+            index, label, node = queue.popleft()
+            children = sorted(
+                (child_label, child) for child_label, child in node.items()
+                if child_label is not None)
+            first = len(records)
+            for child_label, child in children:
+                queue.append((len(records), child_label, child))
+                records.append(None)
+            records[index] = cls.NODE.pack(
+                label_offset(label), len(label), node.get(None, 0),
+                first, len(children))
+
+        return "".join(
+            [cls.HEADER.pack(len(records), blob_size[0])] + records + blob)
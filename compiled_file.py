@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import mmap
+import struct
+import hashlib
+
+
+# Starts every compiled file: magic, format version, and the stamp of
+# the sources it was compiled from.
+HEADER = struct.Struct("<4sH20s")
+
+
+def source_stamp(path):
+    """
+    Identifies a version of a source file by its size and modification
+    time, so it can be checked without reading the file.
+    """
+    info = os.stat(path)
+    return hashlib.sha1(
+        "%s:%i:%r" % (path, info.st_size, info.st_mtime)).digest()
+
+
+def load_compiled(compiled_path, magic, version, stamp, build):
+    """
+    Returns a buffer holding a compiled index, and the offset its body
+    starts at.
+
+    If the file at compiled_path has the given magic, version and
+    stamp, it is memory mapped read only, so every process loading it
+    shares the same pages.  Otherwise 'build' is called for a new body,
+    which is saved there for next time.
+    """
+    try:
+        with open(compiled_path, "rb") as compiled:
+            buffer = mmap.mmap(compiled.fileno(), 0, access=mmap.ACCESS_READ)
+        if HEADER.unpack_from(buffer) == (magic, version, stamp):
+            return buffer, HEADER.size
+    except (IOError, OSError, ValueError, struct.error):
+        pass
+
+    data = HEADER.pack(magic, version, stamp) + build()
+    try:
+        if not os.path.isdir(os.path.dirname(compiled_path)):
+            os.makedirs(os.path.dirname(compiled_path))
+        # write to a temporary file and rename, so that a process
+        # reading the old file is never handed a partial one
+        temp_path = "%s.%i" % (compiled_path, os.getpid())
+        with open(temp_path, "wb") as compiled:
+            compiled.write(data)
+        os.rename(temp_path, compiled_path)
+    except (IOError, OSError):
+        pass
+    return data, HEADER.size
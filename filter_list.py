@@ -0,0 +1,420 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Compiles EasyList style block lists into a binary index, which every
+universe process memory maps.
+
+Usage: python filter_list.py [list ...]
+
+With no arguments, the lists named by RIDINGHOOD_FILTER_LISTS, or
+found in FILTER_DIR, are compiled into COMPILED_PATH.
+"""
+
+
+import os
+import re
+import sys
+import glob
+import struct
+import hashlib
+
+from compact_trie import CompactTrie
+from compiled_file import load_compiled, source_stamp
+from public_suffix import CACHE_DIR
+
+
+# Block lists in the Adblock Plus format, such as EasyList, separated
+# by colons.  When unset, every .txt file in FILTER_DIR is used.
+FILTER_DIR = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+    "ridinghood", "filters")
+FILTER_LISTS = os.environ.get("RIDINGHOOD_FILTER_LISTS")
+
+# Where the compiled form of the lists is kept between runs.
+COMPILED_PATH = os.path.join(CACHE_DIR, "filters.bin")
+
+# Node flag in the compiled host tries.
+RULE = 1
+
+# Longest url pattern kept, as pattern lengths are stored in 16 bits.
+MAX_PATTERN_LENGTH = 0xffff
+
+# Characters that make up the tokens urls are split into.
+TOKEN = re.compile(r"[a-z0-9%]+")
+
+# Keyword candidates in a pattern: tokens with a separator on both
+# sides, so that any url the pattern matches has them as whole tokens.
+# Like in Adblock Plus, the ends of the pattern only count as a
+# separator next to an anchor, that is after a leading "|" or "||",
+# and before a trailing "|" or "^".
+KEYWORD_CANDIDATE = re.compile(
+    r"(?<=[^a-z0-9%*])[a-z0-9%]{3,}(?=[^a-z0-9%*])")
+
+
+def pattern_regex(pattern):
+    """
+    Translates an Adblock Plus url pattern into a regular expression.
+    """
+    start = ""
+    if pattern.startswith("||"):
+        start = r"^[\w\-]+:/+(?:[^/]+\.)?"
+        pattern = pattern[2:]
+    elif pattern.startswith("|"):
+        start = "^"
+        pattern = pattern[1:]
+    end = ""
+    if pattern.endswith("|"):
+        end = "$"
+        pattern = pattern[:-1]
+    body = re.escape(pattern)
+    body = body.replace(r"\*", ".*").replace(r"\^", r"(?:[^\w\-.%]|$)")
+    return re.compile(start + body + end)
+
+
+def parse_filters(lines):
+    """
+    Sorts the rules of a block list into host names and url patterns,
+    each for blocking and for exceptions.  Returns a dictionary with
+    "block_hosts", "allow_hosts", "block_patterns" and
+    "allow_patterns", and the number of rules that were skipped.
+
+    Element hiding rules only matter to the page, and rules with
+    options ($third-party, $script, ...) depend on more than the url,
+    so both are skipped.  Regular expression rules are skipped too, as
+    are patterns longer than MAX_PATTERN_LENGTH.
+    """
+    found = {
+        "block_hosts" : set(),
+        "allow_hosts" : set(),
+        "block_patterns" : set(),
+        "allow_patterns" : set(),
+    }
+    skipped = 0
+    for line in lines:
+        rule = line.strip().lower()
+        if not rule or rule.startswith("!") or rule.startswith("["):
+            continue
+        if "##" in rule or "#@#" in rule or "#?#" in rule or "$" in rule:
+            skipped += 1
+            continue
+        kind = "block"
+        if rule.startswith("@@"):
+            kind = "allow"
+            rule = rule[2:]
+        if rule.startswith("/") and rule.endswith("/") and len(rule) > 1:
+            skipped += 1
+            continue
+        # wildcards at the ends of an unanchored pattern don't matter
+        rule = rule.rstrip("*")
+        if not rule.startswith("|"):
+            rule = rule.lstrip("*")
+        if not rule:
+            skipped += 1
+            continue
+        host = rule[2:-1]
+        if rule.startswith("||") and rule.endswith("^") and \
+           re.match(r"^[a-z0-9\-.]+$", host):
+            found[kind + "_hosts"].add(host.strip("."))
+        elif len(rule) > MAX_PATTERN_LENGTH:
+            skipped += 1
+        else:
+            found[kind + "_patterns"].add(rule)
+    return found, skipped
+
+
+def host_trie(names):
+    """
+    Turns host names into nested dictionaries for CompactTrie.build,
+    with the labels in reverse order.
+    """
+    root = {}
+    for name in names:
+        node = root
+        for label in reversed(name.split(".")):
+            node = node.setdefault(label, {})
+        node[None] = RULE
+    return root
+
+
+def host_match(trie, host):
+    """
+    Returns True if the host, or any domain it is a subdomain of, is
+    in a compiled host trie.
+    """
+    node = 0
+    for label in reversed(host.split(".")):
+        node = trie.child(node, label)
+        if node == -1:
+            return False
+        if trie.flags(node) & RULE:
+            return True
+    return False
+
+
+class PatternTable(object):
+    """
+    A read only table of url patterns, indexed by keyword, stored as
+    flat arrays in a single buffer like a CompactTrie.
+
+    Each pattern is filed under one keyword, a token that any url it
+    matches must contain.  Matching a url then only has to look at the
+    patterns filed under the url's own tokens, and at the few patterns
+    without a keyword, which are filed under the empty string.
+
+    The buffer holds a header with the keyword and pattern counts and
+    the size of the text blob, then the keyword records sorted by
+    keyword, then the pattern records grouped by keyword, and then the
+    text blob.  Each keyword record holds the offset and length of
+    the keyword in the blob, and the index and count of its patterns.
+    Each pattern record holds the offset and length of its text.
+
+    Keyword lookups are cached, since most urls share tokens such as
+    "https", "www" and "com".
+    """
+
+    # Upper bound on the number of cached keyword lookups.
+    CACHE_LIMIT = 4096
+
+    HEADER = struct.Struct("<III")
+    KEYWORD = struct.Struct("<IHII")
+    PATTERN = struct.Struct("<IH")
+
+    def __init__(self, buffer, offset=0):
+        self.buffer = buffer
+        keyword_count, pattern_count, text_size = self.HEADER.unpack_from(
+            buffer, offset)
+        self.keyword_count = keyword_count
+        self.keywords = offset + self.HEADER.size
+        self.patterns = self.keywords + keyword_count * self.KEYWORD.size
+        self.text = self.patterns + pattern_count * self.PATTERN.size
+        self.size = self.text + text_size - offset
+        self.__regexes = {}
+        self.__found = {}
+
+    def __find(self, keyword):
+        """
+        Returns the (first, count) of the patterns filed under the
+        keyword.
+        """
+        unpack_from = self.KEYWORD.unpack_from
+        buffer = self.buffer
+        keywords = self.keywords
+        text = self.text
+        record_size = self.KEYWORD.size
+
+        low = 0
+        high = self.keyword_count
+        while low < high:
+            middle = (low + high) // 2
+            start, length, first, count = unpack_from(
+                buffer, keywords + middle * record_size)
+            start += text
+            probe = buffer[start:start + length]
+            if probe < keyword:
+                low = middle + 1
+            elif probe > keyword:
+                high = middle
+            else:
+                return first, count
+        return 0, 0
+
+    def candidates(self, keyword):
+        """
+        Returns the patterns filed under the given keyword.
+        """
+        found = self.__found.get(keyword)
+        if found is not None:
+            return found
+        first, count = self.__find(keyword)
+        found = []
+        for index in xrange(first, first + count):
+            start, length = self.PATTERN.unpack_from(
+                self.buffer, self.patterns + index * self.PATTERN.size)
+            start += self.text
+            found.append(self.buffer[start:start + length])
+        if len(self.__found) >= self.CACHE_LIMIT:
+            self.__found.clear()
+        self.__found[keyword] = found
+        return found
+
+    def match(self, uri, tokens):
+        """
+        Returns True if any pattern matches the lower case url, whose
+        distinct tokens are given.
+        """
+        regexes = self.__regexes
+        for token in tokens:
+            for pattern in self.candidates(token):
+                regex = regexes.get(pattern)
+                if regex is None:
+                    regex = regexes[pattern] = pattern_regex(pattern)
+                if regex.search(uri):
+                    return True
+        return False
+
+    @classmethod
+    def build(cls, patterns):
+        """
+        Serializes a set of patterns.  Each one is filed under the
+        keyword candidate that the fewest patterns so far use.
+        """
+        usage = {}
+        filed = {}
+        for pattern in sorted(patterns):
+            keywords = KEYWORD_CANDIDATE.findall(pattern)
+            keyword = ""
+            if keywords:
+                keyword = min(keywords, key=lambda word: (
+                    usage.get(word, 0), -len(word)))
+            usage[keyword] = usage.get(keyword, 0) + 1
+            filed.setdefault(keyword, []).append(pattern)
+
+        keyword_records = []
+        pattern_records = []
+        blob = []
+        blob_size = 0
+        for keyword in sorted(filed):
+            keyword_records.append(cls.KEYWORD.pack(
+                blob_size, len(keyword), len(pattern_records),
+                len(filed[keyword])))
+            blob.append(keyword)
+            blob_size += len(keyword)
+            for pattern in filed[keyword]:
+                pattern_records.append(
+                    cls.PATTERN.pack(blob_size, len(pattern)))
+                blob.append(pattern)
+                blob_size += len(pattern)
+
+        return "".join(
+            [cls.HEADER.pack(
+                len(keyword_records), len(pattern_records), blob_size)] +
+            keyword_records + pattern_records + blob)
+
+
+def list_paths():
+    """
+    Returns the paths of the configured block lists.
+    """
+    if FILTER_LISTS is not None:
+        return [path for path in FILTER_LISTS.split(os.pathsep) if path]
+    return sorted(glob.glob(os.path.join(FILTER_DIR, "*.txt")))
+
+
+class FilterList(object):
+    """
+    Decides which urls the configured block lists refuse.
+
+    The lists are compiled into an index with a CompactTrie of host
+    names and a PatternTable of url patterns, once for blocking rules
+    and once for exception (@@) rules.  The index is saved to
+    COMPILED_PATH and memory mapped read only, so every universe
+    process shares the same pages, and none of them parses the lists.
+    It is only rebuilt when one of the lists changes, like the
+    compiled PublicSuffixList.
+    """
+
+    MAGIC = "RHFL"
+    VERSION = 3
+    # Starts the index: the number of rules that were skipped.
+    SKIPPED = struct.Struct("<I")
+
+    def __init__(self, paths, compiled_path=COMPILED_PATH):
+        self.paths = paths
+        buffer, offset = load_compiled(
+            compiled_path, self.MAGIC, self.VERSION, self.__stamp(paths),
+            lambda: self.compile(paths))
+        self.skipped, = self.SKIPPED.unpack_from(buffer, offset)
+        offset += self.SKIPPED.size
+        self.block_hosts = CompactTrie(buffer, offset)
+        offset += self.block_hosts.size
+        self.allow_hosts = CompactTrie(buffer, offset)
+        offset += self.allow_hosts.size
+        self.block_patterns = PatternTable(buffer, offset)
+        offset += self.block_patterns.size
+        self.allow_patterns = PatternTable(buffer, offset)
+
+    def __stamp(self, paths):
+        digest = hashlib.sha1()
+        for path in paths:
+            digest.update(source_stamp(path))
+        return digest.digest()
+
+    def compile(self, paths):
+        """
+        Parses the lists, and returns the index without its header.
+        """
+        lines = []
+        for path in paths:
+            with open(path) as source:
+                lines.extend(source)
+        found, skipped = parse_filters(lines)
+        return "".join([
+            self.SKIPPED.pack(skipped),
+            CompactTrie.build(host_trie(found["block_hosts"])),
+            CompactTrie.build(host_trie(found["allow_hosts"])),
+            PatternTable.build(found["block_patterns"]),
+            PatternTable.build(found["allow_patterns"]),
+        ])
+
+    def blocks(self, uri, host):
+        """
+        Returns True if a request to the given url, whose host name is
+        given, is refused by the lists.
+        """
+        uri = uri.lower()
+        # keywords are at least three characters long
+        tokens = set(token for token in TOKEN.findall(uri) if len(token) > 2)
+        tokens.add("")
+        if host_match(self.block_hosts, host) or \
+           self.block_patterns.match(uri, tokens):
+            return not (host_match(self.allow_hosts, host) or
+                        self.allow_patterns.match(uri, tokens))
+        return False
+
+
+__default_list = []
+
+
+def default_filter_list():
+    """
+    Returns a FilterList for the configured block lists, which is
+    loaded on first use and then shared by everything in the process.
+    Returns None when there are no lists.
+    """
+    if not __default_list:
+        paths = list_paths()
+        filter_list = None
+        if paths:
+            try:
+                filter_list = FilterList(paths)
+            except (IOError, OSError) as error:
+                sys.stderr.write("Could not load block lists: %s\n" % error)
+        __default_list.append(filter_list)
+    return __default_list[0]
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or list_paths()
+    if not paths:
+        sys.stderr.write("No block lists found in %s\n" % FILTER_DIR)
+        sys.exit(1)
+    filter_list = FilterList(paths)
+    print "Index of %i lists is in %s, %i rules skipped" % (
+        len(paths), COMPILED_PATH, filter_list.skipped)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import json
+import signal
+
+
+# Set RIDINGHOOD_METRICS=1 to collect IPC metrics.  The variable is
+# inherited by universe processes.  Send SIGUSR1 to a process to have
+# it print its metrics to stderr; the frontend also prints those of
+# every universe.  When unset, nothing is collected.
+METRICS_ENABLED = os.environ.get("RIDINGHOOD_METRICS", "") not in ("", "0")
+
+
+class Histogram(object):
+    """
+    A histogram of non-negative integers, such as durations in
+    microseconds, with power of two buckets.  Bucket n counts values
+    below 2**n, and at least 2**(n-1).  The unit is only used to name
+    the fields of the summary.
+    """
+
+    BUCKETS = 32
+
+    def __init__(self, unit="us"):
+        self.unit = unit
+        self.buckets = [0] * self.BUCKETS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, value):
+        self.buckets[min(value.bit_length(), self.BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, fraction):
+        """
+        Returns the upper bound of the bucket that holds the given
+        fraction of the values, capped at the largest value seen.
+        """
+        wanted = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= wanted:
+                return min(1 << bucket, self.max)
+        return 0
+
+    def summary(self):
+        unit = self.unit
+        return {
+            "count" : self.count,
+            "mean_" + unit : self.total / self.count if self.count else 0,
+            "p50_" + unit : self.percentile(0.5),
+            "p99_" + unit : self.percentile(0.99),
+            "max_" + unit : self.max,
+            "buckets" : dict(
+                ("<%i" % (1 << bucket), count)
+                for bucket, count in enumerate(self.buckets) if count),
+        }
+
+
+class ActionStats(object):
+    """
+    The metrics kept for one action.
+    """
+
+    __slots__ = ("sent", "sent_bytes", "received", "received_bytes",
+                 "coalesced", "dropped", "delay", "handler")
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.delay = None
+        self.handler = None
+
+    def summary(self):
+        found = {
+            "sent" : self.sent,
+            "sent_bytes" : self.sent_bytes,
+            "received" : self.received,
+            "received_bytes" : self.received_bytes,
+            "coalesced" : self.coalesced,
+            "dropped" : self.dropped,
+        }
+        if self.delay:
+            found["read_to_dispatch"] = self.delay.summary()
+        if self.handler:
+            found["handler"] = self.handler.summary()
+        return found
+
+
+class IpcMetrics(object):
+    """
+    IPC metrics for one connection, that is one IpcHandler and the
+    IpcListener on top of it.  The handler records packets and bytes
+    per action in each direction, and how many packets and bytes were
+    waiting in its buffer after each read.  On the writing side, it
+    records the depth of the write queue, how long the queue stayed
+    backed up, how long the "block" overflow policy blocked for, and
+    how many packets were dropped on overflow.  The listener records the
+    delay between reading a packet and dispatching it, the time spent
+    in each handler, and how many coalesced packets were superseded
+    before they were delivered.
+
+    Only created when METRICS_ENABLED is set, so that the hot paths
+    only pay for an "is not None" check otherwise.
+    """
+
+    def __init__(self):
+        self.actions = {}
+        self.reads = 0
+        self.read_bytes = 0
+        self.queue_depth = Histogram("packets")
+        self.max_buffered_bytes = 0
+        self.write_queue = Histogram("bytes")
+        self.write_stall = Histogram()
+        self.write_blocked = Histogram()
+
+    def action(self, action):
+        stats = self.actions.get(action)
+        if stats is None:
+            stats = self.actions[action] = ActionStats()
+        return stats
+
+    def sent(self, action, size):
+        stats = self.action(action)
+        stats.sent += 1
+        stats.sent_bytes += size
+
+    def received(self, action, size):
+        stats = self.action(action)
+        stats.received += 1
+        stats.received_bytes += size
+
+    def read(self, size):
+        """
+        Record a read of 'size' bytes from the pipe.
+        """
+        self.reads += 1
+        self.read_bytes += size
+
+    def decoded(self, packets, buffered):
+        """
+        Record that 'packets' complete packets were queued up for
+        dispatch, and 'buffered' bytes of partial packets were left in
+        the buffer.
+        """
+        self.queue_depth.add(packets)
+        if buffered > self.max_buffered_bytes:
+            self.max_buffered_bytes = buffered
+
+    def queued(self, size):
+        """
+        Record the size of the write queue after packets were queued.
+        """
+        self.write_queue.add(size)
+
+    def stalled(self, seconds):
+        """
+        Record how long the write queue was backed up for.
+        """
+        self.write_stall.add(int(seconds * 1e6))
+
+    def blocked(self, seconds):
+        """
+        Record how long the "block" overflow policy waited for.
+        """
+        self.write_blocked.add(int(seconds * 1e6))
+
+    def dropped(self, action):
+        self.action(action).dropped += 1
+
+    def coalesced(self, action):
+        self.action(action).coalesced += 1
+
+    def dispatched(self, action, delay, cost):
+        """
+        Record that a packet was dispatched 'delay' seconds after it
+        was read, and that its handler ran for 'cost' seconds.
+        """
+        stats = self.action(action)
+        if stats.delay is None:
+            stats.delay = Histogram()
+            stats.handler = Histogram()
+        stats.delay.add(int(delay * 1e6))
+        stats.handler.add(int(cost * 1e6))
+
+    def summary(self):
+        """
+        Returns the metrics as a dictionary that can be sent over the
+        wire or dumped as json.
+        """
+        return {
+            "reads" : self.reads,
+            "read_bytes" : self.read_bytes,
+            "queue_depth" : self.queue_depth.summary(),
+            "max_buffered_bytes" : self.max_buffered_bytes,
+            "write_queue" : self.write_queue.summary(),
+            "write_stall" : self.write_stall.summary(),
+            "write_blocked" : self.write_blocked.summary(),
+            "actions" : dict(
+                (str(action), stats.summary())
+                for action, stats in self.actions.iteritems()),
+        }
+
+
+def dump(label, summary):
+    """
+    Print a metrics summary to stderr as a line of json.
+    """
+    sys.stderr.write("IPC metrics %s: %s\n" % (
+        label, json.dumps(summary, sort_keys=True)))
+
+
+def on_dump_signal(GLib, callback):
+    """
+    Run the callback from the main loop whenever the process gets
+    SIGUSR1.  Does nothing unless metrics are enabled.
+    """
+    if not METRICS_ENABLED:
+        return
+
+    def handler(*args):
+        callback()
+        return True
+
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGUSR1, handler)
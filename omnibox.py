@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+import re
+import math
+import time
+import bisect
+import heapq
+
+
+# Number of suggestions shown under the url bar.
+SUGGESTION_COUNT = 8
+
+# Days after which a visit counts half as much towards an url's
+# frecency as a visit made now.
+FRECENCY_HALF_LIFE = 30
+
+# Prefixes up to this many characters long keep a ranked list of the
+# best TOP_COUNT entries that have a word starting with them.
+SHORT_PREFIX = 2
+TOP_COUNT = 64
+
+WORD = re.compile(r"[^\W_]+", re.UNICODE)
+
+# Words that nearly every url has, and that say nothing about it.
+URL_NOISE = frozenset([u"www"])
+
+
+def tokenize(text):
+    """
+    Splits text into lower case words.
+    """
+    if isinstance(text, str):
+        text = text.decode("utf-8", "replace")
+    return WORD.findall(text.lower())
+
+
+def url_tokens(url):
+    """
+    Returns the words of an url, leaving out the scheme, the query
+    string and the fragment.
+    """
+    rest = url.split("://", 1)[-1]
+    rest = rest.split("?", 1)[0].split("#", 1)[0]
+    return [word for word in tokenize(rest) if word not in URL_NOISE]
+
+
+class HistoryEntry(object):
+    """
+    A visited url, its title, and its frecency score.
+    """
+
+    __slots__ = ("url", "title", "score", "tokens")
+
+    def __init__(self, url):
+        self.url = url
+        self.title = ""
+        self.score = None
+        self.tokens = set(url_tokens(url))
+
+
+class HistoryIndex(object):
+    """
+    An in-memory index of visited urls and their page titles, which
+    suggests urls for what has been typed into the url bar so far.
+
+    Every word of the query must be the start of a word of the url or
+    of the title.  Matches are ranked by frecency, which adds up every
+    visit, weighing each by its age, halving every FRECENCY_HALF_LIFE
+    days.  The score is stored as the log of the sum of 2**(visit time
+    / half life), so older entries never need to be rescored; only the
+    entry that was visited changes.
+
+    The words are kept in a sorted list, so the words starting with a
+    prefix are found by bisection, and each word maps to the urls that
+    have it.  Since a one or two letter prefix can match most of the
+    history, each such prefix also keeps the TOP_COUNT best scoring
+    entries that have it, which is exact because scores only grow.
+    Most queries are answered by filtering one of those short lists.
+    The url sets of longer prefixes are cached until the index changes,
+    since each keystroke usually repeats all but the last query word.
+    """
+
+    # Upper bound on the number of cached url sets.
+    CACHE_LIMIT = 16
+
+    def __init__(self):
+        # url -> HistoryEntry
+        self.entries = {}
+        # sorted list of every distinct word
+        self.words = []
+        # word -> set of urls
+        self.postings = {}
+        # short prefix -> best entries with that prefix, best first
+        self.top = {}
+        # prefix -> set of urls, cleared whenever postings change
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __add_word(self, word, url):
+        self.cache.clear()
+        urls = self.postings.get(word)
+        if urls is None:
+            urls = self.postings[word] = set()
+            bisect.insort(self.words, word)
+        urls.add(url)
+
+    def __remove_word(self, word, url):
+        self.cache.clear()
+        urls = self.postings[word]
+        urls.discard(url)
+        if not urls:
+            del self.postings[word]
+            del self.words[bisect.bisect_left(self.words, word)]
+
+    def __rank(self, entry):
+        """
+        Move the entry up in the ranked list of each of its short
+        prefixes.
+        """
+        prefixes = set()
+        for word in entry.tokens:
+            for length in range(1, SHORT_PREFIX + 1):
+                prefixes.add(word[:length])
+        for prefix in prefixes:
+            ranked = self.top.setdefault(prefix, [])
+            if entry in ranked:
+                ranked.remove(entry)
+            position = 0
+            while position < len(ranked) and \
+                  ranked[position].score >= entry.score:
+                position += 1
+            if position < TOP_COUNT:
+                ranked.insert(position, entry)
+                del ranked[TOP_COUNT:]
+
+    def visit(self, url, title=None, when=None):
+        """
+        Record a visit to an url.
+        """
+        entry = self.entries.get(url)
+        if entry is None:
+            entry = self.entries[url] = HistoryEntry(url)
+            for word in entry.tokens:
+                self.__add_word(word, url)
+        weight = (when or time.time()) / (FRECENCY_HALF_LIFE * 86400.0)
+        if entry.score is None:
+            entry.score = weight
+        else:
+            high, low = max(entry.score, weight), min(entry.score, weight)
+            entry.score = high + math.log(1 + 2 ** (low - high), 2)
+        if title:
+            self.set_title(url, title)
+        self.__rank(entry)
+
+    def set_title(self, url, title):
+        """
+        Record the title of a visited url.
+        """
+        entry = self.entries.get(url)
+        if entry is None or entry.title == title:
+            return
+        old_tokens = entry.tokens
+        entry.title = title
+        entry.tokens = set(url_tokens(url)) | set(tokenize(title))
+        for word in old_tokens - entry.tokens:
+            self.__remove_word(word, url)
+        for word in entry.tokens - old_tokens:
+            self.__add_word(word, url)
+        if entry.tokens - old_tokens:
+            self.__rank(entry)
+
+    def search(self, query, count=SUGGESTION_COUNT):
+        """
+        Returns the best HistoryEntry objects for the query.
+        """
+        query = tokenize(query)
+        if not query:
+            return []
+
+        def matches(entry, query=query):
+            for prefix in query:
+                for word in entry.tokens:
+                    if word.startswith(prefix):
+                        break
+                else:
+                    return False
+            return True
+
+        # every match has a word starting with the short prefix of the
+        # longest query word, so the best matches are in its list,
+        # unless the list was cut short and too few of it match
+        longest = max(query, key=len)
+        ranked = self.top.get(longest[:SHORT_PREFIX], [])
+        found = [entry for entry in ranked if matches(entry)]
+        if len(found) >= count or len(ranked) < TOP_COUNT:
+            return found[:count]
+
+        # otherwise intersect the urls of the words starting with each
+        # of the longer query words, and check the short ones after
+        long_words = [
+            prefix for prefix in query if len(prefix) > SHORT_PREFIX]
+        urls = sorted(
+            (self.__urls(prefix) for prefix in long_words or [longest]),
+            key=len)
+        urls = urls[0].intersection(*urls[1:])
+        short_words = [
+            prefix for prefix in query if len(prefix) <= SHORT_PREFIX]
+        found = [self.entries[url] for url in urls]
+        if short_words:
+            found = [entry for entry in found if matches(entry, short_words)]
+        return heapq.nlargest(count, found, key=lambda entry: entry.score)
+
+    def __urls(self, prefix):
+        """
+        Returns the set of urls that have a word starting with the
+        prefix.
+        """
+        urls = self.cache.get(prefix)
+        if urls is not None:
+            return urls
+        start = bisect.bisect_left(self.words, prefix)
+        end = bisect.bisect_left(self.words, prefix + u"\uffff")
+        urls = set()
+        for word in self.words[start:end]:
+            urls.update(self.postings[word])
+        if len(self.cache) >= self.CACHE_LIMIT:
+            self.cache.clear()
+        self.cache[prefix] = urls
+        return urls
@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+from collections import OrderedDict
+
+from compact_trie import CompactTrie
+from compiled_file import load_compiled, source_stamp
+
+
+# The public suffix list that ships with Ridinghood.  Updates can be
+# pulled from https://publicsuffix.org/list/public_suffix_list.dat
+SOURCE_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "public_suffix_list.dat")
+
+# Where the compiled form of the list is kept between runs.
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "ridinghood")
+COMPILED_PATH = os.path.join(CACHE_DIR, "public_suffix.bin")
+
+# Node flags in the compiled trie.
+RULE = 1
+EXCEPTION = 2
+
+
+class LruCache(object):
+    """
+    A small least-recently-used cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+
+    def get(self, key, default=None):
+        try:
+            value = self.entries.pop(key)
+        except KeyError:
+            return default
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        if len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+
+def parse_rules(lines):
+    """
+    Turns the lines of a public suffix list into a trie of nested
+    dictionaries, as expected by CompactTrie.build.  Labels are stored
+    in reverse order, and in their ascii (punycode) form.
+    """
+    root = {}
+    for line in lines:
+        rule = line.strip().split(None, 1)[0] if line.strip() else ""
+        if not rule or rule.startswith("//"):
+            continue
+        flags = RULE
+        if rule.startswith("!"):
+            flags = EXCEPTION
+            rule = rule[1:]
+        try:
+            rule = rule.decode("utf-8").encode("idna")
+        except UnicodeError:
+            pass
+        node = root
+        for label in reversed(rule.lower().split(".")):
+            node = node.setdefault(label, {})
+        node[None] = node.get(None, 0) | flags
+    return root
+
+
+class PublicSuffixList(object):
+    """
+    Finds the registrable domain (eTLD+1) of host names, following the
+    rules of the public suffix list.  For example, the registrable
+    domain of "www.bbc.co.uk" is "bbc.co.uk", not "co.uk".
+
+    The list is compiled into a CompactTrie, which is saved to
+    COMPILED_PATH and memory mapped on later runs, so loading it does
+    not require parsing the list again.  Since the map is read only,
+    every process using it shares the same pages.  The compiled file
+    is rebuilt whenever the source list changes.
+
+    Lookups are cached in an LRU cache keyed by host name.
+    """
+
+    MAGIC = "RHPS"
+    VERSION = 1
+
+    def __init__(self, source_path=SOURCE_PATH, compiled_path=COMPILED_PATH,
+                 cache_size=4096):
+        self.cache = LruCache(cache_size)
+        self.trie = self.__load(source_path, compiled_path)
+
+    def __load(self, source_path, compiled_path):
+        def build():
+            with open(source_path) as source:
+                return CompactTrie.build(parse_rules(source))
+        buffer, offset = load_compiled(
+            compiled_path, self.MAGIC, self.VERSION,
+            source_stamp(source_path), build)
+        return CompactTrie(buffer, offset)
+
+    def public_suffix_length(self, labels):
+        """
+        Returns how many of the trailing labels form the public suffix.
+        When no rule matches, the last label is the suffix.
+        """
+        trie = self.trie
+        suffix_length = 1
+        node = 0
+        depth = 0
+        for label in reversed(labels):
+            depth += 1
+            child = trie.child(node, label)
+            if child != -1 and trie.flags(child) & EXCEPTION:
+                suffix_length = depth - 1
+                break
+            if trie.child(node, "*") != -1:
+                suffix_length = max(suffix_length, depth)
+            if child == -1:
+                break
+            if trie.flags(child) & RULE:
+                suffix_length = max(suffix_length, depth)
+            node = child
+        return suffix_length
+
+    def registrable_domain(self, host):
+        """
+        Returns the registrable domain of a host name, or None if the
+        host is itself a public suffix, such as "co.uk".
+        """
+        found = self.cache.get(host, False)
+        if found is not False:
+            return found
+        labels = host.lower().strip(".").split(".")
+        suffix_length = self.public_suffix_length(labels)
+        found = None
+        if len(labels) > suffix_length:
+            found = ".".join(labels[-suffix_length - 1:])
+        self.cache.put(host, found)
+        return found
+
+    def registrable_domains(self, hosts):
+        """
+        Batch version of 'registrable_domain', which only looks up
+        each distinct host once.
+        """
+        found = {}
+        for host in hosts:
+            if host not in found:
+                found[host] = self.registrable_domain(host)
+        return [found[host] for host in hosts]
+
+
+__default_list = []
+
+
+def default_list():
+    """
+    Returns a PublicSuffixList for the bundled list, which is loaded
+    on first use and then shared by everything in the process.
+    """
+    if not __default_list:
+        __default_list.append(PublicSuffixList())
+    return __default_list[0]
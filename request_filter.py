@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+
+
+# Url schemes that go out to the network, and so are subject to
+# filtering.  Everything else (about:, data:, and so on) is allowed.
+NETWORK_SCHEMES = frozenset(["http", "https", "ws", "wss", "ftp"])
+
+# The per-host rules every universe starts with.  Each line is either
+# "allow <host>", "block <host>", or "default allow|block", and lines
+# starting with "#" are comments.
+HOST_RULES_PATH = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"),
+    "ridinghood", "hosts.txt")
+
+
+def uri_host(uri):
+    """
+    Returns the lower case host name of a url, or None if the url
+    does not go out to the network.  This is a lot cheaper than
+    urlsplit, which matters when a page makes hundreds of requests.
+    """
+    scheme_end = uri.find("://")
+    if scheme_end == -1 or uri[:scheme_end].lower() not in NETWORK_SCHEMES:
+        return None
+    start = scheme_end + 3
+    end = len(uri)
+    for delimiter in "/?#":
+        found = uri.find(delimiter, start)
+        if found != -1 and found < end:
+            end = found
+    host = uri[start:end]
+    host = host[host.rfind("@") + 1:]
+    if host.startswith("["):
+        # ipv6 address
+        return host[:host.find("]") + 1].lower()
+    return host.split(":", 1)[0].rstrip(".").lower()
+
+
+class HostTrie(object):
+    """
+    A suffix trie over domain names.  The labels of each name are
+    stored in reverse, so "cdn.example.com" is stored as com ->
+    example -> cdn.  A name in the trie matches itself and all of its
+    subdomains, but only on label boundaries, so "example.com" does
+    not match "badexample.com".
+    """
+
+    def __init__(self, names=()):
+        self.root = {}
+        for name in names:
+            self.add(name)
+
+    def add(self, name):
+        node = self.root
+        for label in reversed(name.strip(".").lower().split(".")):
+            node = node.setdefault(label, {})
+        node[None] = True
+
+    def match(self, host):
+        """
+        Returns True if the host, or any domain it is a subdomain of,
+        is in the trie.
+        """
+        node = self.root
+        for label in reversed(host.split(".")):
+            node = node.get(label)
+            if node is None:
+                return False
+            if None in node:
+                return True
+        return False
+
+
+class RequestFilter(object):
+    """
+    Decides which hosts a universe may make requests to.  Hosts on the
+    block list are always refused.  Otherwise, hosts on the allow list
+    are permitted, and everything else gets the default policy, which
+    is either "allow" or "block".
+
+    Decisions are cached per host, since pages tend to make many
+    requests to the same few hosts.
+
+    If a FilterList is given, urls it blocks are refused too, unless
+    their host is on the allow list.
+    """
+
+    # Upper bound on the number of cached decisions.
+    CACHE_LIMIT = 4096
+
+    def __init__(self, allow=(), block=(), default="allow",
+                 filter_list=None):
+        self.filter_list = filter_list
+        self.update(allow, block, default)
+
+    def update(self, allow=(), block=(), default="allow"):
+        """
+        Replace the filter rules, which drops any cached decisions.
+        """
+        self.allow = HostTrie(allow)
+        self.block = HostTrie(block)
+        self.default = default == "allow"
+        self.cache = {}
+
+    def allows_host(self, host):
+        try:
+            return self.cache[host]
+        except KeyError:
+            pass
+        if self.block.match(host):
+            allowed = False
+        elif self.allow.match(host):
+            allowed = True
+        else:
+            allowed = self.default
+        if len(self.cache) >= self.CACHE_LIMIT:
+            self.cache.clear()
+        self.cache[host] = allowed
+        return allowed
+
+    def allows(self, uri):
+        """
+        Returns True if a request to the given url is permitted.
+        """
+        host = uri_host(uri)
+        if host is None:
+            return True
+        if not self.allows_host(host):
+            return False
+        if self.filter_list is None or self.allow.match(host):
+            return True
+        return not self.filter_list.blocks(uri, host)
+
+
+def load_host_rules(path=HOST_RULES_PATH):
+    """
+    Reads a host rules file into the keyword arguments for
+    Universe.set_request_filter.  Returns None if there is no such
+    file.  Lines that don't make sense are skipped with a warning.
+    """
+    try:
+        with open(path) as source:
+            lines = source.readlines()
+    except (IOError, OSError):
+        return None
+    rules = {"allow" : [], "block" : [], "default" : "allow"}
+    for number, line in enumerate(lines, 1):
+        words = line.split("#", 1)[0].split()
+        if not words:
+            continue
+        if len(words) == 2 and words[0] in ("allow", "block"):
+            rules[words[0]].append(words[1].lower())
+        elif len(words) == 2 and words[0] == "default" and \
+                words[1] in ("allow", "block"):
+            rules["default"] = words[1]
+        else:
+            sys.stderr.write(
+                "Skipping bad host rule at %s:%i\n" % (path, number))
+    return rules
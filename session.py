@@ -0,0 +1,266 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import json
+import Queue
+import threading
+from collections import OrderedDict
+
+
+# Where the session journal is kept.  Set RIDINGHOOD_SESSION to an
+# empty string to turn session restore off.
+SESSION_PATH = os.environ.get("RIDINGHOOD_SESSION", os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"),
+    "ridinghood", "session.journal"))
+
+# The journal is compacted once it holds this many records more than a
+# fresh snapshot of the session would.
+COMPACT_SLACK = 1000
+
+
+class SessionState(object):
+    """
+    The set of open universes and tabs, as described by the records of
+    a SessionJournal.  Universes are keyed by their identity, and tabs
+    by their ID.  Both keep the order they were opened in.
+    """
+
+    def __init__(self):
+        # universe identity -> OrderedDict of tab ID -> [url, title]
+        self.universes = OrderedDict()
+        # tab ID -> universe identity
+        self.tab_universes = {}
+        self.focused = None
+
+    def __len__(self):
+        """
+        The number of records a snapshot of this state takes up.
+        """
+        return len(self.universes) + len(self.tab_universes) + 1
+
+    def apply(self, record):
+        """
+        Update the state with a journal record.  Returns False if the
+        record changed nothing, such as a title that was already set,
+        so that the journal doesn't need to store it.
+        """
+        kind = record[0]
+        if kind == "t":
+            tab_id, identity, url, title = record[1:]
+            self.apply(("u", identity))
+            tabs = self.universes[identity]
+            if tabs.get(tab_id) == [url, title]:
+                return False
+            tabs[tab_id] = [url, title]
+            self.tab_universes[tab_id] = identity
+        elif kind in ("n", "h"):
+            identity = self.tab_universes.get(record[1])
+            if identity is None:
+                return False
+            tab = self.universes[identity][record[1]]
+            field = 0 if kind == "n" else 1
+            if tab[field] == record[2]:
+                return False
+            tab[field] = record[2]
+        elif kind == "f":
+            if self.focused == record[1]:
+                return False
+            self.focused = record[1]
+        elif kind == "T":
+            identity = self.tab_universes.pop(record[1], None)
+            if identity is None:
+                return False
+            del self.universes[identity][record[1]]
+        elif kind == "u":
+            if record[1] in self.universes:
+                return False
+            self.universes[record[1]] = OrderedDict()
+        elif kind == "U":
+            tabs = self.universes.pop(record[1], None)
+            if tabs is None:
+                return False
+            for tab_id in tabs:
+                self.tab_universes.pop(tab_id, None)
+        else:
+            return False
+        return True
+
+    def snapshot(self):
+        """
+        Returns the shortest list of records that rebuilds this state.
+        """
+        records = []
+        for identity, tabs in self.universes.iteritems():
+            records.append(("u", identity))
+            for tab_id, (url, title) in tabs.iteritems():
+                records.append(("t", tab_id, identity, url, title))
+        if self.focused in self.tab_universes:
+            records.append(("f", self.focused))
+        return records
+
+
+class SessionJournal(object):
+    """
+    Records the open universes and tabs as they change, so that the
+    session can be rebuilt the next time the browser starts.
+
+    The journal is an append-only file with one compact json list per
+    line.  The first item says what happened:
+
+        ["u", identity]                      universe opened
+        ["U", identity]                      universe closed
+        ["t", tab_id, identity, url, title]  tab opened
+        ["T", tab_id]                        tab closed
+        ["n", tab_id, url]                   tab navigated
+        ["h", tab_id, title]                 tab title changed
+        ["f", tab_id]                        tab focused
+
+    The records are also applied to an in memory SessionState.  When
+    the file holds COMPACT_SLACK more records than the state needs, it
+    is replaced by a snapshot of the state.
+
+    Writing happens on a background thread, so the main loop never
+    waits on the disk.  Since every record is a line of its own, a
+    crash can at worst cut the last record short, which 'load' skips.
+    """
+
+    def __init__(self, path=SESSION_PATH):
+        self.path = path
+        self.state = SessionState()
+        self.record_count = 0
+        self.__queue = Queue.Queue()
+        self.__thread = None
+
+    def load(self):
+        """
+        Replay the journal on disk, and return the resulting
+        SessionState.  This must be called before anything is recorded.
+        """
+        self.state = SessionState()
+        self.record_count = 0
+        if not self.path:
+            return self.state
+        damaged = False
+        try:
+            with open(self.path) as journal:
+                for line in journal:
+                    try:
+                        self.state.apply(json.loads(line))
+                    except (ValueError, TypeError, IndexError, KeyError):
+                        sys.stderr.write(
+                            "Skipping bad session record: %r\n" % line)
+                        damaged = True
+                        continue
+                    self.record_count += 1
+                    damaged = not line.endswith("\n")
+        except IOError:
+            pass
+        if damaged:
+            # rewrite the journal, so that new records don't get
+            # appended to a partial line
+            self.compact()
+        return self.state
+
+    def record(self, *record):
+        """
+        Apply a record to the session state, and queue it to be
+        written to disk.  See the class description for the records.
+        """
+        if not self.path or not self.state.apply(record):
+            return
+        self.record_count += 1
+        if self.record_count > len(self.state) + COMPACT_SLACK:
+            self.compact()
+        else:
+            self.__write(("append", [record]))
+
+    def compact(self):
+        """
+        Replace the journal on disk with a snapshot of the session.
+        """
+        records = self.state.snapshot()
+        self.record_count = len(records)
+        self.__write(("compact", records))
+
+    def close(self, timeout=None):
+        """
+        Write out anything still queued, and stop the writer thread.
+        """
+        if self.__thread:
+            self.__queue.put(None)
+            self.__thread.join(timeout)
+            self.__thread = None
+
+    def __write(self, job):
+        if not self.__thread:
+            self.__thread = threading.Thread(
+                target=self.__writer, name="session journal")
+            self.__thread.daemon = True
+            self.__thread.start()
+        self.__queue.put(job)
+
+    def __encode(self, records):
+        return "".join(
+            json.dumps(record, separators=(",", ":")) + "\n"
+            for record in records)
+
+    def __open(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        return open(self.path, "a")
+
+    def __writer(self):
+        journal = None
+        running = True
+        while running:
+            # batch up whatever has been queued since the last write
+            jobs = [self.__queue.get()]
+            while True:
+                try:
+                    jobs.append(self.__queue.get_nowait())
+                except Queue.Empty:
+                    break
+            try:
+                if journal is None:
+                    journal = self.__open()
+                for job in jobs:
+                    if job is None:
+                        running = False
+                        break
+                    kind, records = job
+                    if kind == "append":
+                        journal.write(self.__encode(records))
+                        continue
+                    temp_path = self.path + ".new"
+                    with open(temp_path, "w") as snapshot:
+                        snapshot.write(self.__encode(records))
+                        snapshot.flush()
+                        os.fsync(snapshot.fileno())
+                    journal.close()
+                    journal = None
+                    os.rename(temp_path, self.path)
+                    journal = self.__open()
+                journal.flush()
+            except (IOError, OSError) as error:
+                sys.stderr.write("Session journal write failed: %s\n" % error)
+        if journal:
+            journal.close()
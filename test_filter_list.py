@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for FilterList.
+
+Usage: python test_filter_list.py
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from filter_list import FilterList, KEYWORD_CANDIDATE, MAX_PATTERN_LENGTH
+from request_filter import uri_host
+
+
+class FilterListTestCase(unittest.TestCase):
+    """
+    Compiles lists of rules in a temporary directory.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def filters(self, *rules):
+        list_path = os.path.join(self.work_dir, "list.txt")
+        with open(list_path, "w") as source:
+            source.write("\n".join(rules) + "\n")
+        return FilterList(
+            [list_path], os.path.join(self.work_dir, "filters.bin"))
+
+    def assertBlocks(self, filters, uri):
+        self.assertTrue(filters.blocks(uri, uri_host(uri)), uri)
+
+
+class KeywordTest(FilterListTestCase):
+    """
+    A pattern must still block every url its regular expression
+    matches, whichever keyword it was filed under.
+    """
+
+    def test_unanchored_end(self):
+        filters = self.filters("/adsbox")
+        self.assertBlocks(filters, "https://example.com/adsboxes.js")
+        self.assertBlocks(filters, "https://example.com/adsbox/x.js")
+
+    def test_unanchored_start(self):
+        filters = self.filters("banner_ad.")
+        self.assertBlocks(filters, "https://example.com/mybanner_ad.gif")
+        self.assertBlocks(filters, "https://example.com/banner_ad.gif")
+
+    def test_unanchored_both(self):
+        filters = self.filters(".com/track")
+        self.assertBlocks(filters, "https://example.com/tracker.js")
+        self.assertFalse(filters.blocks(
+            "https://example.org/tracker.js", "example.org"))
+
+    def test_anchored_ends(self):
+        self.assertEqual(
+            KEYWORD_CANDIDATE.findall("||ads.example.com/banner^"),
+            ["ads", "example", "com", "banner"])
+        self.assertEqual(
+            KEYWORD_CANDIDATE.findall("|http://ads.js|"), ["http", "ads"])
+        self.assertEqual(KEYWORD_CANDIDATE.findall("adsbox/banner"), [])
+
+
+class CompileTest(FilterListTestCase):
+
+    def test_long_pattern_is_skipped(self):
+        filters = self.filters("/" + "x" * (MAX_PATTERN_LENGTH + 1), "/adsbox")
+        self.assertEqual(filters.skipped, 1)
+        self.assertBlocks(filters, "https://example.com/adsbox/x.js")
+
+    def test_compiled_file_is_reused(self):
+        self.filters("/adsbox", "$third-party")
+        filters = FilterList(
+            [os.path.join(self.work_dir, "list.txt")],
+            os.path.join(self.work_dir, "filters.bin"))
+        self.assertEqual(filters.skipped, 1)
+        self.assertBlocks(filters, "https://example.com/adsbox/x.js")
+
+
+if __name__ == "__main__":
+    unittest.main()
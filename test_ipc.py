@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for IpcHandler and IpcListener over pipes, and for the process
+plumbing in universe.py.  These fall back on the select based loop in
+test_support.py when PyGObject is not installed.
+
+Usage: python test_ipc.py
+"""
+
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+from test_support import GLib, PipeTestCase
+import universe
+from universe import IpcHandler, IpcListener, ProcessReaper, UniversePool
+from universe import Universe, Zygote
+
+
+class ShortWriteTest(PipeTestCase):
+    """
+    Makes the pipe take fewer bytes than asked for, and checks that
+    what comes out of the other end still decodes to every packet.
+    """
+
+    def setUp(self):
+        PipeTestCase.setUp(self)
+        self.real_write_some = self.handler._IpcHandler__write_some
+
+    def limit_writes(self, *limits):
+        """
+        The next writes take at most the given number of bytes each.
+        """
+        limits = list(limits)
+        def write_some(data):
+            if not limits:
+                return self.real_write_some(data)
+            return self.real_write_some(buffer(data, 0, limits.pop(0)))
+        self.handler._IpcHandler__write_some = write_some
+
+    def drain(self):
+        while self.handler.write_event(None, GLib.IO_OUT):
+            pass
+        return [
+            (packet["action"], packet["kargs"])
+            for packet in self.received()]
+
+    def test_cut_inside_first_frame(self):
+        packets = [
+            ("update_uri", {"uri" : "x" * 5000}),
+            ("reload", {"target" : "a"}),
+            ("teardown", {"target" : "a"}),
+        ]
+        self.limit_writes(4096)
+        self.handler.send_batch(packets)
+        encode = self.handler.wire.encode
+        total = sum(len(encode(action, kargs)) for action, kargs in packets)
+        self.assertEqual(self.handler.queued_bytes, total - 4096)
+        self.assertEqual(self.drain(), packets)
+        self.assertEqual(self.handler.queued_bytes, 0)
+
+    def test_cut_inside_later_frame(self):
+        packets = [
+            ("reload", {"target" : "a"}),
+            ("update_uri", {"uri" : "y" * 300}),
+            ("teardown", {"target" : "a"}),
+            ("reload", {"target" : "b"}),
+        ]
+        self.limit_writes(100, 10, 0)
+        self.handler.send_batch(packets)
+        self.assertEqual(self.drain(), packets)
+
+    def test_cut_between_frames(self):
+        packets = [("reload", {"target" : str(number)}) for number in range(5)]
+        frame_size = len(self.handler.wire.encode(*packets[0]))
+        self.limit_writes(2 * frame_size)
+        self.handler.send_batch(packets)
+        self.assertEqual(self.handler.queued_bytes, 3 * frame_size)
+        self.assertEqual(self.drain(), packets)
+
+
+class FaultyListener(IpcListener):
+
+    def __init__(self, ipc):
+        IpcListener.__init__(self, ipc)
+        self.reloaded = []
+
+    def reload(self, target):
+        if target == "bad":
+            raise ValueError("bad target")
+        self.reloaded.append(target)
+
+
+class DispatchErrorTest(PipeTestCase):
+    """
+    A handler that raises must not cost the packets after it, or the
+    connection.
+    """
+
+    def setUp(self):
+        PipeTestCase.setUp(self)
+        self.listener = FaultyListener(self.handler)
+        self.handler.attach(self.listener)
+
+    def test_rest_of_batch_is_delivered(self):
+        self.feed(
+            ("reload", {"target" : "a"}),
+            ("reload", {"target" : "bad"}),
+            ("reload", {"target" : "b"}))
+        self.assertEqual(self.listener.reloaded, ["a", "b"])
+
+    def test_failed_call_is_answered(self):
+        self.feed(
+            ("reload", {"target" : "bad", "call_id" : 7}),
+            ("reload", {"target" : "a"}))
+        self.assertEqual(self.listener.reloaded, ["a"])
+        replies = self.received()
+        self.assertEqual(len(replies), 1)
+        self.assertEqual(replies[0]["action"], "call_reply")
+        self.assertEqual(replies[0]["kargs"]["reply_to"], 7)
+        self.assertIn("bad target", replies[0]["kargs"]["error"])
+
+
+class HealthListener(IpcListener):
+
+    def __init__(self, ipc):
+        IpcListener.__init__(self, ipc)
+        self.health = []
+
+    def health_event(self, healthy):
+        self.health.append(healthy)
+
+
+class HealthTest(PipeTestCase):
+    """
+    The "unhealthy" overflow policy reports when it starts and stops
+    refusing packets.
+    """
+
+    handler_options = {"overflow_policy" : "unhealthy", "queue_limit" : 4096}
+
+    def setUp(self):
+        PipeTestCase.setUp(self)
+        self.listener = HealthListener(self.handler)
+        self.handler.attach(self.listener)
+
+    def test_overflow_and_recovery(self):
+        while self.handler.healthy:
+            self.handler.send("reload", target="x" * 1024)
+        self.assertEqual(self.listener.health, [False])
+        while self.handler.queued_bytes:
+            self.received()
+            self.handler.write_event(None, GLib.IO_OUT)
+        self.assertEqual(self.listener.health, [False, True])
+        self.assertTrue(self.handler.healthy)
+
+
+class ReaperTest(unittest.TestCase):
+
+    def test_on_exit_runs_once_reaped(self):
+        reaper = ProcessReaper()
+        exited = []
+        proc = subprocess.Popen(["true"])
+        reaper.add(proc, on_exit=exited.append)
+        self.assertEqual(exited, [])
+        reaper.finish()
+        self.assertEqual(exited, [proc])
+        self.assertEqual(len(reaper), 0)
+
+
+class ZygoteTest(unittest.TestCase):
+    """
+    Children of the zygote are reaped by the zygote, which reports
+    their exit status and sends them signals.
+    """
+
+    def setUp(self):
+        support = os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), "test_support.py")
+        self.zygote = Zygote([sys.executable, support, "--zygote"])
+
+    def tearDown(self):
+        self.zygote.stop()
+
+    def wait(self, proc, timeout=10):
+        deadline = time.time() + timeout
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.01)
+        return proc.returncode
+
+    def test_exit_is_reported(self):
+        proc, ipc = self.zygote.spawn()
+        self.assertIsNone(proc.poll())
+        ipc.hangup()
+        self.assertEqual(self.wait(proc), 0)
+
+    def test_signal_is_sent_by_zygote(self):
+        proc, ipc = self.zygote.spawn()
+        other, other_ipc = self.zygote.spawn()
+        proc.terminate()
+        self.assertEqual(self.wait(proc), -15)
+        # once reaped, the pid is never signalled again
+        proc.kill()
+        self.assertIsNone(other.poll())
+        ipc.hangup()
+        other_ipc.hangup()
+        self.assertEqual(self.wait(other), 0)
+
+    def test_children_of_a_stopped_zygote(self):
+        proc, ipc = self.zygote.spawn()
+        self.zygote.stop()
+        self.assertEqual(proc.poll(), 0)
+        proc.kill()
+        ipc.hangup()
+
+
+class PruneTest(unittest.TestCase):
+    """
+    Old http caches are deleted, unless their universe is open.
+    """
+
+    def setUp(self):
+        self.real_cache_dir = universe.CACHE_DIR
+        universe.CACHE_DIR = tempfile.mkdtemp()
+        self.active = Universe.__active_universes__
+        Universe.__active_universes__ = {}
+
+    def tearDown(self):
+        shutil.rmtree(universe.CACHE_DIR)
+        universe.CACHE_DIR = self.real_cache_dir
+        Universe.__active_universes__ = self.active
+
+    def old_cache(self, identity):
+        path = os.path.join(universe.CACHE_DIR, identity)
+        os.mkdir(path)
+        os.utime(path, (0, 0))
+        return path
+
+    def test_open_universe_is_kept(self):
+        open_cache = self.old_cache("open")
+        closed_cache = self.old_cache("closed")
+        restored = Universe(identity="open", hibernated=True)
+        try:
+            universe.prune_universe_caches()
+        finally:
+            restored.destroy()
+        self.assertTrue(os.path.isdir(open_cache))
+        self.assertFalse(os.path.exists(closed_cache))
+
+
+class FakeProcess(object):
+
+    def __init__(self, returncode=None):
+        self.pid = 0
+        self.returncode = returncode
+
+    def poll(self):
+        return self.returncode
+
+
+class FakeIpc(object):
+
+    def __init__(self, alive=True):
+        self.alive = alive
+
+    def hangup(self):
+        self.alive = False
+
+
+class PoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.spawned = []
+        self.failures = 0
+
+    def spawn(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError("no more processes")
+        spare = (FakeProcess(), FakeIpc())
+        self.spawned.append(spare)
+        return spare
+
+    def test_dead_spares_are_skipped(self):
+        pool = UniversePool(size=0, spawn=self.spawn)
+        dead = (FakeProcess(returncode=1), FakeIpc())
+        hung_up = (FakeProcess(), FakeIpc(alive=False))
+        pool.spares.extend([dead, hung_up])
+        found = pool.take()
+        self.assertEqual(self.spawned, [found])
+        self.assertFalse(dead[1].alive)
+        self.assertFalse(pool.spares)
+
+    def test_refill_survives_a_failed_spawn(self):
+        pool = UniversePool(size=1, spawn=self.spawn)
+        self.failures = 1
+        self.assertFalse(pool._UniversePool__refill())
+        self.assertFalse(pool.spares)
+        self.assertFalse(pool._UniversePool__refill())
+        self.assertEqual(list(pool.spares), self.spawned)
+
+
+class UniverseHangupTest(unittest.TestCase):
+    """
+    A universe whose process goes away by itself is left hibernated,
+    and waking it starts a fresh process.
+    """
+
+    def setUp(self):
+        self.peers = []
+        self.real_pool = universe.pool
+        universe.pool = UniversePool(size=0, spawn=self.spawn)
+
+    def tearDown(self):
+        universe.pool = self.real_pool
+        for fd in self.peers:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def spawn(self):
+        read_fd, peer_write = os.pipe()
+        peer_read, write_fd = os.pipe()
+        self.peers.extend([peer_write, peer_read])
+        ipc = IpcHandler(
+            os.fdopen(read_fd, "rb"), os.fdopen(write_fd, "wb"),
+            wire_format="binary")
+        return FakeProcess(), ipc
+
+    def test_hangup_hibernates(self):
+        hung_up = []
+        earth = Universe()
+        earth.on_hangup = hung_up.append
+        try:
+            os.close(self.peers[0])
+            earth.ipc.io_event(None, GLib.IO_HUP)
+            self.assertTrue(earth.hibernated)
+            self.assertEqual(hung_up, [earth])
+            earth.wake()
+            self.assertFalse(earth.hibernated)
+            self.assertTrue(earth.ipc.alive)
+            self.assertEqual(len(self.peers), 4)
+        finally:
+            earth.destroy()
+
+
+if __name__ == "__main__":
+    unittest.main()
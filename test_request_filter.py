@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for RequestFilter and the host rules file.
+
+Usage: python test_request_filter.py
+"""
+
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from request_filter import RequestFilter, load_host_rules
+
+
+class HostRulesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.work_dir, "hosts.txt")
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def test_missing_file(self):
+        self.assertIsNone(load_host_rules(self.path))
+
+    def test_rules(self):
+        with open(self.path, "w") as source:
+            source.write(
+                "# comment\n"
+                "default block\n"
+                "allow Example.com  # trailing comment\n"
+                "block ads.example.com\n"
+                "nonsense\n")
+        rules = load_host_rules(self.path)
+        self.assertEqual(rules, {
+            "allow" : ["example.com"],
+            "block" : ["ads.example.com"],
+            "default" : "block",
+        })
+        request_filter = RequestFilter(**rules)
+        self.assertTrue(request_filter.allows("https://www.example.com/"))
+        self.assertFalse(request_filter.allows("https://ads.example.com/"))
+        self.assertFalse(request_filter.allows("https://example.org/"))
+
+
+if __name__ == "__main__":
+    unittest.main()
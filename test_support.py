@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Helpers shared by the tests and the IPC benchmark.
+
+Importing this module provides "GLib".  If PyGObject is not installed,
+a small select based loop stands in for it, which is enough for the
+IPC code in universe.py, so this must be imported before universe.py.
+
+Run as "python test_support.py --zygote", this is a fork server for
+testing the Zygote client.
+"""
+
+
+import os
+import sys
+import time
+import types
+import fcntl
+import select
+import socket
+import unittest
+
+
+class SelectLoop(object):
+    """
+    The parts of GLib's main loop that universe.py uses, on top of
+    select.  Only used when PyGObject is not installed.
+    """
+
+    IO_IN = 1
+    IO_OUT = 4
+    IO_ERR = 8
+    IO_HUP = 16
+    PRIORITY_DEFAULT = 0
+
+    def __init__(self):
+        self.next_id = 1
+        self.watches = {}
+        self.timers = {}
+
+    def __add(self, table, value):
+        source_id = self.next_id
+        self.next_id += 1
+        table[source_id] = value
+        return source_id
+
+    def io_add_watch(self, fd, priority, condition, callback, *data):
+        return self.__add(self.watches, (fd, condition, callback, data))
+
+    def timeout_add(self, interval, callback, *data):
+        return self.__add(
+            self.timers,
+            [time.time() + interval / 1000.0, interval, callback, data])
+
+    def idle_add(self, callback, *data):
+        return self.timeout_add(0, callback, *data)
+
+    def source_remove(self, source_id):
+        self.watches.pop(source_id, None)
+        self.timers.pop(source_id, None)
+
+    def iteration(self, may_block=True):
+        timeout = 0
+        if may_block:
+            timeout = 1.0
+            if self.timers:
+                timeout = max(0, min(timeout, min(
+                    timer[0] for timer in self.timers.values()) - time.time()))
+        readers = [
+            fd for fd, condition, callback, data in self.watches.values()
+            if condition & self.IO_IN]
+        writers = [
+            fd for fd, condition, callback, data in self.watches.values()
+            if condition & self.IO_OUT]
+        if readers or writers:
+            readable, writable = select.select(
+                readers, writers, [], timeout)[:2]
+        else:
+            time.sleep(timeout)
+            readable = writable = []
+        for source_id, (fd, condition, callback, data) in \
+                self.watches.items():
+            ready = 0
+            if fd in readable:
+                ready |= self.IO_IN
+            if fd in writable:
+                ready |= self.IO_OUT
+            if ready and source_id in self.watches:
+                if not callback(fd, ready, *data):
+                    self.watches.pop(source_id, None)
+        now = time.time()
+        for source_id, timer in self.timers.items():
+            if source_id in self.timers and timer[0] <= now:
+                if timer[2](*timer[3]):
+                    timer[0] = now + timer[1] / 1000.0
+                else:
+                    self.timers.pop(source_id, None)
+
+
+try:
+    from gi.repository import GLib
+    iteration = GLib.MainContext.default().iteration
+    LOOP = "glib"
+except ImportError:
+    GLib = SelectLoop()
+    iteration = GLib.iteration
+    LOOP = "select"
+    sys.modules["gi"] = types.ModuleType("gi")
+    sys.modules["gi.repository"] = types.ModuleType("gi.repository")
+    sys.modules["gi.repository"].GLib = GLib
+
+
+import wire
+from universe import IpcHandler, zygote_server
+
+
+class PipeTestCase(unittest.TestCase):
+    """
+    Base class for tests of an IpcHandler connected to pipes.  The test
+    writes packets for the handler to read to "in_fd", and reads what
+    the handler wrote from "out_fd", which doesn't block.  Subclasses
+    may set "handler_options" for the IpcHandler.
+    """
+
+    handler_options = {}
+
+    def setUp(self):
+        self.read_fd, self.in_fd = os.pipe()
+        self.out_fd, write_fd = os.pipe()
+        flags = fcntl.fcntl(self.out_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.out_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.handler = IpcHandler(
+            os.fdopen(self.read_fd, "rb"), os.fdopen(write_fd, "wb"),
+            wire_format="binary", **self.handler_options)
+
+    def tearDown(self):
+        self.handler.hangup()
+        os.close(self.in_fd)
+        os.close(self.out_fd)
+
+    def feed(self, *packets):
+        """
+        Write (action, kargs) pairs for the handler to read, and have
+        it read them.
+        """
+        encode = self.handler.wire.encode
+        os.write(self.in_fd, "".join(
+            encode(action, kargs) for action, kargs in packets))
+        self.assertTrue(self.handler.io_event(self.read_fd, GLib.IO_IN))
+
+    def received(self):
+        """
+        Returns the packets the handler has written so far.
+        """
+        data = bytearray()
+        while True:
+            try:
+                chunk = os.read(self.out_fd, 65536)
+            except OSError:
+                break
+            data.extend(chunk)
+        return wire.BinaryWire().decode(data)
+
+
+def run_echo_zygote():
+    """
+    A zygote like the one in webkit_plug.py, whose children don't run a
+    universe, but only wait for their stdin to close.
+    """
+    control = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    def run_child():
+        while os.read(0, 4096):
+            pass
+    zygote_server(control, run_child)
+
+
+if __name__ == "__main__":
+    if "--zygote" in sys.argv:
+        run_echo_zygote()
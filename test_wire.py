@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+"""
+Tests for the wire formats.
+
+Usage: python test_wire.py
+"""
+
+
+import unittest
+
+import wire
+
+
+class JsonWireTest(unittest.TestCase):
+
+    def test_malformed_lines_are_skipped(self):
+        json_wire = wire.JsonWire()
+        buffer = bytearray(
+            json_wire.encode("reload", {"target" : "a"}) +
+            "JSON:{not json\n" +
+            "JSON:[1, 2]\n" +
+            json_wire.encode("reload", {"target" : "b"}))
+        sizes = []
+        packets = json_wire.decode(buffer, sizes)
+        self.assertEqual(packets, [
+            {"action" : "reload", "kargs" : {"target" : "a"}},
+            {"action" : None, "kargs" : None},
+            {"action" : None, "kargs" : None},
+            {"action" : "reload", "kargs" : {"target" : "b"}},
+        ])
+        self.assertEqual(len(sizes), 4)
+        self.assertEqual(len(buffer), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
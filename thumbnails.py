@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import errno
+import mmap
+import tempfile
+
+
+# Size, in pixels, of the tab thumbnails shown in the tab tree.
+THUMBNAIL_WIDTH = 96
+THUMBNAIL_HEIGHT = 60
+
+# Number of thumbnails each universe can have in flight at once.  Set
+# RIDINGHOOD_THUMBNAILS=0 to turn thumbnails off.
+THUMBNAIL_SLOTS = int(os.environ.get("RIDINGHOOD_THUMBNAILS", 16))
+
+# Shared memory is backed by tmpfs, so the pixels never touch a disk.
+SHM_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+
+class ThumbnailRing(object):
+    """
+    A ring of fixed size thumbnail slots in a shared memory file, which
+    a universe process draws into and the frontend displays from, so
+    that no pixels go through the IPC pipe.
+
+    The frontend creates the file, and tells the universe about it in
+    a "configure_thumbnails" packet.  The universe draws a thumbnail
+    into a free slot and sends "thumbnail_ready" with the slot number.
+    The frontend shows the slot until the tab's next thumbnail arrives,
+    and then hands the old slot back with "release_thumbnail".
+
+    Each slot is mapped on its own, page aligned, so that it can be
+    wrapped in a cairo ImageSurface (ARGB32) without copying.
+    """
+
+    def __init__(self, path, slots=THUMBNAIL_SLOTS, width=THUMBNAIL_WIDTH,
+                 height=THUMBNAIL_HEIGHT, create=False):
+        self.path = path
+        self.width = width
+        self.height = height
+        self.stride = width * 4
+        size = self.stride * height
+        self.slot_size = (
+            (size + mmap.ALLOCATIONGRANULARITY - 1)
+            // mmap.ALLOCATIONGRANULARITY * mmap.ALLOCATIONGRANULARITY)
+
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT | os.O_EXCL
+        fd = os.open(path, flags, 0600)
+        try:
+            if create:
+                os.ftruncate(fd, self.slot_size * slots)
+            self.slots = [
+                mmap.mmap(fd, self.slot_size, offset=slot * self.slot_size)
+                for slot in range(slots)]
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def create(cls, name, slots=THUMBNAIL_SLOTS):
+        """
+        Create a new ring in shared memory for the universe with the
+        given identity.
+        """
+        path = os.path.join(
+            SHM_DIR, "ridinghood-%i-%s.thumbnails" % (os.getpid(), name))
+        return cls(path, slots, create=True)
+
+    def config(self):
+        """
+        The arguments the other process needs to map this ring.
+        """
+        return {
+            "path" : self.path,
+            "slots" : len(self.slots),
+            "width" : self.width,
+            "height" : self.height,
+        }
+
+    def surface(self, slot):
+        """
+        Returns a cairo ImageSurface that uses the memory of the given
+        slot directly.
+        """
+        import cairo
+        return cairo.ImageSurface.create_for_data(
+            self.slots[slot], cairo.FORMAT_ARGB32,
+            self.width, self.height, self.stride)
+
+    def close(self):
+        for slot in self.slots:
+            slot.close()
+        self.slots = []
+
+    def unlink(self):
+        """
+        Remove the shared memory file.  Existing mappings stay valid.
+        """
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def prune_stale_rings():
+    """
+    Remove the rings left behind by frontends that are no longer
+    running, such as after a crash.
+    """
+    for name in os.listdir(SHM_DIR):
+        if not (name.startswith("ridinghood-") and
+                name.endswith(".thumbnails")):
+            continue
+        try:
+            os.kill(int(name.split("-")[1]), 0)
+        except ValueError:
+            continue
+        except OSError as error:
+            if error.errno == errno.ESRCH:
+                try:
+                    os.unlink(os.path.join(SHM_DIR, name))
+                except OSError:
+                    pass
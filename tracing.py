@@ -0,0 +1,168 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import os
+import sys
+import json
+import time
+import threading
+
+
+# Set RIDINGHOOD_TRACE to a file name to record a trace of startup, in
+# the Chrome trace event format.  Open it in chrome://tracing or
+# https://ui.perfetto.dev.  The variable is inherited by universe
+# processes, which send their events to the frontend.
+TRACE_PATH = os.environ.get("RIDINGHOOD_TRACE", "")
+
+
+class Span(object):
+    """
+    Context manager returned by Tracer.span.
+    """
+
+    def __init__(self, tracer, name, args):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.start, time.time(), **self.args)
+        return False
+
+
+class NullSpan(object):
+    """
+    Stands in for a Span when tracing is off.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """
+    Collects timed events in memory, as Chrome trace events.  All
+    timestamps are wall clock times, so the events of the frontend and
+    of the universe processes line up on a single timeline.
+
+    When the tracer is disabled, every method returns right away, so
+    the calls can stay in the code.
+
+    The universe processes hand their events over with 'take', and the
+    frontend merges them in with 'extend' and writes the whole trace
+    out with 'save'.
+    """
+
+    def __init__(self, path=TRACE_PATH):
+        self.path = path
+        self.enabled = bool(path)
+        self.events = []
+        self.pid = os.getpid()
+
+    def __event(self, phase, name, timestamp, args):
+        pid = os.getpid()
+        if pid != self.pid:
+            # forked by the zygote, so start over as a new process
+            self.pid = pid
+            self.events = []
+        event = {
+            "name" : name,
+            "ph" : phase,
+            "ts" : int(timestamp * 1e6),
+            "pid" : pid,
+            "tid" : threading.current_thread().ident % 1000000,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+        return event
+
+    def name_process(self, name):
+        """
+        Set the name shown for this process in the trace viewer.
+        """
+        if self.enabled:
+            self.__event("M", "process_name", 0, {"name" : name})
+
+    def complete(self, name, start, end=None, **args):
+        """
+        Record a phase that ran from 'start' to 'end', which are
+        time.time() values.  The end defaults to now.
+        """
+        if self.enabled:
+            event = self.__event("X", name, start, args)
+            event["dur"] = int(((end or time.time()) - start) * 1e6)
+
+    def instant(self, name, **args):
+        """
+        Record a single point in time.
+        """
+        if self.enabled:
+            self.__event("i", name, time.time(), args)["s"] = "p"
+
+    def span(self, name, **args):
+        """
+        Returns a context manager that records the time spent in it.
+        """
+        if self.enabled:
+            return Span(self, name, args)
+        return NULL_SPAN
+
+    def take(self):
+        """
+        Returns the recorded events, and forgets them.
+        """
+        events, self.events = self.events, []
+        return events
+
+    def extend(self, events):
+        """
+        Merge in events recorded by another process.
+        """
+        if self.enabled:
+            self.events.extend(events)
+
+    def save(self):
+        """
+        Write every event recorded so far to the trace file.
+        """
+        if not self.enabled:
+            return
+        try:
+            with open(self.path, "w") as trace_file:
+                json.dump({
+                    "traceEvents" : self.events,
+                    "displayTimeUnit" : "ms",
+                }, trace_file)
+        except IOError as error:
+            sys.stderr.write("Could not write trace: %s\n" % error)
+
+
+# The tracer for this process.
+tracer = Tracer()
@@ -17,16 +17,191 @@
 # along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import os
+import re
 import sys
 import time
-import json
+import uuid
+import errno
+import fcntl
+import shutil
 import select
+import signal
+import socket
+import traceback
 import subprocess
-from threading import Thread, Lock, Event
+from collections import deque, OrderedDict
+from multiprocessing.reduction import send_handle, recv_handle
 from gi.repository import GLib
 
+import wire
+from tracing import tracer
+from thumbnails import ThumbnailRing, THUMBNAIL_SLOTS
+from ipc_metrics import IpcMetrics, METRICS_ENABLED
 
-class IpcHandler(Thread):
+
+class IpcReactor(object):
+    """
+    The IpcReactor multiplexes the read pipes of every IpcHandler in
+    the process onto the GLib main loop.  Rather than each handler
+    running its own polling thread, the main loop's poll call watches
+    every pipe at once, and a handler is woken up as soon as data
+    arrives on its pipe.
+
+    Only one instance of this class is needed per process, which is
+    provided as the module level "reactor" variable.
+    """
+
+    def __init__(self):
+        self.__watches = {}
+        self.__output_watches = {}
+
+    def watch(self, handler, pipe):
+        """
+        Start watching the given pipe.  The handler's "io_event" method
+        is called from the main loop whenever the pipe is readable or
+        has been closed.
+        """
+        self.unwatch(handler)
+        fd = pipe.fileno()
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        conditions = GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR
+        self.__watches[handler] = GLib.io_add_watch(
+            fd, GLib.PRIORITY_DEFAULT, conditions, self.__io_event, handler)
+
+    def unwatch(self, handler):
+        """
+        Stop watching the pipe associated with the given handler.
+        """
+        source_id = self.__watches.pop(handler, None)
+        if source_id is not None:
+            GLib.source_remove(source_id)
+
+    def __io_event(self, fd, condition, handler):
+        keep_watching = handler.io_event(fd, condition)
+        if not keep_watching:
+            self.__watches.pop(handler, None)
+        return keep_watching
+
+    def watch_output(self, handler, fd):
+        """
+        Call the handler's "write_event" method from the main loop
+        whenever the given file descriptor can be written to, until
+        it returns False or 'unwatch_output' is called.
+        """
+        if handler not in self.__output_watches:
+            conditions = GLib.IO_OUT | GLib.IO_HUP | GLib.IO_ERR
+            self.__output_watches[handler] = GLib.io_add_watch(
+                fd, GLib.PRIORITY_DEFAULT, conditions,
+                self.__write_event, handler)
+
+    def unwatch_output(self, handler):
+        """
+        Stop watching the given handler's write pipe.
+        """
+        source_id = self.__output_watches.pop(handler, None)
+        if source_id is not None:
+            GLib.source_remove(source_id)
+
+    def __write_event(self, fd, condition, handler):
+        keep_watching = handler.write_event(fd, condition)
+        if not keep_watching:
+            self.__output_watches.pop(handler, None)
+        return keep_watching
+
+
+reactor = IpcReactor()
+
+
+# The framing used between the frontend and universe processes.  This
+# is negotiated on the command line when a universe is started.  Set
+# RIDINGHOOD_WIRE=json to get human readable packets for debugging.
+WIRE_FORMAT = os.environ.get("RIDINGHOOD_WIRE", wire.BinaryWire.name)
+
+# How long, in milliseconds, an IpcListener.call waits for its reply
+# before giving up on it.
+CALL_TIMEOUT = 2000
+
+# How long, in milliseconds, coalesced packets are held back, so that
+# only the latest one per target and action is delivered.  This is
+# about one frame.
+COALESCE_INTERVAL = 16
+
+# Most bytes an IpcHandler will hold in its write queue while the other
+# process isn't reading.
+WRITE_QUEUE_LIMIT = int(
+    os.environ.get("RIDINGHOOD_WRITE_QUEUE_LIMIT", 4 << 20))
+
+# What an IpcHandler does when its write queue is full:
+#   "block"        wait for the other process to read, like a blocking
+#                  write would, which freezes this process meanwhile.
+#   "drop_oldest"  drop the oldest queued packets whose action is in
+#                  DROPPABLE_ACTIONS, then fall back to "unhealthy".
+#   "unhealthy"    drop the new packets, and report the connection as
+#                  unhealthy until the queue has drained to half.
+OVERFLOW_POLICY = os.environ.get("RIDINGHOOD_OVERFLOW", "drop_oldest")
+
+# Actions that only report state, which is sent again whenever it
+# changes, so an old one can be dropped without losing anything that
+# matters.
+DROPPABLE_ACTIONS = frozenset([
+    "title_changed_event",
+    "update_uri",
+    "update_history_state",
+    "update_history_buttons",
+    "update_blocked_count",
+])
+
+# Number of idle, pre-started universe processes to keep around so
+# that a new Universe doesn't have to wait on a cold start.
+POOL_SIZE = int(os.environ.get("RIDINGHOOD_POOL_SIZE", 2))
+
+# Delay, in milliseconds, before the pool starts another spare
+# process, so that refilling doesn't compete with the universe that
+# was just handed out.
+POOL_REFILL_DELAY = 250
+
+# Delay, in milliseconds, before the pool tries again after it failed
+# to start a spare process.
+POOL_RETRY_DELAY = 5000
+
+# Seconds a universe process gets to exit by itself once its pipes are
+# closed, before it is sent SIGTERM, and then how many more it gets
+# before it is sent SIGKILL.
+STOP_GRACE = float(os.environ.get("RIDINGHOOD_STOP_GRACE", 1.0))
+STOP_TERM_GRACE = 0.5
+
+# Seconds to wait for processes to go away after SIGKILL at shutdown.
+STOP_KILL_WAIT = 1.0
+
+# How universe processes are started.  "popen" starts a fresh python
+# interpreter for every universe.  "zygote" asks a fork server, which
+# has already imported the WebKit stack, to fork a new child instead,
+# so that all universes share those pages copy-on-write.
+SPAWN_MODE = os.environ.get("RIDINGHOOD_SPAWN", "popen")
+
+# Seconds the fork server waits on its control socket before it looks
+# for exited children to reap again.
+ZYGOTE_REAP_INTERVAL = 0.1
+
+# Each universe keeps its own on-disk http cache in a directory under
+# here, named after the universe's identity, so nothing cached by one
+# universe is visible to another.
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "ridinghood", "universes")
+
+# Size cap, in megabytes, of each universe's http cache.  When it is
+# reached, the least recently used entries are evicted.
+CACHE_SIZE = int(os.environ.get("RIDINGHOOD_CACHE_SIZE", 64))
+
+# Days after which the cache of a universe that is no longer around is
+# deleted.
+CACHE_MAX_AGE = int(os.environ.get("RIDINGHOOD_CACHE_MAX_AGE", 30))
+
+
+class IpcHandler(object):
     """
     This class provides easy interprocess communication over IO
     objects!
@@ -39,101 +214,503 @@ class IpcHandler(Thread):
     A method or IpcListener instance may also be passed in for the
     signal argument so that message events may be pushed.
 
+    The wire_format argument names one of the framings in wire.FORMATS.
+    Both ends of the pipe must agree on it.
+
     Currently, this depends on a GLib event loop to be present.
 
-    An instance of this class creates a new thread to use ot listen to
-    the read_pipe.  When new data is found, it is buffered so that the
-    'read' method can acces it, and optionally signal method is
-    scheduled to run on the main thread when GLib is idle again.
+    The read_pipe is watched by the process wide IpcReactor.  When new
+    data is found, it is appended to a reusable buffer so that the
+    'read' method can decode it, and the signal method is called right
+    away from the main loop.
+
+    Writes don't block either.  Whatever the pipe won't take right
+    away is kept in a write queue, which the reactor drains as the
+    other process reads.  The queue holds at most WRITE_QUEUE_LIMIT
+    bytes, and 'overflow_policy' (see OVERFLOW_POLICY) decides what
+    happens past that.  "healthy" is False while the "unhealthy"
+    policy is refusing packets, and the signal's "health_event"
+    method, if it has one, is called when that changes.
 
     This class provides a "read" and "send" method, both of which are
     non-blocking.
 
     For Gtk applications, you will likely only use the "send" method
     and a signal callback.
+
+    When METRICS_ENABLED is set, traffic is recorded in "metrics", an
+    IpcMetrics instance.  Otherwise "metrics" is None.
     """
-    def __init__(self, read_pipe=sys.stdin, write_pipe=sys.stdout, signal=None):
-        Thread.__init__(self)
+    def __init__(self, read_pipe=sys.stdin, write_pipe=sys.stdout, signal=None,
+                 wire_format=WIRE_FORMAT, overflow_policy=OVERFLOW_POLICY,
+                 queue_limit=WRITE_QUEUE_LIMIT):
         self.__read = read_pipe
         self.__write = write_pipe
         self.__signal = signal
-        
-        self.__new_data = []
-        self.__lock = Lock()
-        self.__ready = Event()
+
+        self.__write_fd = write_pipe.fileno()
+        flags = fcntl.fcntl(self.__write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self.__write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.overflow_policy = overflow_policy
+        self.queue_limit = queue_limit
+        # (action, frame) pairs waiting to be written, and how much of
+        # the first frame has been written already
+        self.__queue = deque()
+        self.__head_written = 0
+        self.queued_bytes = 0
+        self.__droppable_bytes = 0
+        self.__stall_start = None
+        self.healthy = True
+
+        self.wire = wire.FORMATS[wire_format]()
+        self.__buffer = bytearray()
+        self.metrics = IpcMetrics() if METRICS_ENABLED else None
+        self.read_time = 0.0
 
         self.alive = True
-        self.start()
-
-    def run(self):
-        while self.alive:
-            ready = select.select([self.__read], [], [])[0]
-            if ready:
-                line = ready[0].readline()
-                self.__lock.acquire()
-                self.__new_data.append(line)
-                self.__lock.release()
-                self.__ready.set()
-                if self.__signal:
-                    if hasattr(self.__signal, "routing_event"):
-                        GLib.idle_add(self.__signal.routing_event)
-                    elif hasattr(self.__signal, "__call__"):
-                        GLib.idle_add(self.__signal)
-            time.sleep(0.01)
-    
+        reactor.watch(self, self.__read)
+
+    def io_event(self, fd, condition):
+        """
+        Called by the IpcReactor when the read pipe is readable or has
+        been closed.  Everything available on the pipe is drained in
+        one go, and the signal is called once for the whole batch.
+        Returns False when the pipe should no longer be watched.
+        """
+        received = False
+        hung_up = not condition & GLib.IO_IN
+        while not hung_up:
+            try:
+                chunk = os.read(fd, 65536)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                hung_up = error.errno != errno.EAGAIN
+                break
+            if not chunk:
+                # the other end of the pipe went away
+                hung_up = True
+            else:
+                self.__buffer.extend(chunk)
+                received = True
+                if self.metrics is not None:
+                    self.metrics.read(len(chunk))
+                    self.read_time = time.time()
+
+        if hung_up:
+            self.alive = False
+        if received or hung_up:
+            self.__notify()
+        return self.alive
+
+    def __notify(self):
+        if self.__signal:
+            if hasattr(self.__signal, "routing_event"):
+                self.__signal.routing_event()
+            elif hasattr(self.__signal, "__call__"):
+                self.__signal()
+
+    def attach(self, signal):
+        """
+        Set the signal for a handler that was created without one.
+        Anything that arrived in the mean time is delivered right
+        away.
+        """
+        self.__signal = signal
+        if self.__buffer or not self.alive:
+            self.__notify()
+
+    def close(self):
+        """
+        Stop watching the pipes and mark this handler as dead.  Any
+        packets still in the write queue are dropped.
+        """
+        self.alive = False
+        reactor.unwatch(self)
+        reactor.unwatch_output(self)
+        self.__queue.clear()
+        self.__head_written = 0
+        self.queued_bytes = 0
+        self.__droppable_bytes = 0
+
+    def hangup(self):
+        """
+        Close the handler and both pipes, so that the other process
+        reads end of file and knows to exit.
+        """
+        self.close()
+        for pipe in (self.__write, self.__read):
+            try:
+                pipe.close()
+            except (IOError, OSError):
+                pass
+
     def send(self, action, **kargs):
         """
-        Sends a "packet" to the other process.  Right now, a packet is
-        just a line of ascii encoded text.
+        Sends a "packet" to the other process.
+        """
+        self.send_batch([(action, kargs)])
+
+    def send_batch(self, packets):
+        """
+        Sends several packets to the other process with a single
+        write.  The packets argument is a sequence of (action, kargs)
+        pairs.  Anything the pipe won't take right now is queued.
         """
-        if self.alive:
-            packet = "JSON:" + json.dumps({
-                "action" : action,
-                "kargs" : kargs,
-            }).strip().replace("\n", chr(31))
+        if not self.alive or not packets:
+            return
+        encode = self.wire.encode
+        if not self.healthy:
+            if self.metrics is not None:
+                for action, kargs in packets:
+                    self.metrics.dropped(action)
+            return
+
+        if not self.__queue:
+            # the common case: nothing is backed up, so try to write
+            # everything straight away
+            frames = [encode(action, kargs) for action, kargs in packets]
+            if self.metrics is not None:
+                for (action, kargs), frame in zip(packets, frames):
+                    self.metrics.sent(action, len(frame))
+            data = "".join(frames)
+            written = self.__write_some(data)
+            if written is None or written == len(data):
+                return
+            # queue up the rest, starting with the frame that was cut
+            # off, and remember how much of that one already went out
+            offset = 0
+            for (action, kargs), frame in zip(packets, frames):
+                end = offset + len(frame)
+                if end > written:
+                    if not self.__queue:
+                        self.__head_written = written - offset
+                    self.__enqueue(action, frame)
+                offset = end
+            self.queued_bytes -= self.__head_written
+            self.__stall_start = time.time()
+            reactor.watch_output(self, self.__write_fd)
+        else:
+            for action, kargs in packets:
+                frame = encode(action, kargs)
+                if self.metrics is not None:
+                    self.metrics.sent(action, len(frame))
+                self.__enqueue(action, frame)
 
-            self.__write.write(packet + "\n")
+        if self.metrics is not None:
+            self.metrics.queued(self.queued_bytes)
+        if self.queued_bytes > self.queue_limit:
+            self.__overflow()
+
+    def __enqueue(self, action, frame):
+        self.__queue.append((action, frame))
+        self.queued_bytes += len(frame)
+        if action in DROPPABLE_ACTIONS:
+            self.__droppable_bytes += len(frame)
+
+    def __write_some(self, data):
+        """
+        Write as much of the data as the pipe takes without blocking.
+        Returns the number of bytes written, or None if the pipe broke.
+        """
+        written = 0
+        while written < len(data):
             try:
-                self.__write.flush()
-            except IOError:
-                self.alive = False
+                written += os.write(self.__write_fd, buffer(data, written))
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno == errno.EAGAIN:
+                    break
+                self.close()
                 sys.stderr.write(
-                    "IpcHandler shutdown due to IOError on pipe flush.\n")
+                    "IpcHandler shutdown due to error on pipe write: %s\n"
+                    % error)
+                return None
+        return written
+
+    def write_event(self, fd, condition):
+        """
+        Called by the IpcReactor when the write pipe can take more
+        data.  Returns False once the write queue is empty.
+        """
+        if not condition & GLib.IO_OUT:
+            # the other end went away; the read side will notice
+            return False
+        while self.__queue:
+            action, frame = self.__queue[0]
+            written = self.__write_some(
+                buffer(frame, self.__head_written))
+            if written is None:
+                return False
+            self.__head_written += written
+            self.queued_bytes -= written
+            if self.__head_written < len(frame):
+                break
+            self.__queue.popleft()
+            self.__head_written = 0
+            if action in DROPPABLE_ACTIONS:
+                self.__droppable_bytes -= len(frame)
+
+        if not self.healthy and self.queued_bytes <= self.queue_limit // 2:
+            self.__set_healthy(True)
+        if self.__queue:
+            return True
+        if self.metrics is not None and self.__stall_start is not None:
+            self.metrics.stalled(time.time() - self.__stall_start)
+        self.__stall_start = None
+        return False
+
+    def __overflow(self):
+        policy = self.overflow_policy
+        if policy == "block":
+            start = time.time()
+            while self.__queue and self.queued_bytes > self.queue_limit:
+                select.select([], [self.__write_fd], [])
+                if not self.write_event(self.__write_fd, GLib.IO_OUT):
+                    break
+            if self.metrics is not None:
+                self.metrics.blocked(time.time() - start)
+            return
+
+        if policy == "drop_oldest" and (
+                self.queued_bytes - self.__droppable_bytes
+                <= self.queue_limit):
+            # the first frame may be partly written, so it has to stay
+            kept = deque([self.__queue.popleft()])
+            while self.__queue and self.queued_bytes > self.queue_limit:
+                action, frame = self.__queue.popleft()
+                if action in DROPPABLE_ACTIONS:
+                    self.queued_bytes -= len(frame)
+                    self.__droppable_bytes -= len(frame)
+                    if self.metrics is not None:
+                        self.metrics.dropped(action)
+                else:
+                    kept.append((action, frame))
+            kept.extend(self.__queue)
+            self.__queue = kept
+            return
+
+        self.__set_healthy(False)
+
+    def __set_healthy(self, healthy):
+        self.healthy = healthy
+        if not healthy:
+            sys.stderr.write(
+                "IpcHandler write queue is full, refusing packets until "
+                "the other process catches up.\n")
+        if hasattr(self.__signal, "health_event"):
+            self.__signal.health_event(healthy)
 
     def read(self):
         """
         Returns a list of new data from the other process.
         """
-        data = []
-        if self.alive and self.__ready.wait(0.01):
-            self.__lock.acquire()
-            while self.__new_data:
-                raw = self.__new_data.pop(0)
-                if raw.startswith("JSON:"):
-                    raw = raw.replace(chr(31), "\n")
-                    data.append(json.loads(raw[5:]))
-                else:
-                    data.append(raw)
-            self.__lock.release()
-        return data
+        if self.metrics is None:
+            return self.wire.decode(self.__buffer)
+        sizes = []
+        packets = self.wire.decode(self.__buffer, sizes)
+        for packet, size in zip(packets, sizes):
+            if type(packet) is dict:
+                self.metrics.received(packet.get("action"), size)
+        self.metrics.decoded(len(packets), len(self.__buffer))
+        return packets
+
+
+class IpcCall(object):
+    """
+    Represents a request made with IpcListener.call which is waiting
+    on a reply from the other process.  Use the 'then' method to
+    attach callbacks.  The callback is given the handler's return
+    value, and the errback is given a string describing why the call
+    failed, for example because it timed out.
+    """
+
+    def __init__(self, call_id, action):
+        self.call_id = call_id
+        self.action = action
+        self.done = False
+        self.result = None
+        self.error = None
+        self.timer = None
+        self.__callbacks = []
+
+    def then(self, callback=None, errback=None):
+        """
+        Attach callbacks to this call.  If the call has already
+        finished, the appropriate callback runs right away.
+        """
+        self.__callbacks.append((callback, errback))
+        if self.done:
+            self.__fire()
+        return self
+
+    def resolve(self, result):
+        if not self.done:
+            self.done = True
+            self.result = result
+            self.__fire()
+
+    def fail(self, error):
+        if not self.done:
+            self.done = True
+            self.error = error
+            self.__fire()
+
+    def __fire(self):
+        callbacks, self.__callbacks = self.__callbacks, []
+        for callback, errback in callbacks:
+            if self.error is None:
+                if callback:
+                    callback(self.result)
+            elif errback:
+                errback(self.error)
+            else:
+                sys.stderr.write("Call to %s failed: %s\n" % (
+                    self.action, self.error))
+
+
+class RoutingTable(object):
+    """
+    A dispatch table that is compiled once per listener or actor
+    class.  It maps action names to the methods that handle them, so
+    routing a packet does not need any reflection.
+
+    Public methods are routed to by name.  The class may also define
+    an "_event_routing" dictionary, whose keys are regular expressions
+    matched against the action name, and whose values are method
+    names.  The expressions are merged into one combined pattern, and
+    any named groups are passed to the method as extra parameters.
+    Named groups must be unique across all of a class's routes.
+
+    Each distinct action is only resolved once; the result is cached.
+    """
+
+    __tables = {}
+
+    # Upper bound on the number of resolved actions kept per table, so
+    # that a misbehaving peer can't grow the cache without limit.
+    CACHE_LIMIT = 1024
+
+    @classmethod
+    def for_class(cls, klass):
+        """
+        Returns the RoutingTable for the given class, compiling it on
+        first use.
+        """
+        table = cls.__tables.get(klass)
+        if table is None:
+            table = cls.__tables[klass] = cls(klass)
+        return table
+
+    def __init__(self, klass):
+        # Plumbing methods of IpcListener are not routable, with the
+        # exception of the handlers for call replies and metrics.
+        hidden = set(IpcListener.__dict__)
+        hidden.discard("call_reply")
+        hidden.discard("dump_metrics")
+
+        self.methods = {}
+        for name in dir(klass):
+            if name.startswith("_") or name in hidden:
+                continue
+            method = getattr(klass, name)
+            if callable(method):
+                self.methods[name] = method
+
+        self.routes = []
+        self.pattern = None
+        event_routing = getattr(klass, "_event_routing", None) or {}
+        alternatives = []
+        for regex, method_name in sorted(event_routing.items()):
+            group = "_route%i" % len(self.routes)
+            groups = re.compile(regex).groupindex.keys()
+            self.routes.append((getattr(klass, method_name), groups))
+            alternatives.append("(?P<%s>(?:%s)$)" % (group, regex))
+        if alternatives:
+            self.pattern = re.compile("|".join(alternatives))
+
+        self.__cache = {}
+
+    def resolve(self, action):
+        """
+        Returns a (method, extra_kargs) pair for the given action, or
+        None if nothing handles it.
+        """
+        try:
+            return self.__cache[action]
+        except KeyError:
+            pass
+
+        route = None
+        method = self.methods.get(action)
+        if method is not None:
+            route = (method, None)
+        elif self.pattern is not None:
+            match = self.pattern.match(action)
+            if match:
+                method, groups = self.routes[int(match.lastgroup[6:])]
+                found = match.groupdict()
+                route = (method, dict((name, found[name]) for name in groups))
+
+        if len(self.__cache) < self.CACHE_LIMIT:
+            self.__cache[action] = route
+        return route
+
 
-    
 class IpcListener(object):
     """
     The IpcListener class provides event routing on top of the
-    functionality defined by IpcHandler.  To use this, a derrived
-    class should define a dictionary as the "_event_routing" member
+    functionality defined by IpcHandler.  Packets are routed to a
+    public method of the same name on the listener, or else on the
+    registered actor named by the packet's "target" field.  A derrived
+    class may also define a dictionary as the "_event_routing" member
     variable.  The keys in the dictionary should be regular
     expressions, the values are method names on the class.  Any name
     groups in the regex are in turn used as named parameters on the
-    event callback.
+    event callback.  See RoutingTable for the details.
 
     See BrowserTab as an example of how to use this.
+
+    The number of packets that could not be routed, or that did not
+    look like packets at all, are counted in "unhandled_count" and
+    "malformed_count".
+
+    The 'call' method layers request/response messaging on top of the
+    event routing.  The packet is tagged with a "call_id", and the
+    return value of the handler on the other end is sent back in a
+    "call_reply" packet whose "reply_to" field carries the same id.
+    Any number of calls may be in flight at once.
+
+    High frequency events are coalesced, so that only the latest
+    packet per (target, action) pair is delivered at most once every
+    COALESCE_INTERVAL milliseconds.  The sending side does this with
+    'send_coalesced'.  The receiving side does this for the actions
+    listed in the "_coalesced_events" member variable.  Any other
+    packet first flushes the coalesced ones, so the overall order of
+    events is kept.
+
+    When the IpcHandler keeps metrics, the listener adds the time from
+    reading each packet to dispatching it, the time spent in its
+    handler, and how many coalesced packets were superseded.  The
+    "dump_metrics" action returns them.  Coalesced packets are left out
+    of the timings, since holding them back is the point.
     """
 
+    _coalesced_events = frozenset()
+
     def __init__(self, ipc):
         self.ipc = ipc
         self.actors = {}
+        self.pending_calls = {}
+        self.__next_call = 1
+        self.__routes = RoutingTable.for_class(type(self))
+        self.unhandled_count = 0
+        self.malformed_count = 0
+        self.__outgoing = OrderedDict()
+        self.__outgoing_source = None
+        self.__incoming = OrderedDict()
+        self.__incoming_source = None
 
     def register(self, route_id, instance):
         self.actors[route_id] = instance
@@ -145,33 +722,744 @@ class IpcListener(object):
             pass
 
     def send(self, action, **kargs):
+        self.send_batch([(action, kargs)])
+
+    def send_batch(self, packets):
+        """
+        Sends a sequence of (action, kargs) pairs with a single write.
+        """
         if self.ipc.alive:
-            self.ipc.send(action, **kargs)
-                
+            if self.__outgoing:
+                packets = self.__take_outgoing() + list(packets)
+            self.ipc.send_batch(packets)
+
+    def send_coalesced(self, action, **kargs):
+        """
+        Like 'send', but the packet is held back for up to
+        COALESCE_INTERVAL milliseconds.  If another packet with the
+        same action and target is sent in the mean time, it replaces
+        this one.
+        """
+        key = (kargs.get("target"), action)
+        if self.__outgoing.pop(key, None) is not None and self.ipc.metrics:
+            self.ipc.metrics.coalesced(action)
+        self.__outgoing[key] = kargs
+        if self.__outgoing_source is None:
+            self.__outgoing_source = GLib.timeout_add(
+                COALESCE_INTERVAL, self.__outgoing_timeout)
+
+    def __take_outgoing(self):
+        if self.__outgoing_source is not None:
+            GLib.source_remove(self.__outgoing_source)
+            self.__outgoing_source = None
+        packets = [
+            (action, kargs)
+            for (target, action), kargs in self.__outgoing.iteritems()]
+        self.__outgoing = OrderedDict()
+        return packets
+
+    def __outgoing_timeout(self):
+        self.__outgoing_source = None
+        self.send_batch([])
+        return False
+
+    def call(self, action, callback=None, errback=None,
+             timeout=CALL_TIMEOUT, **kargs):
+        """
+        Sends a packet that expects a reply, and returns an IpcCall
+        object for it.  The callback is run with the return value of
+        the remote handler.  The errback is run if the remote end has
+        no handler, raises an error, goes away, or does not reply
+        within 'timeout' milliseconds.
+        """
+        call_id = self.__next_call
+        self.__next_call += 1
+        pending = IpcCall(call_id, action).then(callback, errback)
+        if not self.ipc.alive:
+            pending.fail("connection is closed")
+            return pending
+
+        self.pending_calls[call_id] = pending
+        pending.timer = GLib.timeout_add(timeout, self.__call_timeout, call_id)
+        self.send(action, call_id=call_id, **kargs)
+        return pending
+
+    def call_reply(self, reply_to, result=None, error=None):
+        """
+        Event handler for the reply to a packet sent with 'call'.
+        """
+        pending = self.pending_calls.pop(reply_to, None)
+        if pending:
+            GLib.source_remove(pending.timer)
+            if error is None:
+                pending.resolve(result)
+            else:
+                pending.fail(error)
+
+    def __call_timeout(self, call_id):
+        pending = self.pending_calls.pop(call_id, None)
+        if pending:
+            pending.fail("timed out")
+        return False
+
+    def fail_pending_calls(self, error):
+        """
+        Fail every call that is still waiting on a reply.
+        """
+        pending_calls, self.pending_calls = self.pending_calls, {}
+        for pending in pending_calls.values():
+            GLib.source_remove(pending.timer)
+            pending.fail(error)
+
+    def dump_metrics(self):
+        """
+        Returns the IPC metrics of this end of the connection, or None
+        if metrics are not enabled.
+        """
+        if self.ipc.metrics is None:
+            return None
+        summary = self.ipc.metrics.summary()
+        summary["unhandled"] = self.unhandled_count
+        summary["malformed"] = self.malformed_count
+        summary["pending_calls"] = len(self.pending_calls)
+        return summary
+
     def routing_event(self):
+        metrics = self.ipc.metrics
         for packet in self.ipc.read():
-            handled = False
             if type(packet) is str:
                 sys.stderr.write(packet + "\n")
 
             elif type(packet) is dict:
                 action = packet.get('action')
                 kargs = packet.get('kargs')
-                if action and kargs:
-                    if hasattr(self, action):
-                        self.__getattribute__(action)(**kargs)
+                if action and kargs and type(kargs) is dict:
+                    if (action in self._coalesced_events
+                            and "call_id" not in kargs):
+                        self.__defer(action, kargs)
                     else:
-                        target = self.actors.get(kargs.get("target"))
-                        if target and hasattr(target, action):
-                            kargs.pop("target")
-                            target.__getattribute__(action)(**kargs)
+                        if self.__incoming:
+                            self.flush_incoming()
+                        if metrics is None:
+                            self.__deliver(action, kargs)
                         else:
-                            sys.stderr.write(
-                                "No handler found: %s\n" % action)
+                            start = time.time()
+                            self.__deliver(action, kargs)
+                            metrics.dispatched(
+                                action, start - self.ipc.read_time,
+                                time.time() - start)
                 else:
+                    self.malformed_count += 1
                     sys.stderr.write(
                         "Malformed packet: %s\n" % packet)
 
+        if not self.ipc.alive:
+            if self.pending_calls:
+                self.fail_pending_calls("connection closed")
+            self.hangup_event()
+
+    def __deliver(self, action, kargs):
+        # this runs from the reactor's io watch, which GLib removes for
+        # good if an exception escapes it, so a broken handler must not
+        # take the rest of the batch or the connection down with it
+        try:
+            self.__dispatch(action, kargs)
+        except Exception:
+            sys.stderr.write("Error in handler for %s:\n%s" % (
+                action, traceback.format_exc()))
+
+    def __dispatch(self, action, kargs):
+        call_id = kargs.pop("call_id", None)
+        target = self
+        route = self.__routes.resolve(action)
+        if route is None:
+            target = self.actors.get(kargs.get("target"))
+            if target is not None:
+                route = RoutingTable.for_class(type(target)).resolve(action)
+                if route is not None:
+                    kargs.pop("target")
+
+        if route is None:
+            self.unhandled_count += 1
+            sys.stderr.write("No handler found: %s\n" % action)
+            if call_id is not None:
+                self.send("call_reply", reply_to=call_id,
+                          error="no handler for %s" % action)
+            return
+
+        method, extra = route
+        if extra:
+            kargs.update(extra)
+        if call_id is None:
+            method(target, **kargs)
+        else:
+            try:
+                result = method(target, **kargs)
+            except Exception as error:
+                self.send("call_reply", reply_to=call_id,
+                          error="%s: %s" % (action, error))
+                sys.stderr.write("Error in handler for %s:\n%s" % (
+                    action, traceback.format_exc()))
+                return
+            self.send("call_reply", reply_to=call_id, result=result)
+
+    def __defer(self, action, kargs):
+        key = (kargs.get("target"), action)
+        if self.__incoming.pop(key, None) is not None and self.ipc.metrics:
+            self.ipc.metrics.coalesced(action)
+        self.__incoming[key] = kargs
+        if self.__incoming_source is None:
+            self.__incoming_source = GLib.timeout_add(
+                COALESCE_INTERVAL, self.__incoming_timeout)
+
+    def __incoming_timeout(self):
+        self.__incoming_source = None
+        self.flush_incoming()
+        return False
+
+    def flush_incoming(self):
+        """
+        Deliver every coalesced packet that is being held back.
+        """
+        if self.__incoming_source is not None:
+            GLib.source_remove(self.__incoming_source)
+            self.__incoming_source = None
+        incoming, self.__incoming = self.__incoming, OrderedDict()
+        for (target, action), kargs in incoming.iteritems():
+            self.__deliver(action, kargs)
+
+    def hangup_event(self):
+        """
+        Called once the other end of the connection has gone away.
+        """
+        pass
+
+    def health_event(self, healthy):
+        """
+        Called when the write queue overflows and new packets are
+        refused, with healthy=False, and again with healthy=True once
+        the other end has caught up.
+        """
+        pass
+
+
+class ZygoteChild(object):
+    """
+    Stands in for a Popen object for universe processes that were
+    forked by the Zygote.  These are not children of this process, but
+    of the zygote, which reaps them and reports their exit status.  So
+    the pid can't be reused while 'poll' still returns None, and
+    signals are sent by the zygote, which only does so for children it
+    hasn't reaped yet.
+    """
+
+    def __init__(self, pid, zygote, serial):
+        self.pid = pid
+        self.returncode = None
+        self.__zygote = zygote
+        self.__serial = serial
+
+    def poll(self):
+        if self.returncode is None:
+            self.returncode = self.__zygote.exit_status(self.__serial)
+        return self.returncode
+
+    def wait(self):
+        while self.poll() is None:
+            time.sleep(0.01)
+        return self.returncode
+
+    def send_signal(self, signal_number):
+        if self.poll() is None:
+            self.__zygote.kill(self.__serial, signal_number)
+
+    def terminate(self):
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        self.send_signal(signal.SIGKILL)
+
+
+class Zygote(object):
+    """
+    Client for the fork server mode of webkit_plug.py.  The zygote is
+    started on first use.  It imports the WebKit stack once, and then
+    forks a fresh universe process for every 'spawn' request, before
+    any browsing state exists.
+
+    For each request, the pipes for the new universe are created here
+    and the child's ends are passed to the zygote over a unix socket.
+    See 'zygote_server' for the other end of the socket.
+
+    Every forked child is given a serial number, since its pid may be
+    reused once it has been reaped.  If the zygote goes away, the
+    children it forked are reparented and can no longer be tracked or
+    signalled, so they are reported as exited with status 0.
+    """
+
+    def __init__(self, command=None):
+        self.command = command or [
+            "python", "webkit_plug.py", "--zygote", "--wire", WIRE_FORMAT]
+        self.proc = None
+        self.control = None
+        self.__buffer = ""
+        self.__spawned = deque()
+        self.__next_serial = 1
+        # serial by pid of every child that hasn't been reaped yet, and
+        # exit status by serial of the ones that have
+        self.__live = {}
+        self.__exited = {}
+
+    def start(self):
+        """
+        Start the fork server.
+        """
+        self.stop()
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.proc = subprocess.Popen(
+            self.command, stdin=theirs.fileno(), close_fds=True)
+        theirs.close()
+        self.control = ours
+
+    def stop(self):
+        """
+        Shut down the fork server.  Universes that were already forked
+        keep running.
+        """
+        if self.control:
+            self.control.close()
+            self.control = None
+        if self.proc:
+            self.proc.kill()
+            self.proc.wait()
+            self.proc = None
+        self.__buffer = ""
+        self.__spawned.clear()
+        for serial in self.__live.values():
+            self.__exited[serial] = 0
+        self.__live.clear()
+
+    def __read_reports(self, block=False):
+        """
+        Read whatever the zygote has sent, waiting for something if
+        'block' is set.
+        """
+        if not self.control:
+            return
+        if not block and not select.select([self.control], [], [], 0)[0]:
+            return
+        data = self.control.recv(4096)
+        if not data:
+            self.stop()
+            return
+        self.__buffer += data
+        lines = self.__buffer.split("\n")
+        self.__buffer = lines.pop()
+        for line in lines:
+            kind, fields = line[0], line[1:].split()
+            if kind == "p":
+                self.__spawned.append(int(fields[0]))
+            elif kind == "x":
+                serial = self.__live.pop(int(fields[0]), None)
+                if serial is not None:
+                    self.__exited[serial] = int(fields[1])
+
+    def exit_status(self, serial):
+        """
+        Returns the exit status of the given child, or None if it is
+        still running.
+        """
+        self.__read_reports()
+        return self.__exited.pop(serial, None)
+
+    def kill(self, serial, signal_number):
+        """
+        Have the zygote send a signal to the given child, unless it has
+        already been reaped.
+        """
+        for pid, live_serial in self.__live.items():
+            if live_serial == serial:
+                self.control.sendall("k%i %i\n" % (pid, signal_number))
+                break
+
+    def spawn(self):
+        """
+        Fork a new universe process.  Returns a ZygoteChild and an
+        IpcHandler connected to it, which has no signal attached yet.
+        """
+        if self.proc is None or self.proc.poll() is not None:
+            self.start()
+
+        child_read, write_fd = os.pipe()
+        read_fd, child_write = os.pipe()
+        try:
+            self.control.sendall("s")
+            send_handle(self.control, child_read, self.proc.pid)
+            send_handle(self.control, child_write, self.proc.pid)
+            while not self.__spawned:
+                self.__read_reports(block=True)
+                if not self.control:
+                    raise IOError("zygote went away")
+        finally:
+            os.close(child_read)
+            os.close(child_write)
+
+        pid = self.__spawned.popleft()
+        serial = self.__next_serial
+        self.__next_serial += 1
+        self.__live[pid] = serial
+        proc = ZygoteChild(pid, self, serial)
+        ipc = IpcHandler(os.fdopen(read_fd, "rb"), os.fdopen(write_fd, "wb"))
+        return proc, ipc
+
+
+zygote = Zygote()
+
+
+def zygote_server(control, run_child):
+    """
+    The fork server loop of the zygote.  Runs until the frontend closes
+    the control socket.  The requests it reads are:
+
+        "s" and two file descriptors   fork a child, which gets them as
+                                       its stdin and stdout, and calls
+                                       run_child
+        "k<pid> <signal>\\n"            signal a child that hasn't been
+                                       reaped yet
+
+    It sends back "p<pid>\\n" for every forked child, and
+    "x<pid> <status>\\n" whenever it reaps one.  The status is what
+    Popen.returncode would be.
+    """
+    children = set()
+    buffer = ""
+    while True:
+        readable = select.select([control], [], [], ZYGOTE_REAP_INTERVAL)[0]
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                break
+            if not pid:
+                break
+            children.discard(pid)
+            if os.WIFSIGNALED(status):
+                status = -os.WTERMSIG(status)
+            else:
+                status = os.WEXITSTATUS(status)
+            control.sendall("x%i %i\n" % (pid, status))
+        if not readable:
+            continue
+
+        command = control.recv(1)
+        if not command:
+            # the frontend went away
+            break
+        if command == "k":
+            while not buffer.endswith("\n"):
+                data = control.recv(1)
+                if not data:
+                    return
+                buffer += data
+            pid, signal_number = [int(field) for field in buffer.split()]
+            buffer = ""
+            if pid in children:
+                os.kill(pid, signal_number)
+            continue
+
+        try:
+            read_fd = recv_handle(control)
+            write_fd = recv_handle(control)
+        except (EOFError, EnvironmentError, RuntimeError):
+            break
+        pid = os.fork()
+        if pid == 0:
+            control.close()
+            os.dup2(read_fd, 0)
+            os.dup2(write_fd, 1)
+            os.close(read_fd)
+            os.close(write_fd)
+            try:
+                run_child()
+            finally:
+                os._exit(0)
+
+        os.close(read_fd)
+        os.close(write_fd)
+        children.add(pid)
+        control.sendall("p%i\n" % pid)
+
+
+class ProcessReaper(object):
+    """
+    Waits for universe processes that were told to exit, and reaps
+    them, so that they don't linger as zombies.  A process that is
+    still running STOP_GRACE seconds after it was added is sent
+    SIGTERM, and STOP_TERM_GRACE seconds after that SIGKILL.
+
+    Processes are polled from a GLib timer, so stopping a universe
+    never blocks the main loop.  A process may be added with an
+    'on_exit' callback, which is run with the process once it has been
+    reaped.  At shutdown, 'finish' waits for all
+    of them at once, so the time it takes doesn't grow with the number
+    of universes.
+
+    Only one instance of this class is needed per process, which is
+    provided as the module level "reaper" variable.
+    """
+
+    # Milliseconds between polls from the main loop.
+    POLL_INTERVAL = 100
+
+    def __init__(self):
+        # [proc, time to send SIGTERM, time to send SIGKILL, signals sent,
+        #  on_exit callback]
+        self.__procs = []
+        self.__source = None
+
+    def __len__(self):
+        return len(self.__procs)
+
+    def add(self, proc, grace=STOP_GRACE, on_exit=None):
+        """
+        Take over a process whose pipes have been closed.
+        """
+        now = time.time()
+        self.__procs.append(
+            [proc, now + grace, now + grace + STOP_TERM_GRACE, 0, on_exit])
+        if self.__source is None:
+            self.__source = GLib.timeout_add(self.POLL_INTERVAL, self.__poll)
+
+    def __step(self, now):
+        """
+        Reap the processes that have exited, and signal the ones that
+        are overdue.  Returns False once there are none left.
+        """
+        remaining = []
+        for entry in self.__procs:
+            proc, term_at, kill_at, sent, on_exit = entry
+            if proc.poll() is not None:
+                if on_exit:
+                    on_exit(proc)
+                continue
+            try:
+                if now >= kill_at and sent < 2:
+                    proc.kill()
+                    entry[3] = 2
+                elif now >= term_at and sent < 1:
+                    proc.terminate()
+                    entry[3] = 1
+            except OSError:
+                pass
+            remaining.append(entry)
+        self.__procs = remaining
+        return bool(remaining)
+
+    def __poll(self):
+        if self.__step(time.time()):
+            return True
+        self.__source = None
+        return False
+
+    def finish(self, grace=STOP_GRACE):
+        """
+        Wait for every process to exit, escalating to SIGTERM after at
+        most 'grace' seconds and to SIGKILL after STOP_TERM_GRACE more.
+        Gives up on processes that still haven't gone STOP_KILL_WAIT
+        seconds after SIGKILL.
+        """
+        if self.__source is not None:
+            GLib.source_remove(self.__source)
+            self.__source = None
+        now = time.time()
+        deadline = now + grace + STOP_TERM_GRACE + STOP_KILL_WAIT
+        for entry in self.__procs:
+            entry[1] = min(entry[1], now + grace)
+            entry[2] = min(entry[2], now + grace + STOP_TERM_GRACE)
+        while self.__step(now) and now < deadline:
+            time.sleep(0.01)
+            now = time.time()
+        for entry in self.__procs:
+            sys.stderr.write(
+                "Universe process %i did not exit\n" % entry[0].pid)
+        self.__procs = []
+
+
+reaper = ProcessReaper()
+
+
+class DetachedIpc(object):
+    """
+    Stands in for the IpcHandler of a universe that has never had a
+    process, such as one restored from the session journal in the
+    hibernated state.  Nothing can be sent or received on it.
+    """
+
+    alive = False
+    metrics = None
+    healthy = True
+    queued_bytes = 0
+
+    def attach(self, signal):
+        pass
+
+    def close(self):
+        pass
+
+    def send_batch(self, packets):
+        pass
+
+    def read(self):
+        return []
+
+
+def prune_universe_caches(max_age=CACHE_MAX_AGE):
+    """
+    Delete the http caches of universes that have not been used in
+    the last 'max_age' days.  The caches of open universes are kept,
+    however old, as a restored session may not have touched them yet.
+    """
+    try:
+        names = os.listdir(CACHE_DIR)
+    except OSError:
+        return
+    in_use = set(
+        found.identity for found in Universe.__active_universes__.values())
+    cutoff = time.time() - max_age * 86400
+    for name in names:
+        if name in in_use:
+            continue
+        path = os.path.join(CACHE_DIR, name)
+        try:
+            if os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+        except OSError:
+            pass
+
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def read_process_usage(pid):
+    """
+    Returns the resident memory in bytes and the total cpu time in
+    seconds used so far by the given process, as read from /proc.
+    Returns None if the process is gone.
+    """
+    try:
+        with open("/proc/%i/stat" % pid) as stat_file:
+            stat = stat_file.read()
+        with open("/proc/%i/statm" % pid) as statm_file:
+            statm = statm_file.read()
+    except IOError:
+        return None
+    # the process name may contain spaces, so skip past it
+    fields = stat[stat.rfind(")") + 2:].split()
+    cpu_ticks = int(fields[11]) + int(fields[12])
+    resident_pages = int(statm.split()[1])
+    return resident_pages * PAGE_SIZE, float(cpu_ticks) / CLOCK_TICKS
+
+
+def spawn_universe_process():
+    """
+    Start a new universe subprocess, as configured by SPAWN_MODE.
+    Returns a Popen like object and an IpcHandler connected to it,
+    which has no signal attached yet.
+    """
+    with tracer.span("spawn universe", mode=SPAWN_MODE):
+        if SPAWN_MODE == "zygote":
+            return zygote.spawn()
+
+        args_list = ["python", "webkit_plug.py", "--wire", WIRE_FORMAT]
+        proc = subprocess.Popen(
+            args_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            close_fds=True)
+        return proc, IpcHandler(proc.stdout, proc.stdin)
+
+
+class UniversePool(object):
+    """
+    Keeps a number of idle universe processes running, so that they
+    have already imported WebKit and initialized Gtk by the time a
+    Universe needs one.  The pool is refilled in the background from
+    the GLib main loop whenever a spare is handed out.
+
+    A spare is handed out exactly once.  Processes never return to the
+    pool, so a universe process that has hosted a tab is never reused
+    for a different universe.
+    """
+
+    def __init__(self, size=POOL_SIZE, spawn=spawn_universe_process):
+        self.size = size
+        self.spawn = spawn
+        self.spares = deque()
+        self.__refill_source = None
+
+    def take(self):
+        """
+        Returns a (proc, ipc) pair for a fresh universe process.  A
+        spare is used when one is available, otherwise a new process
+        is started on the spot.
+        """
+        found = None
+        while self.spares and not found:
+            proc, ipc = self.spares.popleft()
+            if ipc.alive and proc.poll() is None:
+                found = (proc, ipc)
+            else:
+                # the spare died while it waited, so reap what is left
+                ipc.hangup()
+                reaper.add(proc)
+        tracer.instant("take universe process", spare=found is not None)
+        if not found:
+            found = self.spawn()
+        self.schedule_refill()
+        return found
+
+    def schedule_refill(self):
+        """
+        Start topping the pool back up, if it isn't full.
+        """
+        if self.__refill_source is None and len(self.spares) < self.size:
+            self.__refill_source = GLib.timeout_add(
+                POOL_REFILL_DELAY, self.__refill)
+
+    def __refill(self):
+        # spares are started one at a time to spread out the load
+        if len(self.spares) < self.size:
+            try:
+                self.spares.append(self.spawn())
+            except Exception:
+                # try again later rather than giving up on the pool for
+                # the rest of the session
+                sys.stderr.write("Could not start a spare universe:\n%s"
+                                 % traceback.format_exc())
+                self.__refill_source = GLib.timeout_add(
+                    POOL_RETRY_DELAY, self.__refill)
+                return False
+        if len(self.spares) < self.size:
+            return True
+        self.__refill_source = None
+        return False
+
+    def drain(self):
+        """
+        Stop refilling the pool and stop all of the spare processes.
+        """
+        if self.__refill_source is not None:
+            GLib.source_remove(self.__refill_source)
+            self.__refill_source = None
+        while self.spares:
+            proc, ipc = self.spares.popleft()
+            ipc.hangup()
+            reaper.add(proc)
+
+
+pool = UniversePool()
+
 
 class Universe(IpcListener):
     """
@@ -183,29 +1471,233 @@ class Universe(IpcListener):
 
     Use the 'register' method to attach objects to the event routing
     system.
+
+    The subprocess is taken from the module level UniversePool, so it
+    is usually already up and running.
+
+    A universe may be hibernated, which tears down the subprocess but
+    keeps the Universe object and its registered actors around.  The
+    'wake' method starts a new subprocess for it.
+
+    The 'identity' names the universe's on-disk http cache, which is
+    kept under CACHE_DIR until 'wipe_cache' is called.  A new identity
+    is made up when none is given.  A universe created with
+    hibernated=True doesn't start a process until it is woken.
+
+    When the universe process stops reading and the write queue
+    overflows, 'on_health_change' is called with the universe, if it
+    is set, and again once the process has caught up.  If the process
+    goes away without being asked to, the universe is treated as
+    hibernated, so that the next 'wake' starts a fresh one, and
+    'on_hangup' is called with the universe, if it is set.
+
+    Each universe also owns a ThumbnailRing, which its process draws
+    tab thumbnails into.  The slots the frontend is still showing are
+    kept in 'held_thumbnails', so that a woken up process leaves them
+    alone.
     """
 
     __next_universe__ = 1
     __active_universes__ = {}
 
-    def __init__(self):
+    _coalesced_events = frozenset([
+        "title_changed_event",
+        "update_uri",
+        "update_history_buttons",
+        "update_blocked_count",
+    ])
+
+    def __init__(self, identity=None, hibernated=False):
         self.universe_id = str(Universe.__next_universe__)
         Universe.__next_universe__ += 1
         Universe.__active_universes__[self.universe_id] = self
 
-        args_list = ["python", "webkit_plug.py"]
-        self.proc = subprocess.Popen(
-            args_list, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-        self.ipc = IpcHandler(self.proc.stdout, self.proc.stdin, self)
+        self.hibernated = hibernated
+        self.request_filter = None
+        self.on_health_change = None
+        self.on_hangup = None
+        self.blocked_count = 0
+        self.__blocked_before = 0
+        self.identity = identity or uuid.uuid4().hex
+        self.cache_dir = os.path.join(CACHE_DIR, self.identity)
+        self.rss = 0
+        self.cpu = 0.0
+        self.__cpu_sample = None
+        self.__exiting = set()
+        self.__wipe_pending = False
+        self.thumbnails = None
+        self.held_thumbnails = set()
+        if THUMBNAIL_SLOTS:
+            self.thumbnails = ThumbnailRing.create(self.identity)
+        if hibernated:
+            self.proc, self.ipc = None, DetachedIpc()
+        else:
+            self.proc, self.ipc = pool.take()
         IpcListener.__init__(self, self.ipc)
+        self.ipc.attach(self)
+        self.configure_cache()
+        self.configure_thumbnails()
 
     def __repr__(self):
         return "EARTH %s" % self.universe_id
-        
+
+    def sample_usage(self):
+        """
+        Update the "rss" (resident memory in bytes) and "cpu" (percent
+        of one core since the last sample) of the universe process.
+        """
+        usage = None
+        # once the process has been reaped its pid may belong to
+        # something else
+        if self.ipc.alive and self.proc.poll() is None:
+            usage = read_process_usage(self.proc.pid)
+        if usage is None:
+            self.rss = 0
+            self.cpu = 0.0
+            self.__cpu_sample = None
+            return
+
+        now = time.time()
+        self.rss, cpu_time = usage
+        if self.__cpu_sample:
+            last_time, last_cpu_time = self.__cpu_sample
+            elapsed = now - last_time
+            if elapsed > 0:
+                self.cpu = 100.0 * (cpu_time - last_cpu_time) / elapsed
+        self.__cpu_sample = (now, cpu_time)
+
+    def __stop_process(self, reason):
+        # closing the pipes lets the process save its cache and exit,
+        # and the reaper makes sure that it does
+        if self.proc:
+            self.ipc.hangup()
+            self.__exiting.add(self.proc)
+            reaper.add(self.proc, on_exit=self.__process_exited)
+            self.proc = None
+        self.fail_pending_calls(reason)
+
+    def __process_exited(self, proc):
+        self.__exiting.discard(proc)
+        if self.__wipe_pending and not self.__exiting:
+            self.__wipe_pending = False
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def hibernate(self):
+        """
+        Tear down the universe subprocess, but keep this object and the
+        registered actors, so that the universe can be woken up later.
+        """
+        if not self.hibernated:
+            print "Hibernating universe: %s" % self.__repr__()
+            self.hibernated = True
+            self.__stop_process("universe hibernated")
+
+    def wake(self):
+        """
+        Start a new subprocess for a hibernated universe.  The actors
+        are responsible for recreating their state in it.
+        """
+        if self.hibernated:
+            print "Waking universe: %s" % self.__repr__()
+            self.hibernated = False
+            self.__cpu_sample = None
+            self.__blocked_before = self.blocked_count
+            self.proc, self.ipc = pool.take()
+            self.ipc.attach(self)
+            self.configure_cache()
+            self.configure_thumbnails()
+            if self.request_filter:
+                self.send("update_filter", **self.request_filter)
+
+    def configure_cache(self):
+        """
+        Point the universe process at this universe's http cache.  This
+        is sent before any tabs are created in the process.
+        """
+        self.send("configure_cache",
+                  path=self.cache_dir, max_size=CACHE_SIZE << 20)
+
+    def configure_thumbnails(self):
+        """
+        Point the universe process at this universe's thumbnail ring.
+        """
+        if self.thumbnails:
+            self.send("configure_thumbnails",
+                      held=sorted(self.held_thumbnails),
+                      **self.thumbnails.config())
+
+    def wipe_cache(self):
+        """
+        Delete the universe's http cache from disk.  The process should
+        be stopped first, so that it doesn't write to it again.  A
+        process that is still saving its cache on the way out is waited
+        for, and the cache is deleted once the reaper has reaped it.
+        """
+        if self.__exiting:
+            self.__wipe_pending = True
+        else:
+            shutil.rmtree(self.cache_dir, ignore_errors=True)
+
+    def set_request_filter(self, allow=(), block=(), default="allow"):
+        """
+        Replace the rules the universe process uses to decide which
+        hosts its pages may make requests to.  See RequestFilter.
+        """
+        self.request_filter = {
+            "allow" : list(allow),
+            "block" : list(block),
+            "default" : default,
+        }
+        self.send("update_filter", **self.request_filter)
+
+    def hangup_event(self):
+        if not self.hibernated:
+            print "Universe process went away: %s" % self.__repr__()
+            self.hibernated = True
+            self.__stop_process("universe process went away")
+            if self.on_hangup:
+                self.on_hangup(self)
+
+    def health_event(self, healthy):
+        if not healthy:
+            print "Universe is not responding: %s" % self.__repr__()
+        if self.on_health_change:
+            self.on_health_change(self)
+
+    def thumbnail_ready(self, target, slot):
+        """
+        Event handler for a thumbnail drawn by the universe process,
+        which is handed to its tab.  If the tab has been closed in the
+        mean time, the slot is released right away, so that it can be
+        drawn into again.
+        """
+        tab = self.actors.get(target)
+        if tab is not None:
+            tab.thumbnail_ready(slot)
+        elif self.thumbnails and 0 <= slot < len(self.thumbnails.slots):
+            self.send("release_thumbnail", slot=slot)
+
+    def update_blocked_count(self, count):
+        """
+        Event handler for the number of requests the universe process
+        has refused so far.  "blocked_count" adds up every process the
+        universe has had.
+        """
+        self.blocked_count = self.__blocked_before + count
+
+    def trace_events(self, events):
+        """
+        Event handler for the startup trace of the universe process.
+        The trace file is rewritten to include it.
+        """
+        tracer.extend(events)
+        tracer.save()
+
     def destroy(self):
-        if self.ipc.alive:
-            self.ipc.alive = False
+        if Universe.__active_universes__.pop(self.universe_id, None):
             print "Destroying universe: %s" % self.__repr__()
-            Universe.__active_universes__.pop(self.universe_id)
-            self.proc.kill()
-            self.actors = []
+            self.__stop_process("universe destroyed")
+            self.actors = {}
+            if self.thumbnails:
+                # thumbnails on screen keep their mappings
+                self.thumbnails.unlink()
@@ -17,26 +17,63 @@
 # along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
 
 
-import json
+import time
+IMPORT_START = time.time()
+
+import os
+import sys
+import socket
+from collections import deque
+
 import gi
 gi.require_version("WebKit", "3.0")
-from gi.repository import WebKit, Gtk, GObject
+gi.require_version("Soup", "2.4")
+from gi.repository import WebKit, Soup, Gtk, GObject, GLib
+import cairo
+
+from universe import IpcHandler, IpcListener, WIRE_FORMAT, zygote_server
+from request_filter import RequestFilter
+from filter_list import default_filter_list
+from thumbnails import ThumbnailRing
+from tracing import tracer
+import ipc_metrics
+
+tracer.complete("worker imports", IMPORT_START)
+
 
-from universe import IpcHandler, IpcListener
+# Seconds between writes of the http cache index to disk.  The process
+# may be killed at any time, and entries missing from the index are
+# lost when the cache is loaded again.
+CACHE_DUMP_INTERVAL = 30
+
+# Milliseconds a tab's page has to stay unchanged before its thumbnail
+# is redrawn, so that a page that is still loading isn't drawn over and
+# over.
+THUMBNAIL_DELAY = 500
 
 
 class BrowserWorker(object):
     """
     This class encapsulates the WebKit.WebView instance corresponding
     to a browser tab.  It is primarily event listeners.
+
+    If a history snapshot (see 'snapshot_state') is provided, the
+    back/forward list is rebuilt from it and its current entry is
+    loaded instead of the url.
+
+    The tab's thumbnail is redrawn a little while after the page
+    finishes loading or changes its title, but only while the frontend
+    says its row in the tab tree is visible.
     """
 
-    def __init__(self, tracker, url, tab_id):
+    def __init__(self, tracker, url, tab_id, history=None):
         self.alive = True
+        self.thumbnail_visible = False
+        self.thumbnail_dirty = True
+        self.thumbnail_timer = None
         self.tracker = tracker
         self.uuid = tab_id
         self.plug = Gtk.Plug()
-        self.plug.connect("destroy", Gtk.main_quit)
         
         self.webview = WebKit.WebView()
         settings = self.webview.get_settings()
@@ -45,6 +82,9 @@ class BrowserWorker(object):
 
         self.webview.connect("load-started", self.load_start_event)
         self.webview.connect("notify::title", self.push_title_change)
+        self.webview.connect("load-finished", self.page_changed_event)
+        self.webview.connect(
+            "resource-request-starting", self.resource_request_event)
 
         scrolled_window = Gtk.ScrolledWindow()
         scrolled_window.add(self.webview)
@@ -53,7 +93,10 @@ class BrowserWorker(object):
         self.plug.show_all()
 
         self.send("attach_event", plug_id = str(self.plug.get_id()))
-        self.navigate_event(url)
+        if history and history["entries"]:
+            self.restore_history(history)
+        else:
+            self.navigate_event(url)
 
     def send(self, action, **packet):
         """
@@ -64,24 +107,158 @@ class BrowserWorker(object):
         if self.alive:
             self.tracker.send(action, target=self.uuid, **packet)
 
+    def send_coalesced(self, action, **packet):
+        """
+        Like 'send', but for high frequency events.  Only the latest
+        packet for each action is sent, at most once per frame.
+        """
+        if self.alive:
+            self.tracker.send_coalesced(action, target=self.uuid, **packet)
+
     def load_start_event(self, *args, **kargs):
         uri = self.webview.get_uri()
-        self.send("update_uri", uri=uri)
+        self.send_coalesced("update_uri", uri=uri)
         self.update_history_state()
+        if tracer.enabled:
+            tracer.instant("load-started", uri=uri)
+            self.tracker.send_trace()
     
+    def resource_request_event(self, webview, frame, resource, request,
+                               response):
+        """
+        Refuse requests to hosts that the universe's RequestFilter does
+        not permit, by pointing them at about:blank.  Top level
+        navigations are left alone, since deciding which universe a
+        page belongs in is up to the frontend.
+        """
+        uri = request.get_uri()
+        if not uri or self.tracker.request_filter.allows(uri):
+            return
+        if frame == webview.get_main_frame():
+            data_source = frame.get_provisional_data_source()
+            if data_source:
+                if data_source.get_initial_request().get_uri() == uri:
+                    return
+        self.tracker.blocked_count += 1
+        self.tracker.send_coalesced(
+            "update_blocked_count", count=self.tracker.blocked_count)
+        request.set_uri("about:blank")
+
     def push_title_change(self, *args, **kargs):
         title = self.webview.get_title()
         if title:
-            self.send("title_changed_event", new_title=str(title))
+            self.send_coalesced("title_changed_event", new_title=str(title))
+        self.page_changed_event()
+
+    def page_changed_event(self, *args, **kargs):
+        """
+        Event handler for when the page may look different, which
+        schedules a new thumbnail.
+        """
+        self.thumbnail_dirty = True
+        self.schedule_thumbnail()
+
+    def set_thumbnail_visible(self, visible):
+        """
+        Event handler for when the tab's row in the tab tree scrolls
+        into or out of view.
+        """
+        self.thumbnail_visible = visible
+        self.schedule_thumbnail()
+
+    def schedule_thumbnail(self):
+        if self.thumbnail_timer is not None:
+            GLib.source_remove(self.thumbnail_timer)
+            self.thumbnail_timer = None
+        if self.thumbnail_visible and self.thumbnail_dirty:
+            self.thumbnail_timer = GLib.timeout_add(
+                THUMBNAIL_DELAY, self.draw_thumbnail)
+
+    def draw_thumbnail(self):
+        """
+        Timer callback that draws the page, scaled down to fit the
+        width of a thumbnail, into a free slot of the universe's
+        ThumbnailRing, and tells the frontend which slot it is in.
+        """
+        self.thumbnail_timer = None
+        ring = self.tracker.thumbnails
+        if not self.alive or not ring:
+            return False
+        slot = self.tracker.take_thumbnail_slot()
+        if slot is None:
+            # every slot is on screen, so try again later
+            self.schedule_thumbnail()
+            return False
+        snapshot = self.webview.get_snapshot()
+        if not snapshot or not snapshot.get_width():
+            self.tracker.release_thumbnail(slot)
+            return False
+
+        surface = ring.surface(slot)
+        context = cairo.Context(surface)
+        context.set_operator(cairo.OPERATOR_SOURCE)
+        context.set_source_rgb(1, 1, 1)
+        context.paint()
+        scale = float(ring.width) / snapshot.get_width()
+        context.scale(scale, scale)
+        context.set_source_surface(snapshot, 0, 0)
+        context.paint()
+        surface.flush()
+        del context, surface
+
+        self.thumbnail_dirty = False
+        self.send("thumbnail_ready", slot=slot)
+        return False
 
     def navigate_event(self, uri):
         self.webview.load_uri(uri)
-        self.send("update_uri", uri=uri)
+        self.send_coalesced("update_uri", uri=uri)
+
+    def history_state(self):
+        return {
+            "back" : self.webview.can_go_back(),
+            "forward" : self.webview.can_go_forward(),
+        }
 
     def update_history_state(self):
-        self.send("update_history_buttons",
-                  back=self.webview.can_go_back(),
-                  forward=self.webview.can_go_forward())
+        self.send_coalesced("update_history_buttons", **self.history_state())
+
+    def query_history_state(self):
+        return self.history_state()
+
+    def snapshot_state(self):
+        """
+        Returns the url, title and back/forward list of this tab, so
+        that it can be restored in a new universe process later.
+        """
+        history = self.webview.get_back_forward_list()
+        back = history.get_back_length()
+        forward = history.get_forward_length()
+        entries = []
+        for index in range(-back, forward + 1):
+            item = history.get_nth_item(index)
+            if item:
+                entries.append((item.get_uri(), item.get_title() or ""))
+        return {
+            "uri" : self.webview.get_uri(),
+            "title" : self.webview.get_title() or "",
+            "history" : {"entries" : entries, "index" : back},
+        }
+
+    def restore_history(self, history):
+        """
+        Rebuild the back/forward list from a snapshot, and load its
+        current entry.
+        """
+        back_forward = self.webview.get_back_forward_list()
+        items = []
+        for uri, title in history["entries"]:
+            item = WebKit.WebHistoryItem.new_with_data(uri, title)
+            back_forward.add_item(item)
+            items.append(item)
+        index = min(max(history["index"], 0), len(items) - 1)
+        self.webview.go_to_back_forward_item(items[index])
+        self.send("update_uri", uri=items[index].get_uri())
 
     def history_forward(self):
         self.webview.go_forward()
@@ -96,8 +273,16 @@ class BrowserWorker(object):
 
     def teardown(self):
         self.alive = False
+        if self.thumbnail_timer is not None:
+            GLib.source_remove(self.thumbnail_timer)
+            self.thumbnail_timer = None
         self.tracker.remove(self.uuid)
         self.plug.destroy()
+        if not self.tracker.actors:
+            # other tabs may share this universe, so the process only
+            # quits along with the last one
+            self.tracker.dump_cache()
+            Gtk.main_quit()
 
 
 class UniverseTracker(IpcListener):
@@ -106,14 +291,138 @@ class UniverseTracker(IpcListener):
     BrowserTab instances and their corresponding BrowserWorker
     instances.
     """
-    def __init__(self):
-        IpcListener.__init__(self, IpcHandler(signal=self))
-        
-    def create_new_tab(self, target, url):
-        new_tab = BrowserWorker(self, url, target)
+    def __init__(self, wire_format=WIRE_FORMAT):
+        IpcListener.__init__(
+            self, IpcHandler(signal=self, wire_format=wire_format))
+        self.request_filter = RequestFilter(
+            filter_list=default_filter_list())
+        self.blocked_count = 0
+        self.cache = None
+        self.thumbnails = None
+        self.free_thumbnails = deque()
+
+    def create_new_tab(self, target, url, history=None):
+        with tracer.span("create_new_tab", url=url):
+            new_tab = BrowserWorker(self, url, target, history)
         self.register(target, new_tab)
 
-if __name__ == "__main__":
-    Gtk.init()
-    UniverseTracker()
+    def send_trace(self):
+        """
+        Hand the trace events recorded so far to the frontend.  Only
+        startup is traced, so tracing stops after the first page load.
+        """
+        self.send("trace_events", events=tracer.take())
+        tracer.enabled = False
+
+    def update_filter(self, allow, block, default):
+        """
+        Replace the rules used to filter the requests of every tab in
+        this universe.
+        """
+        self.request_filter.update(allow, block, default)
+
+    def configure_cache(self, path, max_size):
+        """
+        Store the http cache of this universe in the given directory,
+        holding at most max_size bytes.  Soup evicts the least recently
+        used entries once the cache is full.
+        """
+        session = WebKit.get_default_session()
+        if self.cache:
+            self.dump_cache()
+            session.remove_feature(self.cache)
+        else:
+            GLib.timeout_add_seconds(CACHE_DUMP_INTERVAL, self.dump_cache)
+        self.cache = Soup.Cache.new(path, Soup.CacheType.SINGLE_USER)
+        session.add_feature(self.cache)
+        self.cache.load()
+        self.cache.set_max_size(max_size)
+
+    def configure_thumbnails(self, path, slots, width, height, held):
+        """
+        Map the universe's ThumbnailRing.  The 'held' slots are still
+        shown by the frontend, from before this process was started, so
+        they are only used once the frontend releases them.
+        """
+        self.thumbnails = ThumbnailRing(path, slots, width, height)
+        held = set(held)
+        self.free_thumbnails = deque(
+            slot for slot in range(slots) if slot not in held)
+
+    def take_thumbnail_slot(self):
+        """
+        Returns a thumbnail slot that is free to draw into, or None.
+        """
+        if self.free_thumbnails:
+            return self.free_thumbnails.popleft()
+        return None
+
+    def release_thumbnail(self, slot):
+        """
+        Event handler for when the frontend stops showing a thumbnail,
+        so that its slot may be drawn into again.
+        """
+        self.free_thumbnails.append(slot)
+
+    def dump_cache(self):
+        """
+        Write the index of the http cache to disk.  This is also a
+        GLib timer callback.
+        """
+        if self.cache:
+            self.cache.flush()
+            self.cache.dump()
+        return True
+
+    def ping(self):
+        """
+        Lets the frontend check that this universe is responsive.
+        """
+        return True
+
+    def hangup_event(self):
+        """
+        The frontend went away, so there is nothing left to do.
+        """
+        self.dump_cache()
+        Gtk.main_quit()
+
+
+def run_universe(wire_format):
+    """
+    Run a universe process on stdin and stdout until the frontend
+    goes away.
+    """
+    tracer.name_process("universe %i" % os.getpid())
+    with tracer.span("Gtk.init"):
+        Gtk.init()
+    with tracer.span("UniverseTracker"):
+        tracker = UniverseTracker(wire_format)
+    ipc_metrics.on_dump_signal(GLib, lambda: ipc_metrics.dump(
+        "universe %i" % os.getpid(), tracker.dump_metrics()))
     Gtk.main()
+
+
+def run_zygote(wire_format):
+    """
+    Fork server mode.  Stdin is a unix socket connected to the
+    frontend's Zygote object.  For each pair of file descriptors
+    received on it, a child is forked that uses them as its stdin and
+    stdout and runs a normal universe.  The zygote stays the parent of
+    its children, and reaps them itself (see zygote_server).  The WebKit stack is already
+    imported at this point, so the children share those pages with
+    this process copy-on-write.  Gtk is only initialized in the
+    children, so no display connection is shared between them.
+    """
+    control = socket.fromfd(0, socket.AF_UNIX, socket.SOCK_STREAM)
+    zygote_server(control, lambda: run_universe(wire_format))
+
+
+if __name__ == "__main__":
+    wire_format = WIRE_FORMAT
+    if "--wire" in sys.argv:
+        wire_format = sys.argv[sys.argv.index("--wire") + 1]
+    if "--zygote" in sys.argv:
+        run_zygote(wire_format)
+    else:
+        run_universe(wire_format)
@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+
+# This file is part of Ridinghood.
+#
+# Ridinghood is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ridinghood is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+# General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ridinghood.  If not, see <http://www.gnu.org/licenses/>.
+
+
+import json
+import struct
+
+
+# Actions that are known to both ends of the universe protocol.  The
+# binary wire format sends the position of the action in this tuple
+# instead of its name, so new entries must only ever be appended.
+# Code zero means the action name is sent inline with the packet.
+ACTIONS = (
+    None,
+    "create_new_tab",
+    "attach_event",
+    "navigate_event",
+    "update_uri",
+    "title_changed_event",
+    "update_history_state",
+    "update_history_buttons",
+    "history_forward",
+    "history_backward",
+    "reload",
+    "teardown",
+    "call_reply",
+    "query_history_state",
+    "ping",
+    "snapshot_state",
+    "update_filter",
+    "configure_cache",
+    "trace_events",
+    "dump_metrics",
+    "configure_thumbnails",
+    "thumbnail_ready",
+    "release_thumbnail",
+    "set_thumbnail_visible",
+    "update_blocked_count",
+)
+
+
+class JsonWire(object):
+    """
+    The original line based framing.  Each packet is a line of text
+    starting with "JSON:" followed by the json encoded packet.  Any
+    newlines in the json are swapped for chr(31).
+
+    This is slower than the binary framing, but it is human readable,
+    which makes it handy for debugging.
+    """
+
+    name = "json"
+
+    def encode(self, action, kargs):
+        """
+        Returns the wire representation of a single packet.
+        """
+        return "JSON:" + json.dumps({
+            "action" : action,
+            "kargs" : kargs,
+        }).strip().replace("\n", chr(31)) + "\n"
+
+    def decode(self, buffer, sizes=None):
+        """
+        Decodes every complete packet in the given bytearray, and
+        removes the consumed bytes from it.  Lines that are not
+        packets are returned as strings, and packets that can't be
+        parsed are returned without an action.  If a list is passed
+        in as 'sizes', the wire size of each packet is appended to it.
+        """
+        packets = []
+        end = buffer.rfind("\n")
+        if end == -1:
+            return packets
+        for raw in str(buffer[:end]).split("\n"):
+            if sizes is not None:
+                sizes.append(len(raw) + 1)
+            if raw.startswith("JSON:"):
+                raw = raw.replace(chr(31), "\n")
+                try:
+                    packet = json.loads(raw[5:])
+                except ValueError:
+                    packet = None
+                if type(packet) is not dict:
+                    # the listener counts this as malformed, like a bad
+                    # binary frame
+                    packet = {"action" : None, "kargs" : None}
+                packets.append(packet)
+            else:
+                packets.append(raw)
+        del buffer[:end + 1]
+        return packets
+
+
+class BinaryWire(object):
+    """
+    A compact, length prefixed framing.  Each frame starts with a
+    header made of a marker byte, the action code (see ACTIONS), and
+    the length of the payload.  The payload is the packet's kargs in
+    a small tagged binary encoding.  When the action code is zero,
+    the action name is stored at the front of the payload.
+
+    Anything that does not start with the marker byte is treated as a
+    stray line of text, so that debug output accidentally written to
+    the pipe does not desynchronize the stream.
+    """
+
+    name = "binary"
+
+    MARKER = 0xfe
+    HEADER = struct.Struct("!BHI")
+    INT = struct.Struct("!q")
+    FLOAT = struct.Struct("!d")
+    COUNT = struct.Struct("!I")
+    KEY = struct.Struct("!H")
+
+    def __init__(self):
+        self.codes = dict((name, code) for code, name in enumerate(ACTIONS))
+        self.__keys = {}
+
+    def encode(self, action, kargs):
+        """
+        Returns the wire representation of a single packet.
+        """
+        parts = []
+        code = self.codes.get(action, 0)
+        if not code:
+            self.__encode_value(action, parts)
+        self.__encode_value(kargs, parts)
+        payload = "".join(parts)
+        return self.HEADER.pack(self.MARKER, code, len(payload)) + payload
+
+    def __encode_value(self, value, parts):
+        if value is None:
+            parts.append("N")
+        elif value is True:
+            parts.append("T")
+        elif value is False:
+            parts.append("F")
+        elif isinstance(value, (int, long)):
+            parts.append("i" + self.INT.pack(value))
+        elif isinstance(value, float):
+            parts.append("d" + self.FLOAT.pack(value))
+        elif isinstance(value, basestring):
+            if isinstance(value, unicode):
+                value = value.encode("utf-8")
+            parts.append("s" + self.COUNT.pack(len(value)) + value)
+        elif isinstance(value, (list, tuple)):
+            parts.append("l" + self.COUNT.pack(len(value)))
+            for item in value:
+                self.__encode_value(item, parts)
+        elif isinstance(value, dict):
+            parts.append("m" + self.COUNT.pack(len(value)))
+            for key, item in value.iteritems():
+                if isinstance(key, unicode):
+                    key = key.encode("utf-8")
+                parts.append(self.KEY.pack(len(key)) + key)
+                self.__encode_value(item, parts)
+        else:
+            raise TypeError("Can't encode %r for the wire." % (value,))
+
+    def decode(self, buffer, sizes=None):
+        """
+        Decodes every complete frame in the given bytearray, and
+        removes the consumed bytes from it.  Stray lines of text are
+        returned as strings.  If a list is passed in as 'sizes', the
+        wire size of each packet is appended to it.
+        """
+        packets = []
+        offset = 0
+        available = len(buffer)
+        header_size = self.HEADER.size
+        while offset < available:
+            if buffer[offset] != self.MARKER:
+                end = buffer.find("\n", offset)
+                if end == -1:
+                    break
+                packets.append(str(buffer[offset:end]))
+                if sizes is not None:
+                    sizes.append(end + 1 - offset)
+                offset = end + 1
+                continue
+
+            if available - offset < header_size:
+                break
+            marker, code, length = self.HEADER.unpack_from(buffer, offset)
+            start = offset + header_size
+            end = start + length
+            if end > available:
+                break
+            if sizes is not None:
+                sizes.append(end - offset)
+            offset = end
+
+            try:
+                if code:
+                    action = ACTIONS[code]
+                else:
+                    action, start = self.__decode_value(buffer, start)
+                kargs = self.__decode_value(buffer, start)[0]
+            except (IndexError, ValueError, struct.error):
+                packets.append({"action" : None, "kargs" : None})
+                continue
+            packets.append({"action" : action, "kargs" : kargs})
+
+        del buffer[:offset]
+        return packets
+
+    def __decode_value(self, buffer, offset):
+        tag = chr(buffer[offset])
+        offset += 1
+        if tag == "s":
+            length = self.COUNT.unpack_from(buffer, offset)[0]
+            offset += 4
+            value = buffer[offset:offset + length].decode("utf-8")
+            return value, offset + length
+        elif tag == "m":
+            count = self.COUNT.unpack_from(buffer, offset)[0]
+            offset += 4
+            value = {}
+            for i in xrange(count):
+                length = self.KEY.unpack_from(buffer, offset)[0]
+                offset += 2
+                raw_key = str(buffer[offset:offset + length])
+                key = self.__keys.get(raw_key)
+                if key is None:
+                    key = self.__keys.setdefault(raw_key, intern(raw_key))
+                offset += length
+                value[key], offset = self.__decode_value(buffer, offset)
+            return value, offset
+        elif tag == "N":
+            return None, offset
+        elif tag == "T":
+            return True, offset
+        elif tag == "F":
+            return False, offset
+        elif tag == "i":
+            return self.INT.unpack_from(buffer, offset)[0], offset + 8
+        elif tag == "d":
+            return self.FLOAT.unpack_from(buffer, offset)[0], offset + 8
+        elif tag == "l":
+            count = self.COUNT.unpack_from(buffer, offset)[0]
+            offset += 4
+            value = []
+            for i in xrange(count):
+                item, offset = self.__decode_value(buffer, offset)
+                value.append(item)
+            return value, offset
+        raise ValueError("Unknown wire tag: %r" % tag)
+
+
+# Framings that may be negotiated when a universe process is started.
+FORMATS = {
+    JsonWire.name : JsonWire,
+    BinaryWire.name : BinaryWire,
+}